@@ -0,0 +1,288 @@
+"""
+Filename:    cdml.py
+
+Description: Index NetCDF files and write a CDML (cdms2 xml) catalogue
+             without calling cdscan. Each file is opened once, in a
+             thread pool, to read its axes and variable metadata.
+
+Copyright:   CSIRO, 2015
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import os
+import json
+import codecs
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape, quoteattr
+
+import numpy as np
+import netCDF4 as nc4
+
+CDML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+              '<!DOCTYPE dataset SYSTEM "http://www-pcmdi.llnl.gov/software/cdms/cdml.dtd">\n'
+
+CDMS_DATATYPES = {'f4': 'Float', 'f8': 'Double',
+                  'i1': 'Byte', 'i2': 'Short', 'i4': 'Int', 'i8': 'Long',
+                  'u1': 'Byte', 'u2': 'Short', 'u4': 'Int', 'u8': 'Long',
+                  'S1': 'Char'}
+
+
+def datatype(dtype):
+    dtype = np.dtype(dtype)
+    return CDMS_DATATYPES.get(dtype.str[1:], 'String' if dtype.kind in 'SUO' else 'Double')
+
+
+def attributes(obj):
+    return dict((att, obj.getncattr(att)) for att in obj.ncattrs())
+
+
+def scan_file(path):
+    """Read the metadata and axis values of one NetCDF file."""
+
+    with nc4.Dataset(path) as ds:
+        record = {'path': path,
+                  'attributes': attributes(ds),
+                  'dimensions': dict((name, len(dim)) for name, dim in ds.dimensions.items()),
+                  'variables': {},
+                  'axes': {}}
+        for name, var in ds.variables.items():
+            record['variables'][name] = {'dtype': var.dtype,
+                                         'dimensions': var.dimensions,
+                                         'attributes': attributes(var)}
+            if var.dimensions == (name,):
+                var.set_auto_mask(False)
+                record['axes'][name] = var[:]
+    return record
+
+
+def scan_files(paths, threads=None):
+    """Scan the files in a thread pool, keeping their order."""
+
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(scan_file, paths)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def time_span(record):
+    """(first, last, units, calendar) of the time axis of a record."""
+
+    t = record['axes'].get('time')
+    if t is None or len(t) == 0:
+        return None
+    atts = record['variables']['time']['attributes']
+    return float(t[0]), float(t[-1]), atts.get('units'), atts.get('calendar', 'standard')
+
+
+def merged_time(records):
+    """The time axis of the records concatenated in the units of the first."""
+
+    atts = records[0]['variables']['time']['attributes']
+    units, calendar = atts['units'], atts.get('calendar', 'standard')
+    values = []
+    for record in records:
+        t = record['axes']['time']
+        rec_units = record['variables']['time']['attributes']['units']
+        if rec_units != units:
+            t = nc4.date2num(nc4.num2date(t, rec_units, calendar), units, calendar)
+        values.append(np.asarray(t, dtype=np.float64))
+    return np.concatenate(values)
+
+
+def format_values(values):
+    values = np.asarray(values)
+    if values.dtype.kind in 'SU':
+        return ''.join(values.astype(str))
+    if values.ndim == 0:
+        values = values.reshape(1)
+    if values.dtype.kind == 'f':
+        return '[' + ' '.join(repr(float(v)) for v in values) + ']'
+    return '[' + ' '.join('%d' % v for v in values) + ']'
+
+
+def format_attr_value(value):
+    if isinstance(value, basestring):
+        return value
+    return format_values(value).strip('[]')
+
+
+def write_attributes(out, atts, indent):
+    """Write string attributes inline, everything else as attr elements.
+
+    Returns the non-string attributes for writing as child elements.
+    """
+
+    children = []
+    for name in sorted(atts):
+        value = atts[name]
+        if isinstance(value, basestring):
+            out.write('%s%s =%s\n' % (indent, name, quoteattr(value)))
+        else:
+            children.append((name, value))
+    return children
+
+
+def write_attr_elements(out, children, indent):
+    for name, value in children:
+        out.write('%s<attr datatype=%s name=%s >%s</attr>\n'
+                  % (indent, quoteattr(datatype(np.asarray(value).dtype)), quoteattr(name),
+                     escape(format_attr_value(value))))
+
+
+def filemap(records, time_dependent, directory):
+    """The cdms_filemap attribute.
+
+    Time dependent variables are partitioned over all the files, the rest
+    are read from the first file.
+    """
+
+    paths = [os.path.relpath(r['path'], directory) for r in records]
+
+    entries = []
+    if time_dependent:
+        start = 0
+        parts = []
+        for record, path in zip(records, paths):
+            length = record['dimensions']['time']
+            parts.append('[%d,%d,-,-,-,%s]' % (start, start + length, path))
+            start += length
+        entries.append('[[%s],[%s]]' % (','.join(sorted(time_dependent)), ','.join(parts)))
+
+    static = sorted(set(records[0]['variables']) - set(records[0]['axes']) - set(time_dependent))
+    if static:
+        entries.append('[[%s],[[-,-,-,-,-,%s]]]' % (','.join(static), paths[0]))
+
+    return '[%s]' % ','.join(entries)
+
+
+def common_directory(paths):
+    directory = os.path.commonprefix([os.path.dirname(os.path.abspath(p)) + os.sep for p in paths])
+    return os.path.dirname(directory)
+
+
+@contextmanager
+def replacing(output):
+    """Write UTF-8 text to a temporary file next to output, then rename it into place.
+
+    A failed write leaves any previous output as it was.
+    """
+
+    temp_output = '%s.%d.tmp' % (output, os.getpid())
+    out = codecs.open(temp_output, 'w', 'utf-8')
+    try:
+        yield out
+        out.close()
+        os.rename(temp_output, output)
+    except:
+        out.close()
+        os.remove(temp_output)
+        raise
+
+
+def write_cdml(records, output):
+    """Write a CDML catalogue of the scanned records, in time order."""
+
+    first = records[0]
+    time_dependent = [name for name, var in first['variables'].items()
+                      if 'time' in var['dimensions'] and name not in first['axes']]
+    for record in records[1:]:
+        for name, length in first['dimensions'].items():
+            if name != 'time' and record['dimensions'].get(name) != length:
+                raise ValueError('Dimension %s of %s does not match %s'
+                                 % (name, record['path'], first['path']))
+
+    directory = common_directory([r['path'] for r in records])
+    lengths = dict(first['dimensions'])
+    axes = dict(first['axes'])
+    if 'time' in first['dimensions']:
+        lengths['time'] = sum(r['dimensions']['time'] for r in records)
+        if 'time' in axes:
+            axes['time'] = merged_time(records)
+
+    with replacing(output) as out:
+        out.write(CDML_HEADER)
+        out.write('<dataset\n\tid ="none"\n')
+        dataset_atts = dict(first['attributes'])
+        dataset_atts['cdms_filemap'] = filemap(records, time_dependent, directory)
+        dataset_atts['directory'] = directory
+        children = write_attributes(out, dataset_atts, '\t')
+        out.write('\t>\n')
+        write_attr_elements(out, children, '\t')
+
+        for name in sorted(lengths):
+            var = first['variables'].get(name)
+            values = axes.get(name, np.arange(lengths[name], dtype=np.float64))
+            atts = dict(var['attributes']) if name in axes else {}
+            atts.pop('_FillValue', None)
+            atts['datatype'] = datatype(var['dtype'] if name in axes else np.float64)
+            atts['length'] = str(lengths[name])
+            if name == 'time' and len(records) > 1:
+                ends = np.cumsum([r['dimensions']['time'] for r in records])
+                partition = np.column_stack((np.concatenate(([0], ends[:-1])), ends)).ravel()
+                atts['partition'] = format_values(partition)
+            out.write('\t<axis\n\t\tid =%s\n' % quoteattr(name))
+            children = write_attributes(out, atts, '\t\t')
+            out.write('\t\t>%s\n' % format_values(values))
+            write_attr_elements(out, children, '\t\t')
+            out.write('\t</axis>\n')
+
+        for name in sorted(set(first['variables']) - set(axes)):
+            var = first['variables'][name]
+            atts = dict(var['attributes'])
+            atts['datatype'] = datatype(var['dtype'])
+            out.write('\t<variable\n\t\tid =%s\n' % quoteattr(name))
+            children = write_attributes(out, atts, '\t\t')
+            out.write('\t\t>\n')
+            write_attr_elements(out, children, '\t\t')
+            out.write('\t\t<domain >\n')
+            for dim in var['dimensions']:
+                out.write('\t\t\t<domElem name=%s start="0" length="%d"/>\n'
+                          % (quoteattr(dim), lengths[dim]))
+            out.write('\t\t</domain>\n')
+            out.write('\t</variable>\n')
+
+        out.write('</dataset>\n')
+
+
+def json_value(value):
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return value
+
+
+def write_json(records, output):
+    """Write a JSON summary of the catalogue: files, time spans and variables."""
+
+    files = []
+    for record in records:
+        entry = {'path': os.path.abspath(record['path']),
+                 'dimensions': record['dimensions']}
+        span = time_span(record)
+        if span:
+            entry['time'] = dict(zip(('start', 'end', 'units', 'calendar'), span))
+        files.append(entry)
+
+    first = records[0]
+    variables = {}
+    for name, var in first['variables'].items():
+        variables[name] = {'dimensions': list(var['dimensions']),
+                           'datatype': datatype(var['dtype']),
+                           'attributes': dict((k, json_value(v)) for k, v in var['attributes'].items())}
+
+    with replacing(output) as out:
+        json.dump({'attributes': dict((k, json_value(v)) for k, v in first['attributes'].items()),
+                   'variables': variables,
+                   'files': files}, out, indent=1, sort_keys=True)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+Copyright 2015 CSIRO
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Calculate an ensemble statistic in parallel.
+
+This is a drop-in alternative to cdo_ensemble_agg.sh for large ensembles.
+Rather than one process reading every member in full, the domain is split
+into latitude bands (or blocks of time steps) and each tile is reduced
+by a separate process. Members are read one at a time into streaming
+(Welford) accumulators, so the memory used per tile does not grow with
+the ensemble size, except for percentiles which need every member.
+
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+import numpy as np
+import netCDF4 as nc4
+
+
+XML_TO_NC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'utils', 'xml_to_nc.py')
+
+STATISTICS = ('ensmin', 'ensmax', 'enssum', 'ensmean', 'ensavg',
+              'ensvar', 'ensvar1', 'ensstd', 'ensstd1', 'enspctl')
+
+LAT_NAMES = ('lat', 'latitude', 'y', 'j', 'rlat')
+
+
+def parse_statistic(statistic):
+    """Split 'enspctl,90' into ('enspctl', 90.0)."""
+
+    fields = statistic.split(',')
+    name = fields[0]
+    if name not in STATISTICS:
+        raise ValueError('Unknown statistic: %s' % statistic)
+    if name == 'enspctl':
+        if len(fields) != 2:
+            raise ValueError('enspctl requires a percentile, e.g. enspctl,90')
+        return name, float(fields[1])
+    return name, None
+
+
+class WelfordAccumulator(object):
+    """Running count, mean, sum of squared deviations, min and max."""
+
+    def __init__(self, shape):
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.empty(shape)
+        self.min[:] = np.inf
+        self.max = np.empty(shape)
+        self.max[:] = -np.inf
+
+    def update(self, data):
+        valid = ~np.ma.getmaskarray(data)
+        values = np.ma.getdata(data).astype(np.float64)
+
+        self.count += valid
+        delta = np.where(valid, values - self.mean, 0.0)
+        safe_count = np.maximum(self.count, 1)
+        self.mean += delta / safe_count
+        self.m2 += delta * np.where(valid, values - self.mean, 0.0)
+
+        np.minimum(self.min, np.where(valid, values, np.inf), out=self.min)
+        np.maximum(self.max, np.where(valid, values, -np.inf), out=self.max)
+
+    def result(self, name):
+        if name == 'ensmin':
+            values = self.min
+        elif name == 'ensmax':
+            values = self.max
+        elif name == 'enssum':
+            values = self.mean * self.count
+        elif name in ('ensmean', 'ensavg'):
+            values = self.mean
+        else:
+            ddof = 1 if name.endswith('1') else 0
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = self.m2 / (self.count - ddof)
+            if name.startswith('ensstd'):
+                values = np.sqrt(values)
+
+        min_count = 2 if name in ('ensvar1', 'ensstd1') else 1
+        return np.ma.masked_where(self.count < min_count, values)
+
+
+def tile_slices(shape, axis, tile_size):
+    """Index tuples that split an array of the given shape along axis."""
+
+    slices = []
+    for start in range(0, shape[axis], tile_size):
+        index = [slice(None)] * len(shape)
+        index[axis] = slice(start, min(start + tile_size, shape[axis]))
+        slices.append(tuple(index))
+    return slices
+
+
+def reduce_tile(task):
+    """Reduce one tile of one variable over all the ensemble members."""
+
+    infiles, var_name, index, statistic, percentile = task
+
+    if statistic == 'enspctl':
+        members = []
+        for infile in infiles:
+            with nc4.Dataset(infile) as ds:
+                members.append(np.ma.filled(ds.variables[var_name][index].astype(np.float64),
+                                            np.nan))
+        with np.errstate(invalid='ignore'):
+            values = np.nanpercentile(np.array(members), percentile, axis=0)
+        return index, np.ma.masked_invalid(values)
+
+    acc = None
+    for infile in infiles:
+        with nc4.Dataset(infile) as ds:
+            data = ds.variables[var_name][index]
+        if acc is None:
+            acc = WelfordAccumulator(data.shape)
+        acc.update(data)
+
+    return index, acc.result(statistic)
+
+
+def data_variables(ds):
+    """Names of the variables to aggregate (not coordinates or bounds)."""
+
+    bounds = set(getattr(v, 'bounds', None) for v in ds.variables.values())
+    return [name for name, var in ds.variables.items()
+            if name not in ds.dimensions and name not in bounds and len(var.dimensions) > 0]
+
+
+def tile_axis(var, tile_by):
+    if tile_by == 'time':
+        return 0
+    for i, dim in enumerate(var.dimensions):
+        if dim.lower() in LAT_NAMES:
+            return i
+    # Fall back to the second last dimension, which is latitude for
+    # (time, [level,] lat, lon) data.
+    return max(len(var.dimensions) - 2, 0)
+
+
+def choose_tile_size(var, axis, nmembers, statistic, max_tile_mb):
+    """Largest tile along axis that keeps a worker within max_tile_mb."""
+
+    shape = var.shape
+    row_elems = int(np.prod(shape)) // max(shape[axis], 1)
+    # Five float64 accumulators per cell, or every member for percentiles.
+    arrays = nmembers + 1 if statistic == 'enspctl' else 6
+    row_bytes = row_elems * 8 * arrays
+    return int(max(1, min(shape[axis], max_tile_mb * 1024 * 1024 // max(row_bytes, 1))))
+
+
+def copy_structure(ds, out, skip):
+    """Copy dimensions, attributes and coordinate variables to the output."""
+
+    out.setncatts(dict((att, ds.getncattr(att)) for att in ds.ncattrs()))
+
+    for name, dim in ds.dimensions.items():
+        out.createDimension(name, None if dim.isunlimited() else len(dim))
+
+    for name, var in ds.variables.items():
+        if name in skip:
+            continue
+        fill_value = getattr(var, '_FillValue', None)
+        out_var = out.createVariable(name, var.dtype, var.dimensions, fill_value=fill_value)
+        out_var.setncatts(dict((att, var.getncattr(att)) for att in var.ncattrs()
+                               if att != '_FillValue'))
+        out_var[:] = var[:]
+
+
+def xml_to_nc(infiles, temp_dir):
+    """Convert any xml catalogues to netCDF files in temp_dir."""
+
+    checked_infiles = []
+    for i, infile in enumerate(infiles):
+        if not os.path.isfile(infile):
+            raise IOError("Input file doesn't exist: %s" % infile)
+        if infile.endswith('.xml'):
+            tmp_in = os.path.join(temp_dir, 'xml_concat.%d.nc' % i)
+            subprocess.check_call(['python', XML_TO_NC, 'None', infile, tmp_in])
+            infile = tmp_in
+        checked_infiles.append(infile)
+    return checked_infiles
+
+
+def main(statistic, infiles, outfile, variables=None, tile_by='lat',
+         max_tile_mb=256, processes=None, verbose=False):
+    """Run the program."""
+
+    name, percentile = parse_statistic(statistic)
+
+    temp_dir = tempfile.mkdtemp()
+    pool = multiprocessing.Pool(processes)
+    try:
+        infiles = xml_to_nc(infiles, temp_dir)
+
+        with nc4.Dataset(infiles[0]) as ds:
+            var_names = variables or data_variables(ds)
+
+            with nc4.Dataset(outfile, 'w') as out:
+                copy_structure(ds, out, var_names)
+
+                for var_name in var_names:
+                    var = ds.variables[var_name]
+                    fill_value = getattr(var, '_FillValue', getattr(var, 'missing_value', 1e20))
+                    dtype = var.dtype if var.dtype.kind == 'f' else np.float64
+                    out_var = out.createVariable(var_name, dtype, var.dimensions,
+                                                 fill_value=fill_value)
+                    out_var.setncatts(dict((att, var.getncattr(att)) for att in var.ncattrs()
+                                           if att not in ('_FillValue', 'missing_value')))
+                    out_var.missing_value = out_var._FillValue
+
+                    axis = tile_axis(var, tile_by)
+                    tile_size = choose_tile_size(var, axis, len(infiles), name, max_tile_mb)
+                    tasks = [(infiles, var_name, index, name, percentile)
+                             for index in tile_slices(var.shape, axis, tile_size)]
+                    if verbose:
+                        print('%s: %d tiles of %d along %s'
+                              % (var_name, len(tasks), tile_size, var.dimensions[axis]))
+
+                    for index, values in pool.imap_unordered(reduce_tile, tasks):
+                        out_var[index] = values
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+
+    extra_info = """
+  e.g. python ensemble_agg.py ensmean indata1.nc indata2.nc indata3.nc outdata.nc
+  e.g. python ensemble_agg.py enspctl,90 indata1.nc indata2.nc indata3.nc outdata.nc
+  """
+
+    description = 'Calculate an ensemble statistic in parallel over latitude bands or time blocks'
+    parser = argparse.ArgumentParser(description=description,
+                                     epilog=extra_info,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("statistic", type=str,
+                        help="Choices: ensmin, ensmax, enssum, ensmean, ensavg, ensvar, ensvar1, "
+                             "ensstd, ensstd1, enspctl,P (where P is the percentile)")
+    parser.add_argument("files", type=str, nargs='+', metavar='infile ... outfile',
+                        help="Input file names (netCDF or xml catalogues) followed by the output file name")
+
+    parser.add_argument("--variable", type=str, nargs='*', default=None,
+                        help="Variables to aggregate [default = all non-coordinate variables]")
+    parser.add_argument("--tile_by", type=str, choices=('lat', 'time'), default='lat',
+                        help="Split the domain into latitude bands or blocks of time steps [default = lat]")
+    parser.add_argument("--max_tile_mb", type=int, default=256,
+                        help="Approximate memory budget for each tile in MB [default = 256]")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Number of worker processes [default = number of cpus]")
+    parser.add_argument("--verbose", action="store_true", default=False,
+                        help="Report the tiling")
+
+    args = parser.parse_args()
+
+    if len(args.files) < 3:
+        parser.print_usage()
+        sys.exit(1)
+
+    main(args.statistic, args.files[:-1], args.files[-1],
+         variables=args.variable,
+         tile_by=args.tile_by,
+         max_tile_mb=args.max_tile_mb,
+         processes=args.processes,
+         verbose=args.verbose)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import netCDF4 as nc4
+
+import cdml
+
+
+def write_file(path, start):
+    with nc4.Dataset(path, 'w') as ds:
+        ds.institution = u'Météo'
+        ds.createDimension('time', None)
+        var_time = ds.createVariable('time', 'f8', ('time',))
+        var_time.units = 'days since 2000-01-01'
+        var_time[:] = np.arange(start, start + 3)
+        var = ds.createVariable('pr', 'f4', ('time',))
+        var.long_name = u'précipitation'
+        var[:] = np.ones(3)
+
+
+def test_non_ascii_attributes(tmpdir):
+    paths = [str(tmpdir.join('a.nc')), str(tmpdir.join('b.nc'))]
+    write_file(paths[0], 0)
+    write_file(paths[1], 3)
+    output = str(tmpdir.join('cat.xml'))
+
+    cdml.write_cdml(cdml.scan_files(paths), output)
+
+    with io.open(output, encoding='utf-8') as f:
+        text = f.read()
+    assert u'institution ="Météo"' in text
+    assert u'long_name ="précipitation"' in text
+    assert ET.parse(output).getroot().get('institution') == u'Météo'
+    assert sorted(os.listdir(str(tmpdir))) == ['a.nc', 'b.nc', 'cat.xml']
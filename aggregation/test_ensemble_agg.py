@@ -0,0 +1,56 @@
+import warnings
+
+import numpy as np
+import netCDF4 as nc4
+import pytest
+
+import ensemble_agg
+
+
+def write_member(infile, data):
+    with nc4.Dataset(infile, 'w') as ds:
+        ds.createDimension('time', data.shape[0])
+        ds.createDimension('lat', data.shape[1])
+        ds.createDimension('lon', data.shape[2])
+        var = ds.createVariable('pr', 'f4', ('time', 'lat', 'lon'), fill_value=1e20)
+        var[:] = data
+
+
+@pytest.fixture
+def members(tmpdir):
+    """Three members, with a cell masked in all of them and one valid in only one."""
+
+    data = np.ma.masked_array(np.random.RandomState(0).rand(3, 2, 3, 4).astype(np.float32) * 10)
+    data[:, :, 0, 0] = np.ma.masked
+    data[1:, :, 1, 2] = np.ma.masked
+    data[0, 1, 2, 3] = np.ma.masked
+
+    infiles = []
+    for i, member in enumerate(data):
+        infiles.append(str(tmpdir.join('member%d.nc' % i)))
+        write_member(infiles[-1], member)
+    return infiles, data.astype(np.float64)
+
+
+@pytest.mark.parametrize('index', [(slice(None),) * 3,
+                                   (slice(None), slice(1, 3), slice(None))])
+def test_reduce_tile(members, index):
+    infiles, data = members
+    data = data[(slice(None),) + index]
+
+    _, mean = ensemble_agg.reduce_tile((infiles, 'pr', index, 'ensmean', None))
+    np.testing.assert_allclose(mean, data.mean(axis=0))
+    np.testing.assert_equal(np.ma.getmaskarray(mean), np.ma.getmaskarray(data.mean(axis=0)))
+
+    _, std = ensemble_agg.reduce_tile((infiles, 'pr', index, 'ensstd1', None))
+    expected = np.ma.masked_where(data.count(axis=0) < 2, data.std(axis=0, ddof=1))
+    np.testing.assert_allclose(std, expected)
+    np.testing.assert_equal(np.ma.getmaskarray(std), np.ma.getmaskarray(expected))
+
+    _, pctl = ensemble_agg.reduce_tile((infiles, 'pr', index, 'enspctl', 90.0))
+    with warnings.catch_warnings():
+        # Cells missing in every member give NaN.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = np.ma.masked_invalid(np.nanpercentile(data.filled(np.nan), 90, axis=0))
+    np.testing.assert_allclose(pctl, expected)
+    np.testing.assert_equal(np.ma.getmaskarray(pctl), np.ma.getmaskarray(expected))
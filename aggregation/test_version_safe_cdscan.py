@@ -0,0 +1,28 @@
+import numpy as np
+import netCDF4 as nc4
+
+import cdml
+import version_safe_cdscan
+
+
+def write_file(path, start=None, units='days since 2000-01-01', calendar='standard'):
+    with nc4.Dataset(path, 'w') as ds:
+        ds.createDimension('time', None)
+        var_time = ds.createVariable('time', 'f8', ('time',))
+        var_time.units = units
+        var_time.calendar = calendar
+        if start is not None:
+            var_time[:] = np.arange(start, start + 3)
+
+
+def test_sort_records(tmpdir):
+    paths = [str(tmpdir.join(name)) for name in ('a.nc', 'b.nc', 'c.nc', 'd.nc')]
+    write_file(paths[0], 3)
+    write_file(paths[1])
+    # Starts on 2000-01-01, in other units and calendar
+    write_file(paths[2], 0, 'hours since 2000-01-01', 'noleap')
+    write_file(paths[3], 6, calendar='noleap')
+
+    records = version_safe_cdscan.sort_records(cdml.scan_files(paths))
+
+    assert [record['path'] for record in records] == [paths[2], paths[0], paths[3], paths[1]]
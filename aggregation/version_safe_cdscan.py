@@ -2,7 +2,11 @@
 """
 Filename:    version_safe_cdscan.py   
 
-Description: Create a xml catalogue of NetCDF files using cdscan
+Description: Create a xml catalogue of NetCDF files
+             Each input is scanned once (in parallel) and the catalogue is
+             written directly; the external cdscan can still be used with
+             --cdscan, in which case the time-axis checks are cached by path,
+             size and modification time.
 Input:       List on XML files
 Output:      XML catalogue file suitable for use with CDAT/UV-CDAT (cdms python library)
 
@@ -24,15 +28,23 @@ limitations under the License.
 """
 
 import sys, re, os
+import json
+import tempfile
+import multiprocessing
 from optparse import OptionParser
 import subprocess
 import numpy as np
 
-#CDAT
-import cdms2
+import netCDF4 as nc4
+
+import cdml
 
 __version__ = '$Id$'
 
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.version_safe_cdscan_cache.json')
+# Number of problem time points kept in a summary for reporting
+MAX_REPORTED = 20
+
 def cdscan(inputs, output):
     cmds = ['cdscan', '-x', output] + inputs
     subprocess.Popen(cmds).wait()
@@ -41,124 +53,272 @@ def change_permissions(ifile):
     cmds = ['chmod', '775', ifile]
     subprocess.Popen(cmds).wait()
 
-def overlaps(m, ms):
-    for testm in ms:
-        if int(m.group(1)) < int(testm.group(2)) and \
-           int(m.group(2)) > int(testm.group(1)):
-            return True
-    return False
-
-def check_time_axis(ifile):
-    # Check the output to ensure that the time-axis is complete.
-    c = cdms2.open(ifile)
-    if 'time' in c.axes:
-       t = c.axes['time']
-       if len(t) <= 1:
-           c.close()
-           return 0
-
-
-       # Need to allow time-axis with units in "days since ..." to
-       # vary a little. 
-       dt = t[1] - t[0]
-       if t.units.startswith("days"):
-           mindt = dt - 3
-           maxdt = dt + 3
-       else:
-           mindt = dt
-           maxdt = dt
-       diff_ts = [elem[1] - elem[0] for elem in \
-                  zip(t[:-1], t[1:])]
-       #check = np.logical_and(mindt <= diff_ts,
-       #                       maxdt >= diff_ts)
-       #print mindt <= diff_ts
-       check = t[1:][np.logical_or(diff_ts < mindt,diff_ts > maxdt)]
-
-       if len(check) > 0:
-           # Not constantly increasing time-axis.
-           print('\nERROR:\tTime axis not consistently monotonically increasing.')
-           print('\tCheck that input files represent entire time period')
-           #Print Problem Files
-           import cdtime
-           print("\tBoundaries of problem time points")
-           for tp in check:
-               print('\t\t'),
-               tindex = np.where(t==tp)[0][0]
-               for invalid_t in t[tindex-1:tindex+1]:
-                   print('%s,' % cdtime.reltime(invalid_t,t.units).tocomp()),
-               print('\n')
-           c.close()
-           return 1
-
-    c.close()
+def step_limits(dt, units):
+    # Need to allow time-axis with units in "days since ..." to
+    # vary a little.
+    if units.startswith("days"):
+        return dt - 3, dt + 3
+    return dt, dt
+
+def summarise_time_axis(ifile):
+    """Read only the time variable of ifile and summarise its time-axis."""
+    with nc4.Dataset(ifile) as c:
+        if 'time' not in c.variables:
+            return summarise_values(ifile, [], None, None)
+        tvar = c.variables['time']
+        return summarise_values(ifile, tvar[:], tvar.units,
+                                getattr(tvar, 'calendar', 'standard'))
+
+def summarise_record(record):
+    """Summarise the time-axis of a file already scanned by cdml."""
+    if 'time' not in record['axes']:
+        return summarise_values(record['path'], [], None, None)
+    atts = record['variables']['time']['attributes']
+    return summarise_values(record['path'], record['axes']['time'],
+                            atts['units'], atts.get('calendar', 'standard'))
+
+def summarise_values(ifile, t, units, calendar):
+    """Summarise a time-axis.
+
+    The summary holds the units, calendar, length, first and last values
+    and nominal step of the axis, plus the boundaries of any steps that
+    fall outside the allowed range.
+    """
+    t = np.asarray(t, dtype=np.float64)
+    summary = {'path': ifile, 'length': len(t), 'bad': []}
+    if len(t) == 0:
+        return summary
+    summary['units'] = units
+    summary['calendar'] = calendar
+    summary['first'] = float(t[0])
+    summary['last'] = float(t[-1])
+    if len(t) <= 1:
+        return summary
+
+    dt = t[1] - t[0]
+    summary['dt'] = float(dt)
+    mindt, maxdt = step_limits(dt, units)
+    diff_ts = np.diff(t)
+    bad = np.flatnonzero(np.logical_or(diff_ts < mindt, diff_ts > maxdt))
+    summary['nbad'] = len(bad)
+    summary['bad'] = [[float(t[i]), float(t[i + 1])] for i in bad[:MAX_REPORTED]]
+    return summary
+
+def file_key(ifile):
+    st = os.stat(ifile)
+    return [st.st_size, st.st_mtime]
+
+def load_cache(cache_file):
+    if not cache_file or not os.path.isfile(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def save_cache(cache, cache_file):
+    # Write to a temporary file first so concurrent readers never see
+    # a partially written cache.
+    cache_dir = os.path.dirname(os.path.abspath(cache_file))
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f)
+    os.rename(tmp_file, cache_file)
+
+def summarise_inputs(inputs, cache_file=None, processes=None):
+    """Time-axis summaries of the inputs, in order.
+
+    Summaries are cached by path, size and modification time; only new
+    or changed files are read, in parallel.
+    """
+    cache = load_cache(cache_file)
+    paths = [os.path.abspath(f) for f in inputs]
+    keys = [file_key(p) for p in paths]
+
+    todo = [p for p, key in zip(paths, keys)
+            if p not in cache or cache[p]['key'] != key]
+    if todo:
+        pool = multiprocessing.Pool(processes)
+        try:
+            summaries = pool.map(summarise_time_axis, todo)
+        finally:
+            pool.close()
+            pool.join()
+        for p, summary in zip(todo, summaries):
+            cache[p] = {'key': file_key(p), 'summary': summary}
+        if cache_file:
+            save_cache(cache, cache_file)
+
+    return [dict(cache[p]['summary'], path=f) for p, f in zip(paths, inputs)]
+
+def print_problems(pairs, units, calendar):
+    print("\tBoundaries of problem time points")
+    for pair in pairs:
+        print('\t\t'),
+        for invalid_t in nc4.num2date(pair, units, calendar):
+            print('%s,' % invalid_t),
+        print('\n')
+
+def check_time_axis(summary):
+    # Check the summary to ensure that the time-axis is complete.
+    if summary['bad']:
+        # Not constantly increasing time-axis.
+        print('\nERROR:\tTime axis not consistently monotonically increasing.')
+        print('\tCheck that input files represent entire time period')
+        #Print Problem Files
+        print_problems(summary['bad'], summary['units'], summary['calendar'])
+        return 1
+    return 0
+
+def check_merged_axis(summaries):
+    """Check the time-axis the inputs make once concatenated.
+
+    Uses the per-file summaries, so the files (or the catalogue made from
+    them) need not be read again. The files must each be valid; this
+    checks the steps across the boundaries between files.
+    """
+    summaries = [s for s in summaries if s['length'] > 0]
+    if not summaries:
+        return 0
+
+    units = summaries[0]['units']
+    calendar = summaries[0]['calendar']
+
+    def to_common(value, summary):
+        if summary['units'] == units:
+            return value
+        return float(nc4.date2num(nc4.num2date(value, summary['units'], calendar),
+                                  units, calendar))
+
+    spans = sorted((to_common(s['first'], s), to_common(s['last'], s)) for s in summaries)
+    if len(spans) == 1 and 'dt' not in summaries[0]:
+        return 0
+
+    dt = [s for s in summaries if 'dt' in s]
+    if not dt:
+        dt = spans[1][0] - spans[0][1]
+    else:
+        dt = dt[0]['dt']
+    mindt, maxdt = step_limits(dt, units)
+
+    bad = [(prev[1], curr[0]) for prev, curr in zip(spans[:-1], spans[1:])
+           if not mindt <= curr[0] - prev[1] <= maxdt]
+    if bad:
+        print('\nERROR:\tTime axis not consistently monotonically increasing.')
+        print('\tCheck that input files represent entire time period')
+        print_problems(bad, units, calendar)
+        return 1
     return 0
     
 
-def main(inputs, output, ignore=False):
-    """Run the program.
+def latest_versions(inputs):
+    """Keep only the latest version of files present in several versions."""
+    vpat = re.compile(r'v(\d+)/')
+    latest = {}
+    order = []
+    for infile in inputs:
+        m = vpat.search(infile)
+        if m is None:
+            key, version = infile, 0
+        else:
+            key, version = vpat.sub('', infile), int(m.group(1))
+        if key not in latest:
+            order.append(key)
+            latest[key] = (version, infile)
+        elif version > latest[key][0]:
+            latest[key] = (version, infile)
+    return [latest[key][1] for key in order]
+
+def without_overlaps(inputs):
+    """Drop files whose date range in the file name overlaps another's.
+
+    Some CMIP3 datasets have two files representing that same variable/
+    time-period. Files are taken in order of their start date, skipping
+    any that start before the end of the files already kept. If only some
+    of the files have dates, only those are kept.
     """
-    vpat = re.compile(r'(v\d+)/')
-    inputs_with_version = filter(vpat.search, inputs)
-    if inputs_with_version:
-        inputs_version_stripped = map(lambda s: vpat.sub('', s), inputs)
-        inputs_versions = map(vpat.search, inputs)
-        latest_versions = []
-        handled = []
-        for i in range(len(inputs)):
-            if i in handled:
-                continue
-            current = inputs_version_stripped[i]
-            if inputs_version_stripped.count(current) > 1:
-                idxs = [j for j, f in enumerate(inputs_version_stripped) \
-                        if f == current]
-                versions = [inputs_versions[j] for j in idxs]
-                greatest = versions.index(max(versions))
-                greatest_idxs = idxs[greatest]
-                latest_versions.append(inputs[greatest_idxs])
-                handled += idxs
-            else:
-                latest_versions.append(inputs[i])
-                handled.append(i)
-        inputs = latest_versions
-
-    # Some CMIP3 datasets have two files representing that same variable/
-    # time-period. We want to strip out duplicates....
     #date_pat = re.compile(r'(\d{4,6})[\d-]*.*(\d{4,6})[\d-]*')
     date_pat = re.compile(r'(\d{4,10})-(\d{4,10})')
-    inputs_with_dates = map(date_pat.search, inputs)
-    if any(inputs_with_dates) and not all(inputs_with_dates):
-        # limit only to those with dates
-        newinputs = []
-        for i, has_date in enumerate(inputs_with_dates):
-            if has_date:
-                newinputs.append(inputs[i])
-        inputs = newinputs
-    elif all(inputs_with_dates):
-        used_so_far = []
-        for i, has_date in enumerate(inputs_with_dates):
-            if not overlaps(has_date, [t[0] for t in used_so_far]):
-                used_so_far.append((has_date, inputs[i]))
-            else:
-                print 'Warning: file overlaps. Skipping. ' + inputs[i]
-        inputs = [t[1] for t in used_so_far]
+    inputs_with_dates = [(date_pat.search(f), f) for f in inputs]
+    dated = [(int(m.group(1)), int(m.group(2)), f) for m, f in inputs_with_dates if m]
+    if not dated:
+        return inputs
+    if len(dated) < len(inputs):
+        return [f for m, f in inputs_with_dates if m]
 
+    kept = []
+    end_so_far = None
+    for start, end, infile in sorted(dated):
+        if end_so_far is not None and start < end_so_far:
+            print 'Warning: file overlaps. Skipping. ' + infile
+            continue
+        kept.append(infile)
+        end_so_far = end
+    return kept
 
-    for infile in inputs:
-        if check_time_axis(infile):
-            print("Error in time axis of file %s" % infile)
+def sort_records(records):
+    """Sort scanned records by the start of their time-axis.
+
+    Starts are compared as numbers in the units and calendar of the first
+    record with a time-axis, so files in other units or calendars sort
+    too. Records without a time-axis go last, by path.
+    """
+    spans = [cdml.time_span(record) for record in records]
+    known = [span for span in spans if span is not None]
+    if known:
+        units, calendar = known[0][2], known[0][3]
+
+    def start(span):
+        if span[2] == units:
+            return span[0]
+        return float(nc4.date2num(nc4.num2date(span[0], span[2], calendar),
+                                  units, calendar))
+
+    keys = [(span is None, 0.0 if span is None else start(span), record['path'])
+            for span, record in zip(spans, records)]
+    return [record for key, record in sorted(zip(keys, records), key=lambda pair: pair[0])]
+
+def main(inputs, output, ignore=False, cache_file=DEFAULT_CACHE_FILE, processes=None,
+         use_cdscan=False, json_sidecar=False):
+    """Run the program.
+
+    cache_file is only used with use_cdscan.
+    """
+    inputs = latest_versions(inputs)
+    inputs = without_overlaps(inputs)
+
+    if use_cdscan:
+        summaries = summarise_inputs(inputs, cache_file, processes)
+    else:
+        # Scan every file once; the records give both the time-axis
+        # summaries and everything needed to write the catalogue.
+        records = cdml.scan_files(inputs, processes)
+        records = sort_records(records)
+        inputs = [record['path'] for record in records]
+        summaries = [summarise_record(record) for record in records]
+
+    for summary in summaries:
+        if check_time_axis(summary):
+            print("Error in time axis of file %s" % summary['path'])
             sys.exit(1)
 
-    cdscan(inputs, output)
+    # Check that the merged time-axis will be complete before writing
+    # the catalogue, using the per-file summaries.
+    if not ignore and check_merged_axis(summaries):
+        print("\tNot creating file %s" % output)
+        sys.exit(1)
+
+    if use_cdscan:
+        cdscan(inputs, output)
+    else:
+        cdml.write_cdml(records, output)
+        if json_sidecar:
+            cdml.write_json(records, os.path.splitext(output)[0] + '.json')
 
     if ignore:
         return
 
-    # Check the output to ensure that the time-axis is complete.
-    if check_time_axis(output):
-       print("\tRemoving file %s" % output)
-       os.remove(output)
-       sys.exit(1)
-    
     # Change permissions for the cdscan.    
     change_permissions(output)
 
@@ -172,6 +332,21 @@ if __name__ == '__main__':
     parser.add_option("-i", "--ignore-check", 
                       action="store_true", dest="ignore", default=False,
                       help="Print the names of the files.")
+    parser.add_option("-C", "--cache-file",
+                      dest="cache_file", default=None,
+                      help="Cache of time-axis summaries, with --cdscan [default: %s]" % DEFAULT_CACHE_FILE)
+    parser.add_option("-n", "--no-cache",
+                      action="store_true", dest="no_cache", default=False,
+                      help="Do not read or update the time-axis cache, with --cdscan.")
+    parser.add_option("-p", "--processes",
+                      dest="processes", default=None, type="int",
+                      help="Number of files to read in parallel [default: number of cpus]")
+    parser.add_option("-s", "--cdscan",
+                      action="store_true", dest="use_cdscan", default=False,
+                      help="Write the catalogue with the external cdscan program.")
+    parser.add_option("-j", "--json",
+                      action="store_true", dest="json_sidecar", default=False,
+                      help="Also write a JSON summary of the catalogue next to the output.")
     #parser.add_option("-y", "--num-years",
     #                  dest="numyears", default=None, type="int",
     #                  help="Try and concatenate total number of years, YEARS, from the end of the catalogue. start_date and end_date ignored. ")
@@ -182,4 +357,12 @@ if __name__ == '__main__':
         parser.print_usage()
         sys.exit(1)
 
-    main(args[:-1], args[-1], options.ignore)
+    # The native scan reads each file once, so only the cdscan checks are cached.
+    if not options.use_cdscan and (options.cache_file or options.no_cache):
+        parser.error("-C/--cache-file and -n/--no-cache only apply with -s/--cdscan")
+
+    main(args[:-1], args[-1], options.ignore,
+         cache_file=None if options.no_cache else (options.cache_file or DEFAULT_CACHE_FILE),
+         processes=options.processes,
+         use_cdscan=options.use_cdscan,
+         json_sidecar=options.json_sidecar)
@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+
+Description: Calculate box and mask based climate indices for an ensemble.
+
+             An index is a weighted sum of regional means (Niño 3.4 is one
+             box, the DMI is the western minus the eastern box, ...). Every
+             index requested is calculated from a single read of each input
+             file: the regions share one hyperslab covering all of them, and
+             each regional mean is a dot product with a precomputed cosine
+             latitude weight vector. Files are processed in a pool of worker
+             processes and their regional means are cached, so only new or
+             changed files are read again.
+
+             After the files of each model are joined the monthly
+             climatology is removed (cdo ymonsub -ymonmean) and, for most
+             indices, the linear trend (cdo detrend).
+
+Copyright:   2015 CSIRO
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import multiprocessing
+from collections import defaultdict
+
+import numpy as np
+import netCDF4 as nc4
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.climate_indices_cache')
+
+# Time steps read at once by a worker.
+CHUNK_SIZE = 240
+
+
+class Region(object):
+    """A lon/lat box, or the non-zero cells of a mask on the data grid.
+
+    Mask values are used as weights (times cos(lat)), so fractional
+    masks are allowed.
+    """
+
+    def __init__(self, lons=None, lats=None, mask_file=None, mask_var=None):
+        self.lons = lons
+        self.lats = lats
+        self.mask_file = mask_file and os.path.abspath(mask_file)
+        self.mask_var = mask_var
+
+    def key(self):
+        if self.mask_file:
+            return 'mask:%s:%s:%r' % (self.mask_file, self.mask_var,
+                                      os.stat(self.mask_file).st_mtime)
+        return 'box:%r,%r,%r,%r' % (self.lons + self.lats)
+
+    def weights(self, lats, lons):
+        """Weights of every cell of the grid, zero outside the region."""
+
+        if self.mask_file:
+            with nc4.Dataset(self.mask_file) as ds:
+                names = [name for name in ds.variables if name not in ds.dimensions]
+                mask = np.ma.filled(ds.variables[self.mask_var or names[0]][:], 0)
+            mask = np.squeeze(np.asarray(mask, dtype=np.float64))
+            if mask.shape != lats.shape:
+                raise ValueError('Mask %s does not match the data grid' % self.mask_file)
+            selected = mask
+        else:
+            selected = box_mask(lats, lons, self.lons, self.lats).astype(np.float64)
+        return selected * np.cos(np.deg2rad(lats))
+
+
+class Index(object):
+    """A linear combination of regional means of one variable."""
+
+    def __init__(self, name, terms, variable=None, anomaly=True, detrend=True, description=''):
+        self.name = name
+        self.terms = terms
+        self.variable = variable
+        self.anomaly = anomaly
+        self.detrend = detrend
+        self.description = description
+
+    def regions(self):
+        return [region for coefficient, region in self.terms]
+
+
+NINO12 = Region((270.0, 280.0), (-10.0, 0.0))
+NINO3 = Region((210.0, 270.0), (-5.0, 5.0))
+NINO34 = Region((190.0, 240.0), (-5.0, 5.0))
+NINO4 = Region((160.0, 210.0), (-5.0, 5.0))
+DMI_WEST = Region((50.0, 70.0), (-10.0, 10.0))
+DMI_EAST = Region((90.0, 110.0), (-10.0, 0.0))
+# 5 degree bands so that every model grid has points in them.
+SAM_NORTH = Region((0.0, 360.0), (-42.5, -37.5))
+SAM_SOUTH = Region((0.0, 360.0), (-67.5, -62.5))
+
+INDICES = dict((index.name, index) for index in [
+    Index('nino12', [(1, NINO12)], 'tos', description='Niño 1+2, 90W-80W, 10S-0'),
+    Index('nino3', [(1, NINO3)], 'tos', description='Niño 3, 150W-90W, 5S-5N'),
+    Index('nino34', [(1, NINO34)], 'tos', description='Niño 3.4, 170W-120W, 5S-5N'),
+    Index('nino4', [(1, NINO4)], 'tos', description='Niño 4, 160E-150W, 5S-5N'),
+    Index('dmi', [(1, DMI_WEST), (-1, DMI_EAST)], 'tos',
+          description='Dipole Mode Index, 50E-70E, 10S-10N minus 90E-110E, 10S-0'),
+    Index('sam', [(1, SAM_NORTH), (-1, SAM_SOUTH)], 'psl', detrend=False,
+          description='SAM style zonal mean difference, 40S minus 65S (not normalised)'),
+])
+
+
+def coordinates(ds, var):
+    """2D latitudes and longitudes of the last two dimensions of var."""
+
+    lat_var = lon_var = None
+    for name in getattr(var, 'coordinates', '').split() + list(var.dimensions):
+        if name not in ds.variables:
+            continue
+        units = getattr(ds.variables[name], 'units', '')
+        if lat_var is None and (units.startswith('degrees_n') or name in ('lat', 'latitude')):
+            lat_var = ds.variables[name]
+        elif lon_var is None and (units.startswith('degrees_e') or name in ('lon', 'longitude')):
+            lon_var = ds.variables[name]
+    if lat_var is None or lon_var is None:
+        raise ValueError('Cannot find the latitude and longitude of %s' % var.name)
+
+    lats = np.asarray(lat_var[:], dtype=np.float64)
+    lons = np.asarray(lon_var[:], dtype=np.float64)
+    if lats.ndim == 1:
+        lons, lats = np.meshgrid(lons, lats)
+    return lats, lons
+
+
+def box_mask(lats, lons, lon_range, lat_range):
+    """Cells inside the box, with longitudes taken modulo 360."""
+
+    lons = np.mod(lons, 360.0)
+    return ((lats >= lat_range[0]) & (lats <= lat_range[1]) &
+            (lons >= lon_range[0]) & (lons <= lon_range[1]))
+
+
+def bounding_slices(mask):
+    """Smallest (y, x) slices that contain every selected cell."""
+
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        raise ValueError('No grid cells in the region')
+    return slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+
+def array_name(key):
+    return 'r_' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def cache_path(cache_dir, infile, variable):
+    """Cache file for one input file, changing whenever the file does."""
+
+    st = os.stat(infile)
+    ident = '%s:%d:%r:%s' % (os.path.abspath(infile), st.st_size, st.st_mtime, variable)
+    return os.path.join(cache_dir, hashlib.sha1(ident.encode('utf-8')).hexdigest() + '.npz')
+
+
+def load_cache(path):
+    try:
+        with np.load(path) as cached:
+            return dict((name, cached[name]) for name in cached.files)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_cache(path, arrays):
+    """Write the cache file atomically, so readers never see part of it."""
+
+    temp = '%s.%d.tmp.npz' % (path[:-len('.npz')], os.getpid())
+    np.savez(temp, **arrays)
+    os.rename(temp, path)
+
+
+def regional_means(ds, var, regions):
+    """Weighted means of var over each region, from one shared read."""
+
+    lats, lons = coordinates(ds, var)
+    weights = [region.weights(lats, lons) for region in regions]
+    y, x = bounding_slices(np.any([w > 0 for w in weights], axis=0))
+
+    vectors = []
+    for w in weights:
+        w = w[y, x].ravel()
+        cells = np.flatnonzero(w)
+        vectors.append((cells, w[cells]))
+
+    ntime = var.shape[0]
+    means = [np.empty(ntime) for region in regions]
+    extra = (0,) * (var.ndim - 3)
+    for start in range(0, ntime, CHUNK_SIZE):
+        chunk = slice(start, min(start + CHUNK_SIZE, ntime))
+        data = var[(chunk,) + extra + (y, x)]
+        data = data.reshape(data.shape[0], -1)
+        valid = (~np.ma.getmaskarray(data)).astype(np.float64)
+        values = np.ma.filled(data, 0).astype(np.float64)
+
+        for mean, (cells, vector) in zip(means, vectors):
+            # Missing (e.g. land) cells drop out of the weights.
+            total = valid[:, cells].dot(vector)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean[chunk] = values[:, cells].dot(vector) / total
+            mean[chunk][total == 0] = np.nan
+
+    return means
+
+
+def file_means(task):
+    """Regional means of one input file, from the cache where possible.
+
+    Returns the model name, the time values with their units and
+    calendar, and a dictionary of the series for each region key.
+    """
+
+    infile, variable, regions, cache_dir = task
+
+    keys = [region.key() for region in regions]
+    cache_file = cache_dir and cache_path(cache_dir, infile, variable)
+    cached = load_cache(cache_file) if cache_file else {}
+    missing = [(key, region) for key, region in zip(keys, regions)
+               if array_name(key) not in cached]
+
+    if missing or 'times' not in cached:
+        with nc4.Dataset(infile) as ds:
+            var = ds.variables[variable]
+            time_var = ds.variables['time']
+            cached['times'] = np.asarray(time_var[:], dtype=np.float64)
+            cached['units'] = np.array(time_var.units)
+            cached['calendar'] = np.array(getattr(time_var, 'calendar', 'standard'))
+            cached['model'] = np.array(getattr(ds, 'model_id', infile))
+            if missing:
+                means = regional_means(ds, var, [region for key, region in missing])
+                for (key, region), mean in zip(missing, means):
+                    cached[array_name(key)] = mean
+        if cache_file:
+            save_cache(cache_file, cached)
+
+    series = dict((key, cached[array_name(key)]) for key in keys)
+    return (str(cached['model']), cached['times'], str(cached['units']),
+            str(cached['calendar']), series)
+
+
+def merge_time(pieces):
+    """Concatenate the pieces of one model in time order.
+
+    Times are converted to the units of the first piece, and repeated
+    time steps (overlapping files) are kept only once.
+    """
+
+    pieces = sorted(pieces, key=lambda piece: nc4.num2date(piece[0][0], piece[1], piece[2]))
+    units, calendar = pieces[0][1], pieces[0][2]
+    times = []
+    for piece_times, piece_units, piece_calendar, series in pieces:
+        if piece_units != units:
+            piece_times = nc4.date2num(nc4.num2date(piece_times, piece_units, calendar), units, calendar)
+        times.append(np.asarray(piece_times, dtype=np.float64))
+    times, first = np.unique(np.concatenate(times), return_index=True)
+
+    series = {}
+    for key in pieces[0][3]:
+        series[key] = np.concatenate([piece[3][key] for piece in pieces])[first]
+    return times, units, calendar, series
+
+
+def monthly_anomaly(series, months):
+    """Subtract the mean of each calendar month (cdo ymonsub ... -ymonmean)."""
+
+    anomaly = np.empty_like(series)
+    for month in range(1, 13):
+        in_month = months == month
+        if np.any(in_month):
+            with np.errstate(invalid='ignore'):
+                anomaly[in_month] = series[in_month] - np.nanmean(series[in_month])
+    return anomaly
+
+
+def detrend(series, times):
+    """Remove the least squares linear trend in time (cdo detrend)."""
+
+    valid = np.isfinite(series)
+    if valid.sum() < 2:
+        return series
+    slope, intercept = np.polyfit(times[valid], series[valid], 1)
+    return series - (intercept + slope * times)
+
+
+def index_variable(indices, variable=None):
+    """The one variable the indices are calculated from."""
+
+    if variable:
+        return variable
+    variables = set(index.variable for index in indices if index.variable)
+    if len(variables) != 1:
+        raise ValueError('The indices need one input variable, not %s; choose one with --variable'
+                         % (', '.join(sorted(variables)) or 'none'))
+    return variables.pop()
+
+
+def calculate(infiles, indices, variable=None, start_year=1900, end_year=2100,
+              processes=None, cache_dir=None):
+    """Calculate the indices for every model in the input files.
+
+    Returns {model: {'times': dates, index name: series, ...}}.
+    """
+
+    variable = index_variable(indices, variable)
+    regions = []
+    for index in indices:
+        for region in index.regions():
+            if region not in regions:
+                regions.append(region)
+
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    tasks = [(infile, variable, regions, cache_dir) for infile in infiles]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(file_means, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Files of the same model are joined (cdo mergetime).
+    models = defaultdict(list)
+    for model, times, units, calendar, series in results:
+        models[model].append((times, units, calendar, series))
+
+    output = {}
+    for model, pieces in models.items():
+        times, units, calendar, series = merge_time(pieces)
+        dates = nc4.num2date(times, units, calendar)
+        years = np.array([d.year for d in dates])
+        keep = (years >= start_year) & (years <= end_year)
+        dates, times = dates[keep], times[keep]
+        months = np.array([d.month for d in dates])
+
+        output[model] = {'times': dates}
+        for index in indices:
+            values = sum(coefficient * series[region.key()][keep]
+                         for coefficient, region in index.terms)
+            if index.anomaly:
+                values = monthly_anomaly(values, months)
+            if index.detrend:
+                values = detrend(values, times)
+            output[model][index.name] = values
+
+    return output
+
+
+def json_values(values):
+    """The values as a list, with None (null) for masked and non-finite values.
+
+    NaN is not valid JSON, and steps whose boxes are fully masked are NaN.
+    """
+
+    values = np.ma.filled(np.ma.asarray(values, dtype=np.float64), np.nan)
+    return [value if np.isfinite(value) else None for value in values.tolist()]
+
+
+def write_json(output, outfile):
+    """Write the indices in the format produced by nino_extract.py."""
+
+    output_dict = {}
+    for model, results in output.items():
+        output_dict[model] = dict((name, json_values(values)) for name, values in results.items()
+                                  if name != 'times')
+        output_dict[model]['times'] = [str(date) for date in results['times']]
+
+    with open(outfile, 'w') as out:
+        out.write(json.dumps(output_dict, allow_nan=False))
+
+
+def main(infiles, outfile, index_names, masks=None, variable=None, start_year=1900, end_year=2100,
+         processes=None, cache_dir=DEFAULT_CACHE_DIR):
+    """Run the program."""
+
+    indices = [INDICES[name] for name in index_names]
+    for name, mask in masks or []:
+        mask_file, _, mask_var = mask.partition(':')
+        indices.append(Index(name, [(1, Region(mask_file=mask_file, mask_var=mask_var or None))]))
+
+    try:
+        output = calculate(infiles, indices, variable, start_year, end_year, processes, cache_dir)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    write_json(output, outfile)
+
+
+if __name__ == "__main__":
+
+    extra_info = 'indices:\n' + '\n'.join('  %-8s %s (%s)' % (name, INDICES[name].description,
+                                                              INDICES[name].variable)
+                                          for name in sorted(INDICES))
+
+    parser = argparse.ArgumentParser(description='Calculate climate indices for many models at once '
+                                                 'and write them to a single JSON file.',
+                                     epilog=extra_info,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', metavar='infile ... outfile',
+                        help='monthly netCDF files, any number per model, followed by the output JSON file')
+    parser.add_argument('--indices', nargs='*', choices=sorted(INDICES), default=[],
+                        help='indices to calculate')
+    parser.add_argument('--mask', nargs=2, action='append', metavar=('NAME', 'FILE[:VAR]'),
+                        help='add an index that is the mean over a mask on the data grid')
+    parser.add_argument('--variable', default=None,
+                        help='input variable name [default = the variable of the indices]')
+    parser.add_argument('--start_year', type=int, default=1900, help='first year [default = 1900]')
+    parser.add_argument('--end_year', type=int, default=2100, help='last year [default = 2100]')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes [default = number of cpus]')
+    parser.add_argument('--cache_dir', default=DEFAULT_CACHE_DIR,
+                        help='directory of the per file cache [default = %s]' % DEFAULT_CACHE_DIR)
+    parser.add_argument('--no_cache', action='store_true', default=False,
+                        help='read every file, without using the cache')
+    args = parser.parse_args()
+
+    if len(args.files) < 2 or not (args.indices or args.mask):
+        parser.print_usage()
+        sys.exit(1)
+
+    main(args.files[:-1], args.files[-1], args.indices, args.mask, args.variable,
+         args.start_year, args.end_year, args.processes,
+         None if args.no_cache else args.cache_dir)
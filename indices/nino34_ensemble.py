@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+
+Description: Calculate the Niño 3.4 index for a whole ensemble at once.
+
+             Does the same as nino34_onestep.sh (mergetime, selyear,
+             sellonlatbox+fldmean, ymonsub and detrend) but in memory,
+             without CDO, using climate_indices.py. Only the 190-240E,
+             5S-5N box is read from each input file, the files are
+             processed in a pool of worker processes, and the result for
+             every model is written to one JSON file in the format
+             produced by nino_extract.py.
+
+Copyright:   2015 CSIRO
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import sys
+import argparse
+
+import climate_indices
+
+
+def main(infiles, outfile, variable='tos', start_year=1900, end_year=2100, processes=None,
+         cache_dir=climate_indices.DEFAULT_CACHE_DIR):
+    """Run the program."""
+
+    output = climate_indices.calculate(infiles, [climate_indices.INDICES['nino34']], variable,
+                                       start_year, end_year, processes, cache_dir)
+    climate_indices.write_json(output, outfile)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Calculate the Niño 3.4 index of many models '
+                                                 'at once and write them to a single JSON file.')
+    parser.add_argument('files', nargs='+', metavar='infile ... outfile',
+                        help='monthly sea surface temperature netCDF files, any number per model, '
+                             'followed by the output JSON file')
+    parser.add_argument('--variable', default='tos', help='SST variable name [default = tos]')
+    parser.add_argument('--start_year', type=int, default=1900, help='first year [default = 1900]')
+    parser.add_argument('--end_year', type=int, default=2100, help='last year [default = 2100]')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes [default = number of cpus]')
+    parser.add_argument('--no_cache', action='store_true', default=False,
+                        help='read every file, without using the cache of climate_indices.py')
+    args = parser.parse_args()
+
+    if len(args.files) < 2:
+        parser.print_usage()
+        sys.exit(1)
+
+    main(args.files[:-1], args.files[-1], args.variable,
+         args.start_year, args.end_year, args.processes,
+         None if args.no_cache else climate_indices.DEFAULT_CACHE_DIR)
@@ -7,28 +7,48 @@ data and then writes it out to a single JSON file.
 It is quite specialised for use with the Nino34 web
 interface.
 
+The files are read in parallel and the decoded series of each
+one is kept in a cache keyed by the file's path, size and
+modification time, so a rerun only reads the files that changed.
+
 """
 
-import argparse
+import os
 import json
+import argparse
+import multiprocessing
 
 import netCDF4 as nc4
 
 
-def main(input_list, outfile_name):
-    """ Extract the nino/tos data from the files in the inputlist
+def file_key(infile):
+    st = os.stat(infile)
+    return [st.st_size, st.st_mtime]
 
-    Save the results in JSON file 'outfile_name'.
 
-    """
+def load_cache(cache_file):
+    if not cache_file or not os.path.isfile(cache_file):
+        return {}
+    try:
+        with open(cache_file) as fh:
+            return json.load(fh)
+    except ValueError:
+        return {}
 
-    # Extract the data into a dictionary.
-    output_dict = {}
-    for infile in input_list:
 
-        this_dict = {}
+def save_cache(cache_file, cache):
+    """Write the cache atomically, so an interrupted run can't corrupt it."""
 
-        inds = nc4.Dataset(infile)
+    temp = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(temp, 'w') as fh:
+        json.dump(cache, fh, separators=(',', ':'))
+    os.rename(temp, cache_file)
+
+
+def extract(infile):
+    """ Extract the model name, times and nino/tos series of one file. """
+
+    with nc4.Dataset(infile) as inds:
         model_name = inds.model_id
 
         in_var = inds.variables["tos"]
@@ -37,14 +57,72 @@ def main(input_list, outfile_name):
         dates = nc4.num2date(time_var[:], time_var.units, time_var.calendar)
         data_series = in_var[:,0,0]
 
-        this_dict["times"] = [str(timestep) for timestep in dates]
-        this_dict["nino34"] = data_series.tolist()
+        return {"model": model_name,
+                "times": [str(timestep) for timestep in dates],
+                "nino34": data_series.tolist()}
+
+
+def shared_times(output_dict):
+    """ Store each distinct time axis once.
+
+    Models that share a calendar and period refer to the same entry
+    of "time_axes" by its index.
+
+    """
+
+    axes = []
+    models = {}
+    for model_name, this_dict in output_dict.items():
+        times = this_dict["times"]
+        if times not in axes:
+            axes.append(times)
+        models[model_name] = {"time_axis": axes.index(times),
+                              "nino34": this_dict["nino34"]}
+
+    return {"time_axes": axes, "models": models}
+
+
+def main(input_list, outfile_name, cache_file=None, processes=None, share_times=False):
+    """ Extract the nino/tos data from the files in the inputlist
+
+    Save the results in JSON file 'outfile_name'.
+
+    """
+
+    cache = load_cache(cache_file)
+
+    keys = dict((os.path.abspath(infile), file_key(infile)) for infile in input_list)
+    changed = [path for path, key in keys.items()
+               if path not in cache or cache[path]["key"] != key]
+
+    if changed:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for path, series in zip(changed, pool.map(extract, changed)):
+                series["key"] = keys[path]
+                cache[path] = series
+        finally:
+            pool.close()
+            pool.join()
 
-        output_dict[model_name] = this_dict
+    # Extract the data into a dictionary, later files replacing earlier
+    # ones of the same model.
+    output_dict = {}
+    for infile in input_list:
+        series = cache[os.path.abspath(infile)]
+        output_dict[series["model"]] = {"times": series["times"],
+                                        "nino34": series["nino34"]}
+
+    if share_times:
+        output_dict = shared_times(output_dict)
 
     # Dump the dictionary to a JSON file.
     with open(outfile_name, 'w') as outfile:
-        outfile.write(json.dumps(output_dict))
+        outfile.write(json.dumps(output_dict, separators=(',', ':')))
+
+    if cache_file and (changed or len(cache) != len(keys)):
+        # Forget files that are no longer inputs.
+        save_cache(cache_file, dict((path, cache[path]) for path in keys))
 
 
 if __name__ == "__main__":
@@ -54,7 +132,17 @@ if __name__ == "__main__":
     parser.add_argument("inputfiles", help="The netCDF nino index timeseries",
                         nargs="+")
     parser.add_argument("outfile", help="The JSON file to write the results to")
+    parser.add_argument("--cache_file", default=None,
+                        help="Cache of the decoded series [default = outfile.cache]")
+    parser.add_argument("--no_cache", action="store_true", default=False,
+                        help="Read every input file again")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Number of worker processes [default = number of cpus]")
+    parser.add_argument("--shared_times", action="store_true", default=False,
+                        help="Store each distinct time axis once, under 'time_axes', with the "
+                             "series under 'models' (not the format the web interface reads)")
 
     args = parser.parse_args()
 
-    main(args.inputfiles, args.outfile)
+    cache_file = None if args.no_cache else args.cache_file or args.outfile + '.cache'
+    main(args.inputfiles, args.outfile, cache_file, args.processes, args.shared_times)
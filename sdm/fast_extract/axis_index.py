@@ -0,0 +1,115 @@
+""" Contains the AxisIndex and TimeAxisIndex classes."""
+
+import re
+
+import numpy as np
+import netCDF4 as nc4
+
+
+# Calendars that numpy datetime64 arithmetic gets right.
+REAL_CALENDARS = ("standard", "gregorian", "proleptic_gregorian")
+
+UNIT_SECONDS = {"seconds": 1, "minutes": 60, "hours": 3600, "days": 86400}
+
+
+class AxisIndex(object):
+    """ Maps coordinate values to indices of a 1-D axis.
+
+    A regular axis is indexed by arithmetic from its start and step, any
+    other monotonic axis by a binary search (searchsorted). Whole arrays
+    of values are mapped in one call, and the object can be kept and
+    reused for any number of queries.
+
+    """
+
+    def __init__(self, values, rtol=1e-6):
+
+        values = np.asarray(values, dtype=np.float64)
+        self.descending = values.size > 1 and values[-1] < values[0]
+        if self.descending:
+            values = values[::-1]
+        self.values = values
+
+        steps = np.diff(values)
+        self.regular = steps.size > 0 and np.allclose(steps, steps[0], rtol=rtol, atol=0)
+        self.start = values[0]
+        self.step = steps.mean() if self.regular else None
+
+    def __repr__(self):
+        return "<AxisIndex; size = {}, regular = {}>".format(self.values.size, self.regular)
+
+    @classmethod
+    def from_variable(cls, nc_var):
+        return cls(nc_var[:])
+
+    def index(self, targets, mode="nearest"):
+        """ Indices of the targets on the axis.
+
+        mode "nearest" rounds to the closest axis value, "floor" gives the
+        last axis value at or before each target. Indices are not clipped,
+        so callers can check them against the axis size.
+
+        """
+
+        targets = np.asarray(targets, dtype=np.float64)
+
+        if self.regular:
+            position = (targets - self.start) / self.step
+            if mode == "nearest":
+                indices = np.round(position)
+            else:
+                # Allow for rounding error in times on the axis itself.
+                indices = np.floor(position + 1e-6)
+            indices = indices.astype(int)
+        else:
+            indices = np.searchsorted(self.values, targets, side="right") - 1
+            if mode == "nearest":
+                upper = np.minimum(indices + 1, self.values.size - 1)
+                lower = np.maximum(indices, 0)
+                closer_up = np.abs(self.values[upper] - targets) < np.abs(targets - self.values[lower])
+                indices = np.where(closer_up | (indices < 0), upper, lower)
+
+        if self.descending:
+            indices = self.values.size - 1 - indices
+        return indices
+
+
+class TimeAxisIndex(AxisIndex):
+    """ An AxisIndex of a netCDF time axis that also maps dates. """
+
+    def __init__(self, values, units, calendar="standard"):
+
+        super(TimeAxisIndex, self).__init__(values)
+        self.units = units
+        self.calendar = calendar
+
+        match = re.match(r"^\s*(\w+) since (\d+)-(\d+)-(\d+)", units)
+        self.origin = None
+        if match and match.group(1) in UNIT_SECONDS and calendar in REAL_CALENDARS:
+            year, month, day = [int(part) for part in match.groups()[1:]]
+            time_part = units[match.end():].strip()
+            self.origin = np.datetime64("%04d-%02d-%02d" % (year, month, day), "s")
+            if time_part:
+                hms = [int(float(part)) for part in re.findall(r"[\d.]+", time_part)[:3]]
+                hms += [0] * (3 - len(hms))
+                self.origin += np.timedelta64(hms[0] * 3600 + hms[1] * 60 + hms[2], "s")
+            self.unit_seconds = UNIT_SECONDS[match.group(1)]
+
+    @classmethod
+    def from_variable(cls, nc_time):
+        return cls(nc_time[:], nc_time.units, getattr(nc_time, "calendar", "standard"))
+
+    def date_numbers(self, dates):
+        """ Values on this axis of an array of numpy datetime64 dates. """
+
+        dates = np.asarray(dates, dtype="datetime64[s]")
+        if self.origin is not None:
+            return (dates - self.origin).astype(np.float64) / self.unit_seconds
+
+        # Other calendars go through netCDF4, a date at a time.
+        return nc4.date2num(dates.astype(object), self.units, self.calendar)
+
+    def index_dates(self, dates, mode="floor"):
+        """ Indices of an array of datetime64 dates, by default the time step each falls in. """
+
+        return self.index(self.date_numbers(dates), mode=mode)
@@ -34,6 +34,22 @@ class CodFile(object):
         return [self.convert_date(datestring)
                 for datestring in self._raw_data[1]]
 
+    @property
+    def base_datetime64(self):
+        """ The base dates as an array of numpy datetime64 days. """
+        if self._raw_data is None:
+            self.read_data()
+
+        return self.convert_dates(self._raw_data[0])
+
+    @property
+    def projected_datetime64(self):
+        """ The projected dates as an array of numpy datetime64 days. """
+        if self._raw_data is None:
+            self.read_data()
+
+        return self.convert_dates(self._raw_data[1])
+
     def read_data(self):
         """ Read in the raw data from the COD file."""
 
@@ -54,3 +70,15 @@ class CodFile(object):
         year_part = int(datestring[:-4]) + 1900
 
         return(dt.datetime(year_part, month_part, date_part))
+
+    @staticmethod
+    def convert_dates(datestrings):
+        """ Convert an array of string dates to numpy datetime64 days at once. """
+
+        codes = np.asarray(datestrings).astype(int)
+        years = codes // 10000 + 1900
+        months = codes // 100 % 100
+        days = codes % 100
+
+        month_starts = ((years - 1970) * 12 + months - 1).astype("datetime64[M]")
+        return month_starts.astype("datetime64[D]") + (days - 1)
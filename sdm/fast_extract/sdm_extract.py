@@ -3,9 +3,19 @@
 
 It dumps straight to JSON format, and doesn't write out a netCDF file.
 
+Several CoD files (e.g. every model, scenario and season) can be given at
+once: the AWAP series of the point is then read once and each CoD file's
+dates are applied to it, and the point series can be cached on disk.
+
+Time series can be decimated to about a given number of points, and/or
+have min/max/mean pyramid levels written alongside (see sdm/sdm/lod.py).
+
 """
 
+import os
+import glob
 import json
+import hashlib
 import argparse
 import string
 
@@ -13,7 +23,10 @@ import numpy as np
 import netCDF4 as nc4
 
 from cod_file import CodFile
+from axis_index import AxisIndex, TimeAxisIndex
+
 
+AWAP_PATTERN = "/local/ep1_1/data/staging_data/AWAP/daily_0.05/${var_name}/${var_name}_daily_0.05*.nc"
 
 
 def main(args):
@@ -35,28 +48,36 @@ def main(args):
 
     # Extract the required values from the cod file.
     var_dict = dict(var_name=this_var[0])
-    awap_pattern = string.Template("/local/ep1_1/data/staging_data/AWAP/daily_0.05/${var_name}/${var_name}_daily_0.05*.nc").substitute(var_dict)
-    input_awap = nc4.MFDataset(awap_pattern, aggdim="time")
-    in_var = input_awap.variables[this_var[1]]
-
-    lat_var = input_awap.variables["lat"]
-    lon_var = input_awap.variables["lon"]
-
-    # Grab the time series of interest.
-    y_val = get_index(args.latitude, lat_var)
-    x_val = get_index(args.longitude, lon_var)
-    base_ts = in_var[:, y_val, x_val]
+    awap_pattern = string.Template(AWAP_PATTERN).substitute(var_dict)
+
+    # The observed series of the point is read once for all the CoD files.
+    times, base_ts = load_point_series(awap_pattern, this_var[1], float(args.latitude),
+                                       float(args.longitude), args.cache_dir)
+    time_index = TimeAxisIndex(times["values"], times["units"], times["calendar"])
+
+    outputs = {}
+    for cod_file in args.cod_file:
+        if len(args.cod_file) == 1:
+            key, outfile = None, args.outfile
+        else:
+            key = cod_key(cod_file)
+            root, ext = os.path.splitext(args.outfile)
+            outfile = "%s_%s%s" % (root, key.replace("/", "_"), ext)
+        outputs[key] = extract_cod(CodFile(cod_file), base_ts, time_index, this_var,
+                                   args, outfile)
+
+    # A single CoD file gives its output directly, many are keyed by
+    # model_scenario/region-type/season.
+    output = outputs[None] if len(args.cod_file) == 1 else outputs
 
-    # Ensure the base timeseries is a masked array.
-    base_ts = np.ma.masked_array(base_ts)
+    with open(args.outfile, 'w') as output_file:
+        output_file.write(json.dumps(output))
 
-    # Load in the CoD file.
-    cod = CodFile(args.cod_file)
 
-    times = input_awap.variables["time"]
-    indices = calculate_time_index(cod.projected_dates, times)
+def extract_cod(cod, base_ts, time_index, this_var, args, outfile):
+    """ Apply the dates of one CoD file to the observed point series. """
 
-    input_awap.close()
+    indices = time_index.index_dates(cod.projected_datetime64)
 
     # Now pull out the required values.
     outts = base_ts[indices]
@@ -66,14 +87,110 @@ def main(args):
 
     if args.output_type == "timeseries":
         output = write_timeseries(out_dates, this_var[2], out_values, num_missing)
+        if args.lod or args.pyramid:
+            write_lod(output, outfile, this_var[2], out_values, args.lod, args.pyramid)
     elif args.output_type == "histogram":
         output = write_histogram(out_dates, this_var[2], out_values, int(args.bins), num_missing)
     else:
         raise Exception("output_type: {} not understood"
                         .format(args.output_type))
 
-    with open(args.outfile, 'w') as output_file:
-        output_file.write(json.dumps(output))
+    return output
+
+
+def cod_key(cod_file):
+    """ model_scenario/region-type/season of a CoD file path.
+
+    CoD files are kept as .../model_scenario/region-type/predictand/season_N/rawfield_analog_N
+
+    """
+
+    season_dir = os.path.dirname(os.path.abspath(cod_file))
+    region_dir = os.path.dirname(os.path.dirname(season_dir))
+    model_dir = os.path.dirname(region_dir)
+    return "/".join([os.path.basename(model_dir), os.path.basename(region_dir),
+                     os.path.basename(season_dir)])
+
+
+def archive_version(file_names):
+    """ A digest of the names, sizes and modification times of the AWAP files. """
+
+    digest = hashlib.sha1()
+    for file_name in file_names:
+        stat = os.stat(file_name)
+        digest.update("%s:%d:%r\n" % (file_name, stat.st_size, stat.st_mtime))
+    return digest.hexdigest()
+
+
+def load_point_series(awap_pattern, var_name, latitude, longitude, cache_dir=None):
+    """ The time axis and observed series of the grid point nearest (latitude, longitude).
+
+    With a cache_dir, the axes of the archive and the series of each point
+    are saved there, keyed by variable, point and a digest of the archive
+    files. A later request for the same point then reads no AWAP files.
+
+    """
+
+    file_names = sorted(glob.glob(awap_pattern))
+    if not file_names:
+        raise Exception("No AWAP files match {}".format(awap_pattern))
+
+    axes_cache = point_cache = None
+    if cache_dir:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        prefix = os.path.join(cache_dir, "%s_%s" % (var_name, archive_version(file_names)))
+        axes_cache = prefix + "_axes.npz"
+
+    input_awap = None
+    if axes_cache and os.path.isfile(axes_cache):
+        axes = dict(np.load(axes_cache))
+    else:
+        input_awap = nc4.MFDataset(file_names, aggdim="time")
+        time_var = input_awap.variables["time"]
+        axes = {"lat": np.ma.filled(input_awap.variables["lat"][:]),
+                "lon": np.ma.filled(input_awap.variables["lon"][:]),
+                "time": np.ma.filled(time_var[:]),
+                "units": np.array(time_var.units),
+                "calendar": np.array(getattr(time_var, "calendar", "standard"))}
+        if axes_cache:
+            save_npz(axes_cache, axes)
+
+    # Grab the time series of interest.
+    y_val = AxisIndex(axes["lat"]).index(latitude)
+    x_val = AxisIndex(axes["lon"]).index(longitude)
+    if axes_cache:
+        point_cache = "%s_%d_%d.npz" % (prefix, y_val, x_val)
+
+    if point_cache and os.path.isfile(point_cache):
+        cached = np.load(point_cache)
+        base_ts = np.ma.masked_array(cached["data"], mask=cached["mask"])
+    else:
+        if input_awap is None:
+            input_awap = nc4.MFDataset(file_names, aggdim="time")
+        base_ts = input_awap.variables[var_name][:, y_val, x_val]
+
+        # Ensure the base timeseries is a masked array.
+        base_ts = np.ma.masked_array(base_ts)
+        if point_cache:
+            save_npz(point_cache, {"data": np.ma.getdata(base_ts), "mask": np.ma.getmaskarray(base_ts)})
+
+    if input_awap is not None:
+        input_awap.close()
+
+    times = {"values": axes["time"],
+             "units": str(axes["units"]),
+             "calendar": str(axes["calendar"])}
+    return times, base_ts
+
+
+def save_npz(file_name, arrays):
+    """ Save arrays atomically, so concurrent requests never read a partial file. """
+
+    temp_name = "%s.%d.tmp.npz" % (file_name[:-len(".npz")], os.getpid())
+    np.savez(temp_name, **arrays)
+    os.rename(temp_name, file_name)
+
 
 def filter_timeseries(date_list, timeseries, var_name):
     """ Filter out invalid values in the timeseries."""
@@ -111,6 +228,20 @@ def write_timeseries(date_list, variable_name,
 
     return output
 
+def write_lod(output, outfile, variable_name, timeseries, lod_points, pyramid):
+    """ Decimate the timeseries output and/or write its pyramid levels. """
+
+    from sdm import lod
+
+    if pyramid:
+        output["lod_levels"] = lod.save_pyramid(outfile, output["times"],
+                                                timeseries, variable_name)
+    if lod_points:
+        times, values = lod.decimate(output["times"], timeseries, lod_points)
+        output["times"] = times
+        output[variable_name] = values.tolist()
+
+
 def write_histogram(date_list, variable_name,
                     timeseries, bins, missing_vals):
     """ Create an output dictionary in timeseries form. """
@@ -138,33 +269,18 @@ def write_histogram(date_list, variable_name,
 def get_index(value, nc_var):
     """ Given a netCDF variable, get the index of a particular lat/lon point.
 
-    Rounds to the nearest value.
+    Rounds to the nearest value. value may also be an array of values.
 
     """
 
-    n_steps = nc_var.shape[0] - 1
-    var_range = nc_var[-1] - nc_var[0]
-    step_size = var_range / n_steps
-
-    change = float(value) - nc_var[0]
-    index = int(round(change / step_size))
-
-    return index
+    return AxisIndex.from_variable(nc_var).index(np.asarray(value, dtype=float))
 
 
 def calculate_time_index(datething, nc_time):
-    """ Given a python datetime object, return the index of the matching time variable."""
-
-    num_steps = nc_time.shape[0] - 1
-    time_range = nc_time[-1] - nc_time[0]
-    each_step = time_range / num_steps
-    step = int(round(each_step))
-
-    axis_numbers = nc4.date2num(datething, nc_time.units, nc_time.calendar)
-
-    return_vals = (axis_numbers - nc_time[0]) / step
+    """ Given python datetime objects, return the indices of the matching time variable."""
 
-    return(return_vals.astype(int))
+    dates = np.array(datething, dtype="datetime64[s]")
+    return TimeAxisIndex.from_variable(nc_time).index_dates(dates)
 
 
 if __name__ == "__main__":
@@ -176,8 +292,16 @@ if __name__ == "__main__":
     parser.add_argument("variable", help="The variable name to extract")
     parser.add_argument("output_type", help="The type of output (histogram or timeseries)")
     parser.add_argument("bins", help="The number of bins for the output histogram")
-    parser.add_argument("cod_file", help="The path to the change-of-date file")
+    parser.add_argument("cod_file", help="The path to the change-of-date file, or several paths to "
+                        "get the results of each, keyed by model_scenario/region-type/season",
+                        nargs="+")
     parser.add_argument("outfile", help="The path to write the output to")
+    parser.add_argument("--cache-dir", help="Directory to cache the AWAP series of each point in",
+                        default=None)
+    parser.add_argument("--lod", help="Decimate the time series to about this many points",
+                        type=int, default=None)
+    parser.add_argument("--pyramid", help="Also write min/max/mean pyramid levels of the time series",
+                        action="store_true", default=False)
 
     args = parser.parse_args()
 
@@ -0,0 +1,279 @@
+"""
+Reverse index from AWAP days to the CoD files and rows that use them
+
+Each row of a CoD file gives the observed AWAP day (adate) used for a day of
+the reconstructed series (rdate). The index keeps the adates of all CoD files
+sorted together with their file and row, so the rows that use any AWAP day or
+month are found by a binary search. When AWAP months are recalibrated or
+appended, only those time steps of the existing outputs need to be extracted
+again.
+"""
+import os
+import re
+import numpy as np
+
+from . import ncio
+from .cod import CoD
+from .pyramid import BASE_RESOLUTION
+
+COD_FILE_PATTERN = re.compile(r'^rawfield_analog_\d+$')
+
+TITLE_PATTERN = re.compile(r'\((.*)\)\s*$')
+
+
+def find_cod_files(base_dir):
+    """ All CoD files under base_dir, in a stable order
+    """
+    ret = []
+    for dirpath, dirnames, filenames in os.walk(base_dir):
+        dirnames.sort()
+        ret.extend(os.path.join(dirpath, filename)
+                   for filename in sorted(filenames) if COD_FILE_PATTERN.match(filename))
+    return ret
+
+
+def file_stamp(file_path):
+    stat = os.stat(file_path)
+    return stat.st_mtime, stat.st_size
+
+
+def days_to_codes(days):
+    """ CoD date codes of dates given as yyyymmdd integers
+    """
+    return np.asarray(days, dtype=int) - 19000000
+
+
+def months_to_codes(months):
+    """ CoD month codes (the CoD date code divided by 100) of months given as yyyymm integers
+    """
+    return np.asarray(months, dtype=int) - 190000
+
+
+class AnalogIndex(object):
+    def __init__(self, base_dir, files, stamps, adates, file_ids, rows):
+        self.base_dir = base_dir
+        self.files = list(files)
+        self.stamps = np.asarray(stamps, dtype=float).reshape(len(self.files), 2)
+        # Entries sorted by adate
+        self.adates = np.asarray(adates, dtype=int)
+        self.file_ids = np.asarray(file_ids, dtype=int)
+        self.rows = np.asarray(rows, dtype=int)
+
+    def __repr__(self):
+        return '<AnalogIndex; files = %d, entries = %d>' % (len(self.files), self.adates.size)
+
+    @classmethod
+    def build(cls, base_dir, previous=None, verbose=False):
+        """ Index every CoD file under base_dir
+
+        CoD files that are unchanged since the previous index was built are
+        not read again.
+        """
+        files = find_cod_files(base_dir)
+        stamps = []
+        all_adates = []
+        for file_path in files:
+            stamp = file_stamp(file_path)
+            adates = previous.file_adates(file_path, stamp) if previous else None
+            if adates is None:
+                if verbose:
+                    print 'indexing CoD file: %s' % file_path
+                adates = CoD.read(file_path)['adates']
+            stamps.append(stamp)
+            all_adates.append(adates)
+
+        sizes = [adates.size for adates in all_adates]
+        adates = np.concatenate(all_adates) if all_adates else np.zeros(0, dtype=int)
+        file_ids = np.repeat(np.arange(len(files)), sizes)
+        rows = np.concatenate([np.arange(size) for size in sizes]) if sizes else np.zeros(0, dtype=int)
+
+        # A stable sort keeps the rows of each file in order for every adate.
+        order = np.argsort(adates, kind='mergesort')
+        return cls(base_dir, files, stamps, adates[order], file_ids[order], rows[order])
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            return cls(str(f['base_dir']), [str(s) for s in f['files']], f['stamps'],
+                       f['adates'], f['file_ids'], f['rows'])
+
+    def save(self, filename):
+        # Write next to the target and rename, so a reader never sees half a file.
+        temp_file = '%s.%d.tmp.npz' % (filename, os.getpid())
+        np.savez(temp_file,
+                 base_dir=np.array(self.base_dir),
+                 files=np.array(self.files),
+                 stamps=self.stamps,
+                 adates=self.adates,
+                 file_ids=self.file_ids,
+                 rows=self.rows)
+        os.rename(temp_file, filename)
+
+    def is_current(self):
+        """ Whether the CoD files are the same as when the index was built
+        """
+        files = find_cod_files(self.base_dir)
+        if files != self.files:
+            return False
+        return all(tuple(self.stamps[i]) == file_stamp(file_path) for i, file_path in enumerate(files))
+
+    def file_adates(self, file_path, stamp=None):
+        """ The adates of a CoD file in row order, or None if it is not indexed (with the given stamp)
+        """
+        try:
+            file_id = self.files.index(file_path)
+        except ValueError:
+            return None
+        if stamp is not None and tuple(self.stamps[file_id]) != tuple(stamp):
+            return None
+        selected = self.file_ids == file_id
+        ret = np.empty(np.count_nonzero(selected), dtype=int)
+        ret[self.rows[selected]] = self.adates[selected]
+        return ret
+
+    def lookup_codes(self, first, last):
+        """ Positions of the entries with first <= adate <= last, for arrays of first and last codes
+        """
+        starts = np.searchsorted(self.adates, first, side='left')
+        stops = np.searchsorted(self.adates, last, side='right')
+        if starts.size == 0:
+            return np.zeros(0, dtype=int)
+        return np.unique(np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)]))
+
+    def lookup(self, days=None, months=None):
+        """ The rows that use any of the given days (yyyymmdd) or months (yyyymm), by CoD file
+
+        Returns a dictionary of CoD file path to a sorted array of row numbers.
+        """
+        first = []
+        last = []
+        if days is not None:
+            codes = days_to_codes(days)
+            first.append(codes)
+            last.append(codes)
+        if months is not None:
+            codes = months_to_codes(months) * 100
+            first.append(codes + 1)
+            last.append(codes + 31)
+        if not first:
+            return {}
+
+        entries = self.lookup_codes(np.concatenate(first), np.concatenate(last))
+        file_ids = self.file_ids[entries]
+        ret = {}
+        for file_id in np.unique(file_ids):
+            ret[self.files[file_id]] = np.sort(self.rows[entries[file_ids == file_id]])
+        return ret
+
+
+def load_or_build(index_file, cod_base_dir, verbose=False):
+    """ Load the index, refreshing it from the CoD files if they have changed
+    """
+    index = None
+    if os.path.isfile(index_file):
+        index = AnalogIndex.load(index_file)
+        if index.base_dir == cod_base_dir and index.is_current():
+            return index
+        if index.base_dir != cod_base_dir:
+            index = None
+
+    index = AnalogIndex.build(cod_base_dir, previous=index, verbose=verbose)
+    index.save(index_file)
+    return index
+
+
+def output_components(ncd_file):
+    """ The model, scenario, region type, season, predictand and region of an output file
+    """
+    if hasattr(ncd_file, 'predictand'):
+        components = [getattr(ncd_file, name) for name in
+                      ('model', 'scenario', 'region_type', 'season', 'predictand', 'region')]
+    else:
+        # Files saved before these attributes were added have them in the title only.
+        match = TITLE_PATTERN.search(getattr(ncd_file, 'title', ''))
+        if match is None:
+            raise ValueError('Not an output file of dxt-gridded')
+        components = [field.strip() for field in match.group(1).split(',')]
+        components.append(components[2])
+    if components[1] in ('None', ''):
+        components[1] = None
+    return components
+
+
+def output_resolution(output_file):
+    """ The resolution of the grid of an output file, 0.05 degree for files saved before it was recorded
+    """
+    with ncio.open_file(output_file) as ncd_file:
+        return getattr(ncd_file, 'resolution', BASE_RESOLUTION)
+
+
+def codes_to_days(cod_dates):
+    """ Days since 1899-12-31 of CoD date codes, as on the output time axis
+    """
+    return (np.array([np.datetime64(d) for d in CoD.format_dates(cod_dates)])
+            - np.datetime64('1899-12-31')).astype('int')
+
+
+def update_output(output_file, index, extractor, days=None, months=None, verbose=False):
+    """ Extract again the time steps of an output file that use the given days or months
+
+    The rows of its CoD file are matched to the time steps of the output on
+    their rdates, so outputs of a time window are updated too. Only the
+    records of those time steps are written over, in place, so the rest of
+    the file is neither read nor rewritten. Returns the number of time steps
+    updated.
+    """
+    with ncio.open_file(output_file) as ncd_file:
+        if 'lat' not in ncd_file.dimensions:
+            raise ValueError('%s holds regional series, which cannot be updated by time step' % output_file)
+        if hasattr(ncd_file, 'aggregation'):
+            raise ValueError('%s holds %s statistics, which cannot be updated by time step'
+                             % (output_file, ncd_file.aggregation))
+        model, scenario, region_type, season, predictand, region = output_components(ncd_file)
+        out_times = ncio.take(ncd_file.variables['time'])
+        var = ncd_file.variables[predictand]
+        shape = var.shape[1:]
+        missing_value = var.missing_value
+        # Records written by write_records: the time value, then the time step of the data.
+        record_vars = [name for name in ncd_file.variables if ncd_file.variables[name].isrec]
+        record_size = ncd_file._recsize
+        nrecs = ncd_file._recs
+        if (record_vars != ['time', predictand] or out_times.dtype != np.dtype('>f4')
+                or var.data.dtype != np.dtype('>f4') or record_size != 4 + shape[0] * shape[1] * 4):
+            raise ValueError('%s is not laid out as an output of dxt-gridded' % output_file)
+        del var
+
+    cod_file_path = extractor.cod_manager.get_cod_file_path(model, scenario, region_type,
+                                                            season, predictand)
+    rows = index.lookup(days, months).get(cod_file_path)
+    if rows is None or rows.size == 0:
+        return 0
+
+    cod_dates = CoD.read(cod_file_path)
+    out_days = out_times.astype(int)
+    order = np.argsort(out_days, kind='mergesort')
+    rdays = codes_to_days(cod_dates['rdates'][rows])
+    positions = np.minimum(np.searchsorted(out_days[order], rdays), out_days.size - 1)
+    # Outputs of a time window have only some of the rows.
+    found = out_days[order][positions] == rdays
+    rows = rows[found]
+    steps = order[positions[found]]
+    if steps.size == 0:
+        return 0
+
+    if verbose:
+        print 'updating %d time steps of %s' % (steps.size, output_file)
+    mask = extractor.mask_manager.read_mask(region)
+    data = extractor.awap_manager.read_data(predictand, cod_dates['adates'][rows], mask, dtype=np.float32)
+    data, _, _ = extractor.cubify(data, mask)
+    if data.shape[1:] != shape:
+        raise ValueError('%s is not on the grid of region %s' % (output_file, region))
+    data[np.isnan(data)] = missing_value
+
+    with open(output_file, 'r+b') as output:
+        # The records are at the end of the file.
+        output.seek(0, 2)
+        begin = output.tell() - nrecs * record_size
+        extractor.write_records(output, begin, record_size, out_times, [(steps, data)])
+
+    return steps.size
@@ -4,6 +4,7 @@ Helper program that manages CoD files
 y.wang@bom.gov.au
 """
 import os
+import calendar
 from datetime import datetime
 
 import numpy as np
@@ -39,6 +40,58 @@ class CoD(object):
                  for d in cod_dates + 19000000]
         return np.array(dates)
 
+    @staticmethod
+    def date_code(date_str, end=False):
+        """
+        The CoD date code of a date given as yyyy, yyyy-mm or yyyy-mm-dd. A year or month
+        stands for its first day, or its last day if end is True.
+        """
+        fields = [int(f) for f in date_str.split('-')]
+        if len(fields) == 1:
+            fields += [12, 31] if end else [1, 1]
+        elif len(fields) == 2:
+            fields.append(calendar.monthrange(fields[0], fields[1])[1] if end else 1)
+        yyyy, mm, dd = fields
+        return (yyyy - 1900) * 10000 + mm * 100 + dd
+
+    @staticmethod
+    def select(cod_dates, start_date=None, end_date=None, months=None):
+        """
+        The rows of the given CoD dates whose rdates are within start_date and end_date
+        (CoD date codes, inclusive) and in the given months of year
+        """
+        rdates = cod_dates['rdates']
+        keep = np.ones(rdates.size, dtype=bool)
+        if start_date is not None:
+            keep &= rdates >= start_date
+        if end_date is not None:
+            keep &= rdates <= end_date
+        if months:
+            keep &= np.in1d(CoD.calc_dates(rdates)['mm'], months)
+
+        return dict((key, values[keep]) for key, values in cod_dates.items())
+
+    @staticmethod
+    def period_starts(cod_dates, period):
+        """
+        The CoD date code of the first day of the month, season (DJF, MAM, JJA or SON) or year of
+        each of the given CoD dates. December counts in the DJF season of the following year.
+        """
+        date_components = CoD.calc_dates(cod_dates)
+        yyyys = date_components['yyyy']
+        if period == 'month':
+            mms = date_components['mm']
+        elif period == 'season':
+            mms = date_components['mm'] - date_components['mm'] % 3
+            yyyys = yyyys - (mms == 0)
+            mms = np.where(mms == 0, 12, mms)
+        elif period == 'year':
+            mms = np.ones_like(yyyys)
+        else:
+            raise ValueError('Unknown period: %s' % period)
+
+        return (yyyys - 1900) * 10000 + mms * 100 + 1
+
     @staticmethod
     def get_components_from_path(cod_file_path):
         _, _, season = os.path.basename(cod_file_path).split('_')
@@ -3,6 +3,9 @@ Extractor for gridded data
 
 y.wang@bom.gov.au
 """
+import os
+import struct
+import warnings
 from datetime import date, timedelta
 
 import numpy as np
@@ -11,19 +14,51 @@ from scipy.io import netcdf
 from .cod import CoD
 from .mask import Mask
 from .gridded import AwapDailyData
+from .pyramid import BASE_RESOLUTION
+
+AGGREGATION_PERIODS = ('month', 'season', 'year')
+AGGREGATION_STATISTICS = ('mean', 'sum', 'max', 'min')
+REGIONAL_STATISTICS = ('mean', 'min', 'max')
+
+MISSING_VALUE = 99999.9
 
 
 class GriddedExtractor(object):
-    def __init__(self, cod_base_dir=None, mask_base_dir=None, gridded_base_dir=None, verbose=False):
+    def __init__(self, cod_base_dir=None, mask_base_dir=None, gridded_base_dir=None, verbose=False,
+                 mask_cache_dir=None, pool=None, resolution=BASE_RESOLUTION):
         self.cod_manager = CoD(base_dir=cod_base_dir, verbose=verbose)
-        self.mask_manager = Mask(base_dir=mask_base_dir, verbose=verbose)
-        self.awap_manager = AwapDailyData(base_dir=gridded_base_dir, verbose=verbose)
+        self.awap_manager = AwapDailyData(base_dir=gridded_base_dir, verbose=verbose, pool=pool,
+                                          resolution=resolution)
+        self.mask_manager = Mask(base_dir=mask_base_dir, verbose=verbose, cache_dir=mask_cache_dir,
+                                 lat=self.awap_manager.lat, lon=self.awap_manager.lon, resolution=resolution)
         self.verbose = verbose
 
-    def extract(self, model, scenario, region_type, season, predictand, region=None, cube=True):
+    def read_inputs(self, model, scenario, region_type, season, predictand, region=None,
+                    start_date=None, end_date=None, months=None, band=None):
+        """ The CoD dates within the window and the mask of the region
+
+        band is the (first, stop) rows of the mask to extract only, for latitude band shards.
+        """
         cod_dates = self.cod_manager.read_cod(model, scenario, region_type, season, predictand)
+        cod_dates = CoD.select(cod_dates, start_date, end_date, months)
+        if cod_dates['rdates'].size == 0:
+            raise ValueError('No dates of the CoD file are in the requested window')
         mask = self.mask_manager.read_mask(region or region_type)
-        data = self.awap_manager.read_data(predictand, cod_dates['adates'], mask)
+        if band is not None:
+            mask = mask.copy()
+            mask[:band[0]] = 0
+            mask[band[1]:] = 0
+
+        return cod_dates, mask
+
+    def extract(self, model, scenario, region_type, season, predictand, region=None, cube=True,
+                start_date=None, end_date=None, months=None, band=None, dtype=np.float64):
+        """ Extract the data of the CoD file, optionally for the rdates between start_date and end_date
+        (CoD date codes) and in the given months only. Only the AWAP months used by those rdates are read.
+        """
+        cod_dates, mask = self.read_inputs(model, scenario, region_type, season, predictand, region,
+                                           start_date, end_date, months, band)
+        data = self.awap_manager.read_data(predictand, cod_dates['adates'], mask, dtype=dtype)
 
         if cube:
             data, lat, lon = self.cubify(data, mask)
@@ -32,12 +67,211 @@ class GriddedExtractor(object):
 
         return data, cod_dates['rdates'], lat, lon
 
+    def extract_to_netcdf(self, filename, model, scenario, region_type, season, predictand, region=None,
+                          start_date=None, end_date=None, months=None, chunk_months=1):
+        """ Extract the data of the CoD file straight into an output file, chunk_months AWAP months at a time
+
+        The file is written as save_netcdf would, but its records are written
+        in place as the rows using each chunk of months are gathered, so only
+        one chunk is held in memory. Returns the number of time steps written.
+        """
+        cod_dates, mask = self.read_inputs(model, scenario, region_type, season, predictand, region,
+                                           start_date, end_date, months)
+        nrows = cod_dates['rdates'].size
+
+        _, lat, lon = self.cubify(np.zeros((0, np.count_nonzero(mask))), mask)
+        begin, record_size = self.create_records_netcdf(filename, cod_dates['rdates'], lat, lon, model, scenario,
+                                                        region_type, season, predictand, region,
+                                                        self.awap_manager.resolution)
+
+        days = self.create_time_values(cod_dates['rdates']).astype('>f4')
+        missing_value = np.float32(MISSING_VALUE)
+        with open(filename, 'r+b') as output:
+            buffered = []
+            for idx_yyyymms, idx_days, data in self.awap_manager.iter_months(predictand, cod_dates['adates'],
+                                                                              mask, dtype=np.float32):
+                data, _, _ = self.cubify(data, mask)
+                data[np.isnan(data)] = missing_value
+                buffered.append((idx_yyyymms, data[idx_days]))
+                if len(buffered) == chunk_months:
+                    self.write_records(output, begin, record_size, days, buffered)
+                    buffered = []
+            self.write_records(output, begin, record_size, days, buffered)
+            self.write_record_count(output, nrows)
+
+        return nrows
+
+    @staticmethod
+    def create_records_netcdf(filename, dates, lat, lon,
+                              model, scenario, region_type, season, predictand, region=None,
+                              resolution=BASE_RESOLUTION):
+        """ Write the header and coordinates of an output file whose records are then written in place
+
+        The file is written as save_netcdf would, with a first record for the
+        sizes in the header to be right, which is written over like the others.
+        Returns the offset of the first record and the size of a record, each
+        holding a time value and a time step of the data.
+        """
+        f = GriddedExtractor.create_netcdf(filename, 'Daily gridded climate series', dates[:1],
+                                           model, scenario, region_type, season, predictand, region,
+                                           resolution)
+        var_data = GriddedExtractor.add_grid_variables(f, lat, lon, predictand)
+        var_data[:] = np.ones((1, lat.size, lon.size)) * MISSING_VALUE
+        del var_data
+        f.close()
+
+        record_size = 4 + lat.size * lon.size * 4
+        return os.path.getsize(filename) - record_size, record_size
+
     @staticmethod
-    def cubify(data, mask):
+    def write_record_count(output, nrecs):
+        # The number of records is the second field of the header.
+        output.seek(4)
+        output.write(struct.pack('>i', nrecs))
+
+    @staticmethod
+    def write_records(output, begin, record_size, days, chunk):
+        rows = np.concatenate([idx_yyyymms for idx_yyyymms, _ in chunk]) if chunk else []
+        data = np.concatenate([values for _, values in chunk]).astype('>f4') if chunk else []
+        # Write in row order, so the file is written from start to end.
+        for i in np.argsort(rows, kind='mergesort'):
+            output.seek(begin + rows[i] * record_size)
+            output.write(days[rows[i]:rows[i] + 1].tostring())
+            output.write(data[i].tostring())
+
+    def regional_series(self, model, scenario, region_type, season, predictand, region=None,
+                        start_date=None, end_date=None, months=None, statistics=('mean',), percentiles=()):
+        """ Extract the daily series of the mean, min or max and percentiles of the region
+
+        The mean is weighted by the cosine of latitude of each grid point,
+        leaving out missing values. The percentiles are of the grid point
+        values. The statistics are calculated once for each distinct AWAP day
+        as it is read, so the gridded data are never built. Returns a
+        dictionary of statistic name ('mean', 'min', 'max' or 'pNN') to series
+        and the rdates.
+        """
+        cod_dates, mask = self.read_inputs(model, scenario, region_type, season, predictand, region,
+                                           start_date, end_date, months)
+
+        idx_mask = np.where(mask.reshape(mask.size) != 0)[0]
+        weights = np.cos(np.radians(self.awap_manager.lat[idx_mask // mask.shape[1]]))
+
+        names = list(statistics) + ['p%g' % p for p in percentiles]
+        ret = {}
+        for name in names:
+            ret[name] = np.empty(cod_dates['rdates'].size)
+            ret[name][:] = np.NaN
+
+        for idx_yyyymms, idx_days, data in self.awap_manager.iter_months(predictand, cod_dates['adates'], mask):
+            valid = ~np.isnan(data)
+            day_stats = {}
+            if 'mean' in statistics:
+                total_weights = np.dot(valid, weights)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    day_stats['mean'] = np.where(total_weights > 0,
+                                                 np.dot(np.where(valid, data, 0.0), weights) / total_weights,
+                                                 np.NaN)
+            if 'min' in statistics:
+                day_stats['min'] = np.fmin.reduce(data, axis=1)
+            if 'max' in statistics:
+                day_stats['max'] = np.fmax.reduce(data, axis=1)
+            if len(percentiles) > 0:
+                with warnings.catch_warnings():
+                    # Days with no valid data give NaN.
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    values = np.nanpercentile(data, percentiles, axis=1)
+                for name, value in zip(names[len(statistics):], values):
+                    day_stats[name] = value
+
+            for name in names:
+                ret[name][idx_yyyymms] = day_stats[name][idx_days]
+
+        return ret, cod_dates['rdates']
+
+    def aggregate(self, model, scenario, region_type, season, predictand, region=None, cube=True,
+                  start_date=None, end_date=None, months=None, period='month', statistic='mean'):
+        """ Extract the monthly, seasonal or yearly mean, sum, maximum or minimum of the CoD file series
+
+        The statistics are accumulated while the AWAP months are read, without
+        the daily series. Each AWAP day is read once and, for the mean and sum,
+        weighted by the number of days of each period that use it. Missing
+        values are left out. Returns the data and the CoD date codes of the
+        start of each period, as extract does.
+        """
+        if period not in AGGREGATION_PERIODS or statistic not in AGGREGATION_STATISTICS:
+            raise ValueError('Unknown aggregation: %s %s' % (period, statistic))
+
+        cod_dates, mask = self.read_inputs(model, scenario, region_type, season, predictand, region,
+                                           start_date, end_date, months)
+
+        period_starts, idx_periods = np.unique(CoD.period_starts(cod_dates['rdates'], period),
+                                               return_inverse=True)
+        shape = (period_starts.size, np.count_nonzero(mask))
+        linear = statistic in ('mean', 'sum')
+        if linear:
+            sums = np.zeros(shape)
+            counts = np.zeros(shape)
+        else:
+            ret = np.empty(shape)
+            ret[:] = np.NaN
+            reduce_func = np.fmax if statistic == 'max' else np.fmin
+
+        for idx_yyyymms, idx_days, data in self.awap_manager.iter_months(predictand, cod_dates['adates'], mask):
+            periods, idx_month_periods = np.unique(idx_periods[idx_yyyymms], return_inverse=True)
+            if linear:
+                # Number of uses of each day of the month by each period.
+                weights = np.zeros((periods.size, data.shape[0]))
+                np.add.at(weights, (idx_month_periods, idx_days), 1)
+                valid = ~np.isnan(data)
+                sums[periods] += np.dot(weights, np.where(valid, data, 0.0))
+                counts[periods] += np.dot(weights, valid)
+            else:
+                for i, p in enumerate(periods):
+                    days = np.unique(idx_days[idx_month_periods == i])
+                    with np.errstate(invalid='ignore'):
+                        ret[p] = reduce_func(ret[p], reduce_func.reduce(data[days], axis=0))
+
+        if linear:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ret = np.where(counts > 0, sums / counts if statistic == 'mean' else sums, np.NaN)
+
+        if cube:
+            ret, lat, lon = self.cubify(ret, mask)
+        else:
+            lat, lon = self.awap_manager.lat, self.awap_manager.lon
+
+        return ret, period_starts, lat, lon
+
+    @staticmethod
+    def save_series_netcdf(filename, series, dates,
+                           model, scenario, region_type, season, predictand, region=None,
+                           resolution=BASE_RESOLUTION):
+        """ Save the regional series returned by regional_series
+        """
+        f = GriddedExtractor.create_netcdf(filename, 'Daily regional climate series', dates,
+                                           model, scenario, region_type, season, predictand, region, resolution)
+
+        for name in sorted(series):
+            var_name = predictand if name == 'mean' else '%s_%s' % (predictand, name)
+            var_data = f.createVariable(var_name, np.float32, ('time',))
+            var_data[:] = np.where(np.isnan(series[name]), MISSING_VALUE, series[name])
+            var_data.units = 'mm' if predictand == 'rain' else 'K'
+            var_data.long_name = '%s %s over %s' % (predictand, name, region or region_type)
+            if name == 'mean':
+                var_data.cell_methods = 'area: mean (weighted by cosine of latitude)'
+            elif name in ('min', 'max'):
+                var_data.cell_methods = 'area: %s' % ('minimum' if name == 'min' else 'maximum')
+            else:
+                var_data.cell_methods = 'area: percentile %s' % name[1:]
+            var_data.missing_value = var_data._FillValue = MISSING_VALUE
+
+        f.close()
+
+    def cubify(self, data, mask):
         """ Reshape the given data of shape (ndays, npoints) to (ndays, nlat, nlon)
         """
-        lat = np.arange(-4450, -995, 5) / 100.0
-        lon = np.arange(11200, 15630, 5) / 100.0
+        lat = self.awap_manager.lat
+        lon = self.awap_manager.lon
         idx_mask = np.where(mask != 0)
         idx_lat_min = np.min(idx_mask[0])
         idx_lat_max = np.max(idx_mask[0]) + 1
@@ -50,7 +284,7 @@ class GriddedExtractor(object):
         mask_subsetted = mask[idx_lat_min: idx_lat_max, idx_lon_min: idx_lon_max]
         idx_mask_subsetted = np.where(mask_subsetted.reshape(mask_subsetted.size) != 0)[0]
 
-        ret = np.empty((data.shape[0], mask_subsetted.size))
+        ret = np.empty((data.shape[0], mask_subsetted.size), dtype=data.dtype)
         ret[:] = np.NaN
 
         ret[:, idx_mask_subsetted] = data
@@ -59,18 +293,37 @@ class GriddedExtractor(object):
         return ret, lat_subsetted, lon_subsetted
 
     @staticmethod
-    def save_netcdf(filename, data, dates, lat, lon,
-                    model, scenario, region_type, season, predictand):
+    def create_time_values(dates):
+        """ Days since 1899-12-31 of the given CoD dates
+        """
+        date_components = CoD.calc_dates(np.asarray(dates, dtype=int))
+        months = ((date_components['yyyy'] - 1970) * 12 + date_components['mm'] - 1).astype('datetime64[M]')
+        return (months.astype('datetime64[D]') + (date_components['dd'] - 1)
+                - np.datetime64('1899-12-31')).astype('int')
 
-        dates = (np.array([np.datetime64(d) for d in CoD.format_dates(dates)])
-                 - np.datetime64('1899-12-31')).astype('int')
+    @staticmethod
+    def create_netcdf(filename, title, dates, model, scenario, region_type, season, predictand, region=None,
+                      resolution=BASE_RESOLUTION):
+        """ Create an output file with its global attributes and time axis
+
+        resolution is that of the grid the data were extracted on, for
+        dxt-update to extract again on the same grid.
+        """
+        dates = GriddedExtractor.create_time_values(dates)
 
         f = netcdf.netcdf_file(filename, 'w')
-        f.title = 'Daily gridded climate series (%s, %s, %s, %s, %s)' % (
-            model, scenario, region_type, season, predictand)
+        f.title = '%s (%s, %s, %s, %s, %s)' % (
+            title, model, scenario, region_type, season, predictand)
         f.institution = 'Bureau of Meteorology'
         f.source = 'Statistical Downscaling Model'
         f.history = 'Generated on %s' % date.today()
+        f.model = model
+        f.scenario = scenario or ''
+        f.region_type = region_type
+        f.season = str(season)
+        f.predictand = predictand
+        f.region = region or region_type
+        f.resolution = resolution
 
         f.createDimension('time', 0)
         var_time = f.createVariable('time', np.float32, ('time',))
@@ -78,6 +331,12 @@ class GriddedExtractor(object):
         var_time.units = 'days since 1899-12-31 00:00:00'
         var_time.calendar = 'standard'
 
+        return f
+
+    @staticmethod
+    def add_grid_variables(f, lat, lon, predictand):
+        """ Add the lat and lon axes and the (time, lat, lon) data variable to an output file
+        """
         f.createDimension('lat', lat.size)
         var_lat = f.createVariable('lat', float, ('lat',))
         var_lat[:] = lat
@@ -92,14 +351,29 @@ class GriddedExtractor(object):
         var_lon.long_name = 'longitude'
         var_lon.standard_name = 'longitude'
 
-        missing_value = 99999.9
         var_data = f.createVariable(predictand, np.float32, ('time', 'lat', 'lon'))
-        data = data.copy()
-        data[np.where(np.isnan(data))] = missing_value
-        var_data[:, :, :] = data
         var_data.units = 'mm' if predictand == 'rain' else 'K'
         var_data.long_name = predictand
-        var_data.missing_value = var_data._FillValue = missing_value
+        var_data.missing_value = var_data._FillValue = MISSING_VALUE
+
+        return var_data
+
+    @staticmethod
+    def save_netcdf(filename, data, dates, lat, lon,
+                    model, scenario, region_type, season, predictand, region=None, aggregation=None,
+                    resolution=BASE_RESOLUTION):
+
+        f = GriddedExtractor.create_netcdf(filename, 'Daily gridded climate series', dates,
+                                           model, scenario, region_type, season, predictand, region, resolution)
+        var_data = GriddedExtractor.add_grid_variables(f, lat, lon, predictand)
+
+        data = data.copy()
+        data[np.where(np.isnan(data))] = MISSING_VALUE
+        var_data[:, :, :] = data
+        if aggregation:
+            # (period, statistic) of the output of GriddedExtractor.aggregate
+            f.aggregation = '%s %s' % aggregation
+            var_data.cell_methods = 'time: %s' % aggregation[1]
 
         f.close()
 
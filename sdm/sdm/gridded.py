@@ -6,21 +6,26 @@ y.wang@bom.gov.au
 import os
 
 import numpy as np
-from scipy.io import netcdf
 
+from . import ncio
 from .cod import CoD
+from .pyramid import BASE_RESOLUTION, grid
 
 
 class AwapDailyData(object):
 
-    def __init__(self, base_dir=None, verbose=False):
-        self.resolution = '0.05'
-        self.lat = np.arange(-4450, -995, 5) / 100.0
-        self.lon = np.arange(11200, 15630, 5) / 100.0
+    def __init__(self, base_dir=None, verbose=False, pool=None, resolution=BASE_RESOLUTION):
+        # Resolutions coarser than 0.05 degree are read from the files built by sdm.pyramid.
+        self.resolution = resolution
+        self.lat, self.lon = grid(resolution)
         self.base_dir = base_dir or os.getcwd()
         self.verbose = verbose
+        # An ncio.FilePool to keep the monthly files open in, else each is closed once read
+        self.pool = pool
 
-    def read_one_file(self, var_name, year, month):
+    def get_file_path(self, var_name, year, month):
+        """ The path of a monthly file and the name of its variable
+        """
         if var_name in ['rr', 'rain']:
             var_code = 'rr'
             file_code = var_code + '_calib'
@@ -33,35 +38,48 @@ class AwapDailyData(object):
                                  file_code,
                                  '%s_daily_%s.%04d%02d.nc' % (file_code, self.resolution, year, month))
 
+        return file_path, var_code
+
+    def read_one_file(self, var_name, year, month, index=Ellipsis):
+        """ The data of a monthly file, or the part of it given by index, with missing values as NaN
+        """
+        file_path, var_code = self.get_file_path(var_name, year, month)
         if self.verbose:
             print 'reading netcdf file: %s' % file_path
-        ncd_file = netcdf.netcdf_file(file_path)
-        var = ncd_file.variables[var_code]
-        data = var.data.copy()
-        data[np.where(var.data == var.missing_value)] = np.NaN
-        ncd_file.close()
-
-        return data
+        return ncio.read_variable(file_path, var_code, index, pool=self.pool, fill_nan=True)
 
-    def read_data(self, var_name, adates, mask):
+    def iter_months(self, var_name, adates, mask, dtype=None):
+        """ Read each AWAP month used by the given adates once
 
+        Yields, for each month, the indices of the adates in the month, the
+        index of each of them in the data, and the data of the distinct days
+        used in shape (ndays, npoints), as dtype if given.
+        """
         date_components = CoD.calc_dates(adates)
 
-        idx_mask = np.where(mask.reshape(mask.size) != 0)[0]
-        ret = np.empty((adates.size, idx_mask.size))
-        ret[:] = np.NaN
+        # Only the days used and the rows and columns enclosing the mask are read.
+        rows, cols = np.where(mask != 0)
+        if rows.size:
+            box = (slice(rows.min(), rows.max() + 1), slice(cols.min(), cols.max() + 1))
+            idx_mask = (rows - rows.min()) * (cols.max() - cols.min() + 1) + (cols - cols.min())
+        else:
+            box = (slice(0, 0), slice(0, 0))
+            idx_mask = rows
 
         for yyyymm in sorted(set(date_components['yyyymm'])):
-            data = self.read_one_file(var_name, yyyymm / 100, yyyymm % 100)
-            data = data.reshape(data.shape[0], data.shape[1] * data.shape[2])
-
             idx_yyyymms = np.where(date_components['yyyymm'] == yyyymm)[0]
-            idx_days = date_components['dd'][idx_yyyymms] - 1
+            days, idx_days = np.unique(date_components['dd'][idx_yyyymms] - 1, return_inverse=True)
 
-            ret[idx_yyyymms, :] = data[idx_days, :][:, idx_mask]
-
-        return ret
+            data = self.read_one_file(var_name, yyyymm / 100, yyyymm % 100, (days,) + box)
+            data = data.reshape(data.shape[0], data.shape[1] * data.shape[2])[:, idx_mask]
+            yield idx_yyyymms, idx_days, data if dtype is None else data.astype(dtype)
 
+    def read_data(self, var_name, adates, mask, dtype=np.float64):
 
+        ret = np.empty((adates.size, np.count_nonzero(mask)), dtype=dtype)
+        ret[:] = np.NaN
 
+        for idx_yyyymms, idx_days, data in self.iter_months(var_name, adates, mask):
+            ret[idx_yyyymms, :] = data[idx_days, :]
 
+        return ret
@@ -0,0 +1,143 @@
+"""
+Level-of-detail reduction of long time series for charting
+
+A daily series of a century has more than 36,000 points, far more than a
+chart can show. The series can be decimated to a requested number of
+points, keeping the minimum and maximum of each bucket so that extremes
+survive, or summarised as min/max/mean envelopes at a pyramid of bucket
+widths, each level coarsening the one below it.
+"""
+import os
+import json
+
+import numpy as np
+
+
+def as_float(values):
+    """ Values as a float array with missing values as NaN
+    """
+    return np.ma.filled(np.ma.masked_invalid(np.ma.asarray(values, dtype=float)), np.NaN)
+
+
+def bucket_edges(n, nbuckets):
+    """ Start indices of nbuckets (nearly) equal buckets over n points
+    """
+    nbuckets = max(1, min(n, nbuckets))
+    return np.unique(np.linspace(0, n, nbuckets + 1).astype(int)[:-1])
+
+
+def minmax_indices(values, npoints):
+    """ Indices of the points to keep to show values with about npoints points
+
+    Each of npoints / 2 buckets keeps its minimum and its maximum, in time
+    order. The first and last points are always kept.
+    """
+    values = as_float(values)
+    n = values.size
+    if n <= npoints:
+        return np.arange(n)
+
+    starts = bucket_edges(n, npoints // 2)
+    bucket = np.repeat(np.arange(starts.size), np.diff(np.append(starts, n)))
+    with np.errstate(invalid='ignore'):
+        lows = np.fmin.reduceat(values, starts)
+        highs = np.fmax.reduceat(values, starts)
+
+    keep = []
+    for extreme in (lows, highs):
+        hits = np.flatnonzero(values == extreme[bucket])
+        # The first hit in each bucket; buckets of only NaN have none.
+        _, first = np.unique(bucket[hits], return_index=True)
+        keep.append(hits[first])
+
+    return np.unique(np.concatenate(keep + [[0, n - 1]]))
+
+
+def decimate(times, values, npoints):
+    """ The times and values of the points kept by minmax_indices
+    """
+    keep = minmax_indices(values, npoints)
+    return [times[i] for i in keep], np.asarray(values)[keep]
+
+
+def envelope(values, width):
+    """ Minimum, maximum, mean and count of values in buckets of width points
+    """
+    values = as_float(values)
+    starts = np.arange(0, values.size, width)
+    valid = ~np.isnan(values)
+    with np.errstate(invalid='ignore'):
+        level = {
+            'start': starts,
+            'min': np.fmin.reduceat(values, starts),
+            'max': np.fmax.reduceat(values, starts),
+            'sum': np.add.reduceat(np.where(valid, values, 0.0), starts),
+            'count': np.add.reduceat(valid.astype(int), starts),
+        }
+    return level
+
+
+def coarsen(level, factor):
+    """ The envelope of factor times wider buckets, from a finer level
+    """
+    starts = np.arange(0, level['start'].size, factor)
+    with np.errstate(invalid='ignore'):
+        return {
+            'start': level['start'][starts],
+            'min': np.fmin.reduceat(level['min'], starts),
+            'max': np.fmax.reduceat(level['max'], starts),
+            'sum': np.add.reduceat(level['sum'], starts),
+            'count': np.add.reduceat(level['count'], starts),
+        }
+
+
+def pyramid(values, factor=4, min_points=500):
+    """ Envelopes of buckets of factor, factor**2, ... points
+
+    Levels are added until one has no more than min_points buckets.
+    Returns a list of (bucket width, level) pairs.
+    """
+    width = factor
+    level = envelope(values, width)
+    levels = [(width, level)]
+    while level['start'].size > min_points:
+        level = coarsen(level, factor)
+        width *= factor
+        levels.append((width, level))
+    return levels
+
+
+def level_json(times, level, variable_name):
+    """ A pyramid level as a JSON-ready dictionary
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = level['sum'] / level['count']
+
+    def to_list(a):
+        return [None if np.isnan(v) else v for v in a.tolist()]
+
+    return {
+        'times': [times[i] for i in level['start']],
+        variable_name: to_list(mean),
+        variable_name + '_min': to_list(level['min']),
+        variable_name + '_max': to_list(level['max']),
+        'count': level['count'].tolist(),
+    }
+
+
+def save_pyramid(outfile, times, values, variable_name, factor=4, min_points=500):
+    """ Write each pyramid level next to outfile, as <name>_lod<width><ext>
+
+    times are the (JSON-ready) labels of values. Returns the list of the
+    levels written, for the index in the main output.
+    """
+    root, ext = os.path.splitext(outfile)
+    index = []
+    for width, level in pyramid(values, factor, min_points):
+        level_file = '%s_lod%d%s' % (root, width, ext or '.json')
+        with open(level_file, 'w') as out:
+            out.write(json.dumps(level_json(times, level, variable_name)))
+        index.append({'bucket_points': width,
+                      'points': int(level['start'].size),
+                      'file': os.path.basename(level_file)})
+    return index
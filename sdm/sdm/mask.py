@@ -1,19 +1,85 @@
 import os
 
+import numpy as np
 from scipy.io import netcdf
 
+from . import ncio, polygon
+from .pyramid import BASE_RESOLUTION, block_size, coarsen_mask, grid
+
+# Files of polygons that can be given as a region instead of a region name
+POLYGON_EXTENSIONS = ('.json', '.geojson', '.shp')
+
 
 class Mask(object):
 
-    def __init__(self, base_dir=None, verbose=False):
+    def __init__(self, base_dir=None, verbose=False, cache_dir=None, lat=None, lon=None,
+                 resolution=BASE_RESOLUTION):
         self.base_dir = base_dir or os.getcwd()
         self.verbose = verbose
+        self.cache_dir = cache_dir or os.path.join(os.path.expanduser('~'), '.sdm_mask_cache')
+        # Mask files are on the 0.05 degree grid and coarsened to the resolution.
+        self.resolution = resolution
+        # The grid polygons are rasterised onto, default to the AWAP grid of the resolution
+        self.lat = grid(resolution)[0] if lat is None else lat
+        self.lon = grid(resolution)[1] if lon is None else lon
+
+    @staticmethod
+    def is_polygon_file(region_name):
+        return region_name.lower().endswith(POLYGON_EXTENSIONS) and os.path.isfile(region_name)
 
     def read_mask(self, region_name):
+        if Mask.is_polygon_file(region_name):
+            return self.read_polygon_mask(region_name)
+
         file_path = os.path.join(self.base_dir, 'mask_%s.nc' % region_name)
         if self.verbose:
             print 'reading mask file: %s' % file_path
-        ncd_file = netcdf.netcdf_file(file_path)
-        mask = ncd_file.variables['mask'].data.copy()
+        mask = ncio.read_variable(file_path, 'mask')
+        if self.resolution != BASE_RESOLUTION:
+            mask = coarsen_mask(mask, block_size(self.resolution))
+
+        return mask
+
+    def read_polygon_mask(self, file_path):
+        """ The mask of the polygons in a GeoJSON file or shapefile
+
+        Masks are cached as mask_<hash>.nc in cache_dir, by a hash of the
+        polygons and the grid, so a region is only rasterised once.
+        """
+        polygons = polygon.read_polygons(file_path)
+        cache_path = os.path.join(self.cache_dir,
+                                  'mask_%s.nc' % polygon.geometry_hash(polygons, self.lat, self.lon))
+        if os.path.isfile(cache_path):
+            if self.verbose:
+                print 'reading cached mask file: %s' % cache_path
+            return ncio.read_variable(cache_path, 'mask')
+
+        if self.verbose:
+            print 'rasterising polygons of: %s' % file_path
+        mask = polygon.rasterise(polygons, self.lat, self.lon)
+        if not np.any(mask):
+            raise ValueError('No grid points are inside the polygons of %s' % file_path)
+        self.save_mask(cache_path, mask, file_path)
+
+        return mask
+
+    def save_mask(self, file_path, mask, source):
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
 
-        return mask
\ No newline at end of file
+        # Write to a temporary file and rename, so a concurrent reader never sees half a mask.
+        temp_path = '%s.%d.tmp' % (file_path, os.getpid())
+        f = netcdf.netcdf_file(temp_path, 'w')
+        f.source = 'Rasterised from %s' % source
+        f.createDimension('lat', self.lat.size)
+        var_lat = f.createVariable('lat', float, ('lat',))
+        var_lat[:] = self.lat
+        var_lat.units = 'degrees_north'
+        f.createDimension('lon', self.lon.size)
+        var_lon = f.createVariable('lon', float, ('lon',))
+        var_lon[:] = self.lon
+        var_lon.units = 'degrees_east'
+        var_mask = f.createVariable('mask', np.int32, ('lat', 'lon'))
+        var_mask[:] = mask
+        f.close()
+        os.rename(temp_path, file_path)
@@ -0,0 +1,121 @@
+"""
+Reading of classic NetCDF files through memory maps
+
+Files are opened with scipy.io.netcdf and mmap, so reading a point or a
+hyperslab of a variable touches only the pages holding it, and only that
+part is copied out. Nothing returned refers to the mapped data, so files can
+always be closed cleanly.
+
+Files read again and again, e.g. the AWAP months of many extractions in a
+shard, can be kept open in a FilePool, which holds a bounded number of them
+and closes the least recently used first.
+
+This module only needs numpy and scipy, and is loaded on its own by the
+point readers of utils/ (utils/netcdf_point.py) when the package is not
+installed, so it must not import the rest of the package.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from scipy.io import netcdf
+
+# Files kept open by a pool, by default
+DEFAULT_MAX_OPEN = 16
+
+
+class FilePool(object):
+    """ Open files, at most max_open of them, the least recently used closed first
+    """
+
+    def __init__(self, max_open=DEFAULT_MAX_OPEN):
+        if max_open < 1:
+            raise ValueError('A file pool needs room for at least one file')
+        self.max_open = max_open
+        self.files = OrderedDict()
+
+    def __repr__(self):
+        return '<FilePool; open = %d, max_open = %d>' % (len(self.files), self.max_open)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, file_path):
+        """ The open file of file_path, opening it if needed
+        """
+        ncd_file = self.files.pop(file_path, None)
+        if ncd_file is None:
+            while len(self.files) >= self.max_open:
+                _, oldest = self.files.popitem(last=False)
+                oldest.close()
+            ncd_file = netcdf.netcdf_file(file_path, mmap=True)
+        self.files[file_path] = ncd_file
+        return ncd_file
+
+    def release(self, file_path):
+        """ Close file_path if it is open
+        """
+        ncd_file = self.files.pop(file_path, None)
+        if ncd_file is not None:
+            ncd_file.close()
+
+    def close(self):
+        while self.files:
+            _, ncd_file = self.files.popitem(last=False)
+            ncd_file.close()
+
+
+@contextmanager
+def open_file(file_path, pool=None):
+    """ Open a file for reading, from the pool if given, else closed on leaving the context
+
+    Arrays taken from the file with take() may be kept. References to its
+    variables must be dropped before leaving the context.
+    """
+    if pool is not None:
+        yield pool.get(file_path)
+        return
+
+    ncd_file = netcdf.netcdf_file(file_path, mmap=True)
+    try:
+        yield ncd_file
+    finally:
+        ncd_file.close()
+
+
+def take(var, index=Ellipsis, fill_nan=False):
+    """ A copy of var[index], with missing values as NaN if fill_nan
+
+    index is anything numpy takes, e.g. (slice(None), y, x) for the series of
+    a point or (days, slice(y0, y1), slice(x0, x1)) for a hyperslab. Only the
+    indexed part is read from the file.
+    """
+    data = np.array(var.data[index])
+    if fill_nan and hasattr(var, 'missing_value'):
+        # Compare in the type of the variable, in which the missing value was written.
+        missing = data == np.array(var.missing_value, dtype=data.dtype)
+        if missing.any():
+            if data.dtype.kind not in 'fc':
+                data = data.astype(float)
+            data[missing] = np.NaN
+    return data
+
+
+def read_variable(file_path, var_name, index=Ellipsis, pool=None, fill_nan=False):
+    """ A copy of var_name[index] of a file, see take()
+    """
+    with open_file(file_path, pool) as ncd_file:
+        data = take(ncd_file.variables[var_name], index, fill_nan)
+    return data
+
+
+def read_point(file_path, var_name, y, x, pool=None, fill_nan=False):
+    """ The series of a (time, lat, lon) variable at a grid point
+    """
+    return read_variable(file_path, var_name, (slice(None), y, x), pool, fill_nan)
@@ -0,0 +1,140 @@
+"""
+Memory planning of gridded extractions
+
+The peak memory of an extraction is estimated up front from the number of
+CoD rows, the number of points of the mask, the size of its enclosing grid
+(the box), the distinct days used of each AWAP month and the data type.
+Only those days of the box are read from each month. A plan then fits a
+memory budget: in memory with float64 as before if it fits, else in memory
+with float32, else streamed into the output file a number of AWAP months at
+a time (GriddedExtractor.extract_to_netcdf).
+"""
+import re
+
+import numpy as np
+
+from .cod import CoD
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_memory(text):
+    """ Bytes of a memory size such as 500M, 8G or 8GB
+    """
+    match = re.match(r'^\s*([\d.]+)\s*([KMGT]?)B?\s*$', text, re.IGNORECASE)
+    if match is None:
+        raise ValueError('Not a memory size: %s' % text)
+    return int(float(match.group(1)) * UNITS[match.group(2).upper()])
+
+
+def format_bytes(nbytes):
+    for unit in ('T', 'G', 'M', 'K'):
+        if nbytes >= UNITS[unit]:
+            return '%.1f %sB' % (nbytes / float(UNITS[unit]), unit)
+    return '%d B' % nbytes
+
+
+def month_peaks(month_days, npoints, ncells):
+    """ Peak bytes of reading each month: the float32 box of its days, their missing value flags and points
+    """
+    return month_days * (ncells * (4 + 1) + npoints * 4)
+
+
+def in_memory_peak(nrows, npoints, ncells, month_peak, itemsize):
+    """ Peak bytes of extract and save_netcdf
+
+    The point matrix is filled a month at a time, then held together with
+    the cube by cubify, then the cube, its copy with missing values and the
+    float32 buffer of the file variable by save_netcdf.
+    """
+    return max(nrows * npoints * itemsize + month_peak,
+               nrows * (npoints + ncells) * itemsize,
+               nrows * ncells * (2 * itemsize + 4))
+
+
+def streaming_peak(chunk_rows, month_peak, ncells):
+    """ Peak bytes of extract_to_netcdf for a chunk of the given rows
+
+    A month read with the float32 cube of its days, and the buffered rows
+    of the chunk with their concatenated and big-endian copies.
+    """
+    return month_peak + chunk_rows * ncells * 4 * 3
+
+
+def largest_chunk_peaks(month_rows, month_days, chunk_months, npoints, ncells):
+    """ The peak of the largest of the chunks of chunk_months consecutive months
+    """
+    starts = np.arange(0, month_rows.size, chunk_months)
+    rows = np.add.reduceat(month_rows, starts)
+    month_peak = (month_peaks(month_days, npoints, ncells) + month_days * ncells * 4).max()
+    return streaming_peak(rows.max(), month_peak, ncells)
+
+
+def plan_extraction(extractor, model, scenario, region_type, season, predictand, region=None,
+                    start_date=None, end_date=None, months=None, max_memory=None):
+    """ The plan of an extraction within max_memory bytes (no limit if None)
+
+    Returns a dictionary of the mode ('in-memory' or 'streaming'), dtype,
+    chunk_months of streaming, the estimated peak_bytes, the bytes_read from
+    AWAP files and the number of files to open, with the sizes used.
+    """
+    cod_dates, mask = extractor.read_inputs(model, scenario, region_type, season, predictand, region,
+                                            start_date, end_date, months)
+    nrows = cod_dates['rdates'].size
+    idx_mask = np.where(mask != 0)
+    npoints = idx_mask[0].size
+    shape = (idx_mask[0].max() - idx_mask[0].min() + 1, idx_mask[1].max() - idx_mask[1].min() + 1)
+    ncells = shape[0] * shape[1]
+
+    date_components = CoD.calc_dates(cod_dates['adates'])
+    yyyymms, idx_months = np.unique(date_components['yyyymm'], return_inverse=True)
+    month_rows = np.bincount(idx_months)
+    month_days = np.array([np.unique(cod_dates['adates'][date_components['yyyymm'] == yyyymm]).size
+                           for yyyymm in yyyymms])
+
+    plan = {
+        'nrows': nrows,
+        'npoints': npoints,
+        'shape': shape,
+        'files': yyyymms.size + 2,  # the AWAP months, the CoD file and the mask
+        'bytes_read': int(month_days.sum()) * ncells * 4,
+        'max_memory': max_memory,
+        'chunk_months': None,
+    }
+
+    month_peak = month_peaks(month_days, npoints, ncells).max()
+    for dtype in (np.float64, np.float32):
+        peak = in_memory_peak(nrows, npoints, ncells, month_peak, np.dtype(dtype).itemsize)
+        if max_memory is None or peak <= max_memory:
+            plan.update(mode='in-memory', dtype=dtype, peak_bytes=peak)
+            return plan
+
+    # The most months per chunk that fit, as fewer chunks mean fewer, longer writes.
+    chunk_months = None
+    for n in range(yyyymms.size, 0, -1):
+        peak = largest_chunk_peaks(month_rows, month_days, n, npoints, ncells)
+        if peak <= max_memory:
+            chunk_months = n
+            break
+    if chunk_months is None:
+        raise ValueError('The extraction needs at least %s, more than the %s allowed' % (
+            format_bytes(peak), format_bytes(max_memory)))
+
+    plan.update(mode='streaming', dtype=np.float32, chunk_months=chunk_months, peak_bytes=peak)
+    return plan
+
+
+def format_plan(plan):
+    lines = [
+        'mode: %s' % plan['mode'],
+        'dtype: %s' % np.dtype(plan['dtype']).name,
+        'time steps: %d' % plan['nrows'],
+        'mask points: %d (grid of %d x %d)' % ((plan['npoints'],) + tuple(plan['shape'])),
+        'estimated peak memory: %s' % format_bytes(plan['peak_bytes']),
+        'memory budget: %s' % (format_bytes(plan['max_memory']) if plan['max_memory'] else 'none'),
+        'files to open: %d' % plan['files'],
+        'expected bytes read: %s' % format_bytes(plan['bytes_read']),
+    ]
+    if plan['mode'] == 'streaming':
+        lines.insert(2, 'months per chunk: %d' % plan['chunk_months'])
+    return '\n'.join(lines)
@@ -0,0 +1,170 @@
+"""
+Polygon regions read from GeoJSON or shapefiles and rasterised onto a grid
+
+A polygon is a list of rings of (lon, lat) vertices. A grid point is inside
+a polygon if a ray from it crosses the rings an odd number of times, so
+holes need no special treatment. Polygons are rasterised a whole grid at a
+time by scanlines: the crossings of every edge with every grid latitude are
+found at once and the points between pairs of crossings are filled.
+"""
+import json
+import struct
+import hashlib
+
+import numpy as np
+
+# Shape types of the polygons in a shapefile: Polygon, PolygonZ and PolygonM
+SHAPEFILE_POLYGON_TYPES = (5, 15, 25)
+
+
+def read_geojson(file_path):
+    """ The polygons of a GeoJSON file (a geometry, feature or feature collection)
+    """
+    with open(file_path) as f:
+        obj = json.load(f)
+
+    polygons = []
+    geometries = [obj]
+    while geometries:
+        geometry = geometries.pop(0)
+        if geometry is None:
+            continue
+        kind = geometry.get('type')
+        if kind == 'FeatureCollection':
+            geometries.extend(feature.get('geometry') for feature in geometry['features'])
+        elif kind == 'Feature':
+            geometries.append(geometry.get('geometry'))
+        elif kind == 'GeometryCollection':
+            geometries.extend(geometry['geometries'])
+        elif kind == 'Polygon':
+            polygons.append(geometry['coordinates'])
+        elif kind == 'MultiPolygon':
+            polygons.extend(geometry['coordinates'])
+        else:
+            raise ValueError('Unsupported GeoJSON type in %s: %s' % (file_path, kind))
+
+    return [[np.array(ring, dtype=float)[:, :2] for ring in polygon] for polygon in polygons]
+
+
+def read_shapefile(file_path):
+    """ The polygons of the records of a shapefile (.shp)
+    """
+    with open(file_path, 'rb') as f:
+        content = f.read()
+
+    file_code, = struct.unpack('>i', content[:4])
+    if file_code != 9994:
+        raise ValueError('Not a shapefile: %s' % file_path)
+
+    polygons = []
+    offset = 100
+    while offset + 8 <= len(content):
+        _, length = struct.unpack('>2i', content[offset:offset + 8])
+        record = content[offset + 8:offset + 8 + 2 * length]
+        offset += 8 + 2 * length
+
+        shape_type, = struct.unpack('<i', record[:4])
+        if shape_type == 0:  # Null shape
+            continue
+        if shape_type not in SHAPEFILE_POLYGON_TYPES:
+            raise ValueError('Not a polygon shapefile: %s' % file_path)
+
+        nparts, npoints = struct.unpack('<2i', record[36:44])
+        parts = np.frombuffer(record, dtype='<i4', count=nparts, offset=44)
+        points = np.frombuffer(record, dtype='<f8', count=2 * npoints,
+                               offset=44 + 4 * nparts).reshape(npoints, 2)
+        bounds = np.append(parts, npoints)
+        polygons.append([points[bounds[i]:bounds[i + 1]] for i in range(nparts)])
+
+    return polygons
+
+
+def read_polygons(file_path):
+    if file_path.lower().endswith('.shp'):
+        return read_shapefile(file_path)
+    else:
+        return read_geojson(file_path)
+
+
+def geometry_hash(polygons, lat, lon):
+    """ A digest of the polygons and the grid they are rasterised onto
+    """
+    digest = hashlib.sha1()
+    for grid in (lat, lon):
+        digest.update(np.ascontiguousarray(grid, dtype='<f8').tostring())
+    for polygon in polygons:
+        digest.update(b'polygon')
+        for ring in polygon:
+            digest.update(b'ring')
+            digest.update(np.ascontiguousarray(ring, dtype='<f8').tostring())
+    return digest.hexdigest()
+
+
+def rasterise_polygon(rings, lat, lon):
+    """ Boolean mask (lat, lon) of the grid points inside the rings, by the even-odd rule
+
+    lat and lon are the ascending coordinates of the grid points.
+    """
+    inside = np.zeros((lat.size, lon.size), dtype=bool)
+    edges = []
+    for ring in rings:
+        ring = np.asarray(ring, dtype=float)
+        if ring.shape[0] < 3:
+            continue
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack([ring, ring[:1]])
+        edges.append(np.hstack([ring[:-1], ring[1:]]))
+    if not edges:
+        return inside
+
+    x0, y0, x1, y1 = np.vstack(edges).T
+    sloped = y0 != y1
+    x0, y0, x1, y1 = x0[sloped], y0[sloped], x1[sloped], y1[sloped]
+
+    # Each edge crosses the grid latitudes in [min(y0, y1), max(y0, y1)).
+    first_rows = np.searchsorted(lat, np.minimum(y0, y1), side='left')
+    ncrossings = np.searchsorted(lat, np.maximum(y0, y1), side='left') - first_rows
+    idx_edges = np.repeat(np.arange(x0.size), ncrossings)
+    rows = first_rows[idx_edges] + np.arange(idx_edges.size) - np.repeat(np.cumsum(ncrossings) - ncrossings,
+                                                                         ncrossings)
+    if rows.size == 0:
+        return inside
+
+    y = lat[rows]
+    x = x0[idx_edges] + (y - y0[idx_edges]) * (x1[idx_edges] - x0[idx_edges]) / (y1[idx_edges] - y0[idx_edges])
+
+    # Each row has an even number of crossings, sorted they pair up as the
+    # starts and ends of the spans inside.
+    order = np.lexsort((x, rows))
+    rows, x = rows[order], x[order]
+    span_rows = rows[0::2]
+    starts = np.searchsorted(lon, x[0::2], side='left')
+    stops = np.searchsorted(lon, x[1::2], side='left')
+
+    counts = np.zeros((lat.size, lon.size + 1), dtype=np.int32)
+    np.add.at(counts, (span_rows, starts), 1)
+    np.add.at(counts, (span_rows, stops), -1)
+    return np.cumsum(counts[:, :-1], axis=1) > 0
+
+
+def rasterise(polygons, lat, lon):
+    """ Mask (lat, lon) of ones at the grid points inside any of the polygons and zeros elsewhere
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    flip_lat = lat.size > 1 and lat[0] > lat[-1]
+    flip_lon = lon.size > 1 and lon[0] > lon[-1]
+    if flip_lat:
+        lat = lat[::-1]
+    if flip_lon:
+        lon = lon[::-1]
+
+    inside = np.zeros((lat.size, lon.size), dtype=bool)
+    for polygon in polygons:
+        inside |= rasterise_polygon(polygon, lat, lon)
+
+    if flip_lat:
+        inside = inside[::-1]
+    if flip_lon:
+        inside = inside[:, ::-1]
+    return inside.astype(np.int32)
@@ -0,0 +1,169 @@
+"""
+Coarser copies of the AWAP daily dataset for quick previews
+
+The 0.05 degree grid is coarsened by averaging blocks of 2 x 2 (0.1
+degree), 5 x 5 (0.25 degree) or 10 x 10 (0.5 degree) cells. Missing cells
+are left out of the means, so a coastal block is the mean of its land cells,
+and a block of missing cells only is missing. Blocks at the northern and
+eastern edges hold the cells that are left. The coarsened monthly files are
+saved next to the 0.05 degree ones, under daily_<resolution>/, in the same
+form, so AwapDailyData reads them with its resolution set.
+
+Masks are coarsened the same way, a block being in the region if any of its
+cells is, so small regions are kept.
+"""
+import os
+import re
+
+import numpy as np
+from scipy.io import netcdf
+
+from . import ncio
+
+BASE_RESOLUTION = '0.05'
+RESOLUTIONS = ('0.05', '0.1', '0.25', '0.5')
+
+# The AWAP 0.05 degree grid, in hundredths of a degree
+BASE_LAT = np.arange(-4450, -995, 5)
+BASE_LON = np.arange(11200, 15630, 5)
+
+MONTH_FILE_PATTERN = re.compile(r'_daily_[\d.]+\.(\d{6})\.nc$')
+
+
+def block_size(resolution):
+    """ The number of 0.05 degree cells along each side of a cell of the resolution
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError('Unknown resolution: %s (one of %s)' % (resolution, ', '.join(RESOLUTIONS)))
+    return int(round(float(resolution) / float(BASE_RESOLUTION)))
+
+
+def coarsen_axis(axis, factor):
+    """ The centres of the blocks of factor cells of an axis in hundredths of a degree, in degrees
+    """
+    step = axis[1] - axis[0]
+    nblocks = -(-axis.size // factor)
+    return (axis[0] + step * (factor - 1) / 2.0 + np.arange(nblocks) * step * factor) / 100.0
+
+
+def grid(resolution):
+    """ The lat and lon of the AWAP grid at the resolution
+    """
+    factor = block_size(resolution)
+    return coarsen_axis(BASE_LAT, factor), coarsen_axis(BASE_LON, factor)
+
+
+def blocks(data, factor, fill_value):
+    """ The data (..., nlat, nlon) as (..., nlat blocks, factor, nlon blocks, factor)
+
+    The last blocks are filled up with fill_value.
+    """
+    nlat, nlon = data.shape[-2:]
+    pad = [(0, 0)] * (data.ndim - 2) + [(0, -nlat % factor), (0, -nlon % factor)]
+    data = np.pad(data, pad, mode='constant', constant_values=fill_value)
+    return data.reshape(data.shape[:-2] + (data.shape[-2] // factor, factor, data.shape[-1] // factor, factor))
+
+
+def coarsen(data, factor):
+    """ Block means of the data (..., nlat, nlon), leaving out NaN
+    """
+    data = blocks(np.asarray(data, dtype=np.float64), factor, np.NaN)
+    valid = ~np.isnan(data)
+    counts = valid.sum(axis=(-3, -1))
+    sums = np.where(valid, data, 0.0).sum(axis=(-3, -1))
+    ret = np.empty(sums.shape)
+    ret[:] = np.NaN
+    ret[counts > 0] = sums[counts > 0] / counts[counts > 0]
+    return ret
+
+
+def coarsen_mask(mask, factor):
+    """ The mask of the blocks with any cell in the mask
+    """
+    return blocks(mask != 0, factor, False).any(axis=(-3, -1)).astype(np.int32)
+
+
+def source_months(awap_manager, var_name):
+    """ The months (yyyymm) of the monthly files of var_name of an AwapDailyData
+    """
+    dir_path = os.path.dirname(awap_manager.get_file_path(var_name, 1900, 1)[0])
+    if not os.path.isdir(dir_path):
+        return []
+    months = [MONTH_FILE_PATTERN.search(filename) for filename in os.listdir(dir_path)]
+    return sorted(int(match.group(1)) for match in months if match)
+
+
+def build_month(source, target, var_name, year, month, overwrite=False):
+    """ Coarsen a monthly file of the source AwapDailyData to the resolution of the target one
+
+    The file is coarsened a day at a time. Returns the file written, or None
+    if it is newer than the source file already and overwrite is not set.
+    """
+    source_path, var_code = source.get_file_path(var_name, year, month)
+    target_path, _ = target.get_file_path(var_name, year, month)
+    if (not overwrite and os.path.isfile(target_path)
+            and os.path.getmtime(target_path) >= os.path.getmtime(source_path)):
+        return None
+
+    factor = block_size(target.resolution)
+    time = None
+    with ncio.open_file(source_path) as ncd_file:
+        var = ncd_file.variables[var_code]
+        missing_value = var.missing_value
+        data = np.empty((var.shape[0], target.lat.size, target.lon.size), dtype=np.float32)
+        for day in range(var.shape[0]):
+            data[day] = coarsen(ncio.take(var, day, fill_nan=True), factor)
+        if 'time' in ncd_file.variables:
+            attributes = ncd_file.variables['time']._attributes
+            time = (ncio.take(ncd_file.variables['time']), ncd_file.variables['time'].data.dtype,
+                    dict((name, attributes[name]) for name in ('units', 'calendar') if name in attributes))
+        del var
+
+    if not os.path.isdir(os.path.dirname(target_path)):
+        os.makedirs(os.path.dirname(target_path))
+    # Write to a temporary file and rename, so a reader never sees half a month.
+    temp_path = '%s.%d.tmp' % (target_path, os.getpid())
+    f = netcdf.netcdf_file(temp_path, 'w')
+    f.source = 'Block means of %s' % source_path
+
+    f.createDimension('time', data.shape[0])
+    if time is not None:
+        values, dtype, attributes = time
+        var_time = f.createVariable('time', dtype, ('time',))
+        var_time[:] = values
+        for name, value in attributes.items():
+            setattr(var_time, name, value)
+    f.createDimension('lat', target.lat.size)
+    var_lat = f.createVariable('lat', float, ('lat',))
+    var_lat[:] = target.lat
+    var_lat.units = 'degrees_north'
+    f.createDimension('lon', target.lon.size)
+    var_lon = f.createVariable('lon', float, ('lon',))
+    var_lon[:] = target.lon
+    var_lon.units = 'degrees_east'
+
+    var_data = f.createVariable(var_code, np.float32, ('time', 'lat', 'lon'))
+    data[np.isnan(data)] = missing_value
+    var_data[:] = data
+    var_data.missing_value = np.float32(missing_value)
+    f.close()
+    os.rename(temp_path, target_path)
+
+    return target_path
+
+
+def build_pyramid(source, targets, var_names, months=None, overwrite=False, verbose=False):
+    """ Coarsen the monthly files of var_names (all months if None) to each of the target AwapDailyData
+
+    Returns the files written.
+    """
+    ret = []
+    for var_name in var_names:
+        for yyyymm in (months or source_months(source, var_name)):
+            for target in targets:
+                target_path = build_month(source, target, var_name, yyyymm // 100, yyyymm % 100, overwrite)
+                if target_path:
+                    if verbose:
+                        print 'written: %s' % target_path
+                    ret.append(target_path)
+    return ret
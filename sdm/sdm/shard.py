@@ -0,0 +1,274 @@
+"""
+Split extraction runs into balanced shards for multi-node jobs
+
+A plan is a list of shards, each a list of extraction tasks, saved as JSON.
+Many CoD files (the job matrix of models, scenarios, region types, seasons
+and predictands) are balanced over the shards by the bytes each task is
+expected to read, which is the number of AWAP months its CoD file uses times
+the size of a monthly file. A single large region is instead split into
+latitude bands with equal numbers of grid points, one per shard, and the
+band outputs are merged into the final file afterwards.
+
+Each shard runs on its own, e.g. as an element of a PBS job array, with the
+shard number taken from PBS_ARRAY_INDEX.
+"""
+import os
+import json
+import heapq
+
+import numpy as np
+
+from . import ncio
+from .cod import CoD
+from .extractor import MISSING_VALUE
+from .mask import Mask
+from .analog_index import find_cod_files
+
+# Size of a monthly AWAP file when none can be found to measure
+DEFAULT_MONTH_BYTES = 31 * 691 * 886 * 4
+
+# Bytes of the time steps of a merged output held in memory at once
+MERGE_CHUNK_BYTES = 256 * 1024 ** 2
+
+# Environment variables holding the index of a job array element
+ARRAY_INDEX_VARIABLES = ('PBS_ARRAY_INDEX', 'PBS_ARRAYID')
+
+
+def job_matrix(cod_base_dir, models=None, scenarios=None, region_types=None, seasons=None, predictands=None):
+    """ The CoD files under cod_base_dir with the given components (all if None)
+    """
+    ret = []
+    for cod_file_path in find_cod_files(cod_base_dir):
+        model, scenario, region_type, season, predictand = CoD.get_components_from_path(cod_file_path)
+        if all(wanted is None or value in wanted
+               for value, wanted in ((model, models), (scenario, scenarios), (region_type, region_types),
+                                     (season, seasons), (predictand, predictands))):
+            ret.append(cod_file_path)
+    return ret
+
+
+def month_count(cod_file_path):
+    """ The number of AWAP months used by a CoD file
+    """
+    adates = CoD.read(cod_file_path)['adates']
+    return np.unique(CoD.calc_dates(adates)['yyyymm']).size
+
+
+def month_bytes(awap_manager, predictand):
+    """ The size of a monthly AWAP file of the predictand
+    """
+    file_code = 'rr_calib' if predictand in ['rr', 'rain'] else predictand
+    dir_path = os.path.join(awap_manager.base_dir, 'daily_%s' % awap_manager.resolution, file_code)
+    if os.path.isdir(dir_path):
+        for filename in sorted(os.listdir(dir_path)):
+            if filename.endswith('.nc'):
+                return os.path.getsize(os.path.join(dir_path, filename))
+    return DEFAULT_MONTH_BYTES
+
+
+def balance(costs, nshards):
+    """ Assign tasks to nshards by longest processing time first
+
+    Each task, from the most costly, goes to the shard with the least cost
+    so far. Ties are broken by task and shard order, so the result is the
+    same on every node. Returns the list of task indices of each shard.
+    """
+    shards = [[] for _ in range(nshards)]
+    heap = [(0, i) for i in range(nshards)]
+    for task in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+        load, shard = heapq.heappop(heap)
+        shards[shard].append(task)
+        heapq.heappush(heap, (load + costs[task], shard))
+    return shards
+
+
+def latitude_bands(mask, nbands):
+    """ Split the rows of the mask into up to nbands bands of consecutive rows with equal numbers of points
+
+    Returns a list of (first row, stop row) pairs, each band having points.
+    """
+    counts = (mask != 0).sum(axis=1)
+    rows = np.flatnonzero(counts)
+    if rows.size == 0:
+        raise ValueError('The mask has no points')
+    cumulative = np.cumsum(counts)
+    targets = cumulative[-1] * np.arange(1, nbands) / float(nbands)
+    cuts = np.searchsorted(cumulative, targets, side='left') + 1
+
+    bands = []
+    start = rows[0]
+    for cut in list(cuts) + [rows[-1] + 1]:
+        if cut > start and counts[start:cut].any():
+            bands.append((int(start), int(cut)))
+            start = cut
+    return bands
+
+
+def output_name(output_dir, cod_file_path):
+    model, scenario, region_type, season, predictand = CoD.get_components_from_path(cod_file_path)
+    return os.path.join(output_dir, '%s_%s_%s_season_%s.nc' % (
+        CoD.get_modsce(model, scenario), region_type, predictand, season))
+
+
+def band_name(output_file, band_number):
+    root, ext = os.path.splitext(output_file)
+    return '%s.band%02d%s' % (root, band_number, ext or '.nc')
+
+
+def plan_path(path):
+    """ A path to store in a plan: absolute, as array jobs do not start in the directory it was planned in
+    """
+    return os.path.abspath(path)
+
+
+def plan_region(region):
+    return plan_path(region) if region and Mask.is_polygon_file(region) else region
+
+
+def plan_jobs(extractor, cod_file_paths, output_dir, nshards, region=None):
+    """ A plan of the extraction of each CoD file to output_dir, over nshards shards
+    """
+    cod_file_paths = [plan_path(cod_file_path) for cod_file_path in cod_file_paths]
+    output_dir = plan_path(output_dir)
+    region = plan_region(region)
+    tasks = []
+    for cod_file_path in cod_file_paths:
+        predictand = CoD.get_components_from_path(cod_file_path)[4]
+        tasks.append({'cod_file': cod_file_path,
+                      'output_file': output_name(output_dir, cod_file_path),
+                      'region': region,
+                      'band': None,
+                      'bytes': month_count(cod_file_path) * month_bytes(extractor.awap_manager, predictand)})
+
+    shards = balance([task['bytes'] for task in tasks], nshards)
+    return {'shards': [[tasks[i] for i in sorted(shard)] for shard in shards],
+            'merges': []}
+
+
+def plan_bands(extractor, cod_file_path, output_file, nshards, region=None):
+    """ A plan of the extraction of a CoD file in nshards latitude bands, merged into output_file
+    """
+    cod_file_path = plan_path(cod_file_path)
+    output_file = plan_path(output_file)
+    region = plan_region(region)
+    model, scenario, region_type, season, predictand = CoD.get_components_from_path(cod_file_path)
+    mask = extractor.mask_manager.read_mask(region or region_type)
+    nbytes = month_count(cod_file_path) * month_bytes(extractor.awap_manager, predictand)
+
+    shards = []
+    for i, band in enumerate(latitude_bands(mask, nshards)):
+        shards.append([{'cod_file': cod_file_path,
+                        'output_file': band_name(output_file, i),
+                        'region': region,
+                        'band': band,
+                        'bytes': nbytes}])
+
+    return {'shards': shards,
+            'merges': [{'output_file': output_file,
+                        'cod_file': cod_file_path,
+                        'region': region,
+                        'band_files': [shard[0]['output_file'] for shard in shards]}]}
+
+
+def save_plan(plan_file, plan):
+    with open(plan_file, 'w') as f:
+        json.dump(plan, f, indent=1, sort_keys=True)
+
+
+def plain_strings(obj):
+    """ The loaded JSON object with unicode strings as plain strings, as netCDF attributes need
+    """
+    if isinstance(obj, dict):
+        return dict((str(key), plain_strings(value)) for key, value in obj.items())
+    elif isinstance(obj, list):
+        return [plain_strings(value) for value in obj]
+    elif isinstance(obj, basestring):
+        return str(obj)
+    return obj
+
+
+def load_plan(plan_file):
+    with open(plan_file) as f:
+        return plain_strings(json.load(f))
+
+
+def shard_index_from_env():
+    for name in ARRAY_INDEX_VARIABLES:
+        if name in os.environ:
+            return int(os.environ[name])
+    raise ValueError('No shard number given and none of %s is set' % ', '.join(ARRAY_INDEX_VARIABLES))
+
+
+def run_shard(plan, shard_index, extractor, verbose=False):
+    """ Run the tasks of a shard of the plan, returning the output files
+    """
+    ret = []
+    if shard_index >= len(plan['shards']):
+        # A plan of latitude bands may have fewer shards than asked for.
+        return ret
+    for task in plan['shards'][shard_index]:
+        model, scenario, region_type, season, predictand = CoD.get_components_from_path(task['cod_file'])
+        if verbose:
+            print 'shard %d: %s -> %s' % (shard_index, task['cod_file'], task['output_file'])
+        data, dates, lat, lon = extractor.extract(model, scenario, region_type, season, predictand,
+                                                  task['region'], band=task['band'])
+        extractor.save_netcdf(task['output_file'], data, dates, lat, lon,
+                              model, scenario, region_type, season, predictand, task['region'],
+                              resolution=extractor.awap_manager.resolution)
+        ret.append(task['output_file'])
+    return ret
+
+
+def merge_bands(merge, extractor, remove=False, verbose=False, chunk_bytes=MERGE_CHUNK_BYTES):
+    """ Assemble the band outputs of a merge of the plan into the final output file
+
+    Only the band outputs are read. Each band is placed on the grid enclosing
+    all of them by its coordinates. The records of the output are written in
+    place a chunk of time steps at a time, of about chunk_bytes, so the whole
+    output is never held in memory.
+    """
+    model, scenario, region_type, season, predictand = CoD.get_components_from_path(merge['cod_file'])
+    bands = []
+    days = None
+    for band_file in merge['band_files']:
+        band_days = ncio.read_variable(band_file, 'time')
+        if days is None:
+            days = band_days
+        elif not np.array_equal(band_days, days):
+            raise ValueError('%s is not on the time axis of the other bands' % band_file)
+        bands.append((band_file, ncio.read_variable(band_file, 'lat'), ncio.read_variable(band_file, 'lon')))
+
+    grid_lat = extractor.awap_manager.lat
+    grid_lon = extractor.awap_manager.lon
+    lat = grid_lat[np.searchsorted(grid_lat, min(b[1][0] for b in bands) - 1e-6):
+                   np.searchsorted(grid_lat, max(b[1][-1] for b in bands) + 1e-6)]
+    lon = grid_lon[np.searchsorted(grid_lon, min(b[2][0] for b in bands) - 1e-6):
+                   np.searchsorted(grid_lon, max(b[2][-1] for b in bands) + 1e-6)]
+
+    dates = CoD.read(merge['cod_file'])['rdates']
+    begin, record_size = extractor.create_records_netcdf(merge['output_file'], dates, lat, lon, model, scenario,
+                                                         region_type, season, predictand, merge['region'],
+                                                         extractor.awap_manager.resolution)
+    chunk_steps = max(1, chunk_bytes // (lat.size * lon.size * 4))
+    days = days.astype('>f4')
+    with ncio.FilePool(max_open=len(bands)) as pool, open(merge['output_file'], 'r+b') as output:
+        for start in range(0, days.size, chunk_steps):
+            steps = np.arange(start, min(start + chunk_steps, days.size))
+            data = np.empty((steps.size, lat.size, lon.size), dtype=np.float32)
+            data[:] = np.NaN
+            for band_file, band_lat, band_lon in bands:
+                if verbose and start == 0:
+                    print 'reading band file: %s' % band_file
+                y = np.searchsorted(lat, band_lat[0] - 1e-6)
+                x = np.searchsorted(lon, band_lon[0] - 1e-6)
+                data[:, y:y + band_lat.size, x:x + band_lon.size] = ncio.read_variable(
+                    band_file, predictand, slice(steps[0], steps[-1] + 1), pool=pool, fill_nan=True)
+            data[np.isnan(data)] = MISSING_VALUE
+            extractor.write_records(output, begin, record_size, days, [(steps, data)])
+        extractor.write_record_count(output, days.size)
+
+    if remove:
+        for band_file in merge['band_files']:
+            os.remove(band_file)
+
+    return merge['output_file']
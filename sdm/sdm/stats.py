@@ -0,0 +1,222 @@
+"""
+Per-cell summary statistics of a DXT output file
+
+One streaming pass over the (time, lat, lon) output cube accumulates, for
+every grid cell, the annual and seasonal means and a fixed-bin histogram
+from which percentiles are interpolated. The results are stored in a
+small side-car NetCDF file (<output>.stats.nc), so the web endpoints can
+look up the statistics of a cell instead of scanning its whole series.
+"""
+from datetime import date
+
+import numpy as np
+from scipy.io import netcdf
+
+from . import ncio
+
+# Season numbers as used by the CoD files, 0 is the whole year.
+SEASON_NAMES = ['ann', 'DJF', 'MAM', 'JJA', 'SON']
+MONTH_SEASONS = np.array([1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 4, 1])
+
+PERCENTILES = [1, 5, 10, 25, 50, 75, 90, 95, 99]
+
+# Histogram bin edges of each predictand (mm, K). Values beyond the
+# edges are counted in the first or last bin.
+BIN_EDGES = {
+    'rain': np.arange(0.0, 201.0, 1.0),
+    'tmax': np.arange(230.0, 330.5, 0.5),
+    'tmin': np.arange(220.0, 320.5, 0.5),
+}
+
+# Cells whose histograms are counted at once, to bound the memory used.
+MAX_BLOCK_BINS = 4 * 1024 * 1024
+
+
+def stats_file_path(output_file):
+    return output_file + '.stats.nc'
+
+
+class StatsAccumulator(object):
+    def __init__(self, predictand, ncells, edges=None):
+        self.predictand = predictand
+        self.edges = BIN_EDGES[predictand] if edges is None else np.asarray(edges)
+        self.ncells = ncells
+        nbins = self.edges.size - 1
+        self.sums = np.zeros((len(SEASON_NAMES), ncells))
+        self.counts = np.zeros((len(SEASON_NAMES), ncells), dtype=np.int32)
+        self.hist = np.zeros((nbins, ncells), dtype=np.int32)
+
+    def update(self, seasons, data):
+        """ Add a chunk of data of shape (ndays, ncells) with the season number of each day
+        """
+        valid = ~np.isnan(data)
+        values = np.where(valid, data, 0.0)
+
+        self.sums[0] += values.sum(axis=0)
+        self.counts[0] += valid.sum(axis=0)
+        for season in range(1, len(SEASON_NAMES)):
+            in_season = seasons == season
+            if np.any(in_season):
+                self.sums[season] += values[in_season].sum(axis=0)
+                self.counts[season] += valid[in_season].sum(axis=0)
+
+        nbins = self.hist.shape[0]
+        bins = np.clip(np.searchsorted(self.edges, data, side='right') - 1, 0, nbins - 1)
+        # Missing values are counted in an extra bin, then dropped.
+        bins[~valid] = nbins
+
+        block = max(1, MAX_BLOCK_BINS // (nbins + 1))
+        for start in range(0, self.ncells, block):
+            stop = min(start + block, self.ncells)
+            cells = np.arange(stop - start)
+            flat = (bins[:, start:stop] * (stop - start) + cells).ravel()
+            counts = np.bincount(flat, minlength=(nbins + 1) * (stop - start))
+            self.hist[:, start:stop] += counts.reshape(nbins + 1, stop - start)[:nbins].astype(np.int32)
+
+    def means(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.counts > 0, self.sums / self.counts, np.NaN)
+
+    def percentiles(self, percentiles=PERCENTILES):
+        return histogram_percentiles(self.hist, self.edges, percentiles)
+
+
+def histogram_percentiles(hist, edges, percentiles):
+    """ Percentiles of each column of hist (nbins, ncells), interpolated linearly within bins
+    """
+    cumulative = np.cumsum(hist, axis=0).astype(float)
+    total = cumulative[-1]
+    cells = np.arange(hist.shape[1])
+    ret = np.empty((len(percentiles), hist.shape[1]))
+    for i, p in enumerate(percentiles):
+        target = total * p / 100.0
+        # The first bin whose cumulative count reaches the target.
+        idx = np.minimum((cumulative < target).sum(axis=0), hist.shape[0] - 1)
+        below = np.where(idx > 0, cumulative[np.maximum(idx - 1, 0), cells], 0.0)
+        in_bin = hist[idx, cells]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(in_bin > 0, (target - below) / in_bin, 0.0)
+        ret[i] = edges[idx] + fraction * (edges[idx + 1] - edges[idx])
+        ret[i][total == 0] = np.NaN
+    return ret
+
+
+def days_to_seasons(days, base='1899-12-31'):
+    """ Season number of each time value in days since base
+    """
+    months = (np.datetime64(base, 'D') + np.asarray(days).astype(int)).astype('datetime64[M]')
+    return MONTH_SEASONS[months.astype(int) % 12]
+
+
+def find_predictand(ncd_file):
+    for name in ('rain', 'tmax', 'tmin'):
+        if name in ncd_file.variables:
+            return name
+    raise ValueError('No rain, tmax or tmin variable in the file')
+
+
+def compute_stats(output_file, stats_file=None, chunk_size=366, verbose=False):
+    """ Compute the statistics of a DXT output file in one pass and save them
+    """
+    stats_file = stats_file or stats_file_path(output_file)
+    ncd_file = netcdf.netcdf_file(output_file, mmap=True)
+    try:
+        predictand = find_predictand(ncd_file)
+        var = ncd_file.variables[predictand]
+        ntime, nlat, nlon = var.shape
+        missing_value = var.missing_value
+        days = ncd_file.variables['time'].data.copy()
+        seasons = days_to_seasons(days)
+        lat = ncd_file.variables['lat'].data.copy()
+        lon = ncd_file.variables['lon'].data.copy()
+
+        acc = StatsAccumulator(predictand, nlat * nlon)
+        for start in range(0, ntime, chunk_size):
+            stop = min(start + chunk_size, ntime)
+            if verbose:
+                print 'accumulating days %d to %d of %d' % (start, stop, ntime)
+            data = var.data[start:stop].reshape(stop - start, nlat * nlon)
+            data = np.where(data == missing_value, np.NaN, data)
+            acc.update(seasons[start:stop], data)
+        # Drop the references to the mapped data so the file can close.
+        del var
+    finally:
+        ncd_file.close()
+
+    save_stats(stats_file, acc, lat, lon, days)
+    return stats_file
+
+
+def save_stats(filename, acc, lat, lon, days):
+    shape = (lat.size, lon.size)
+    f = netcdf.netcdf_file(filename, 'w')
+    f.title = 'Per-cell statistics of %s' % acc.predictand
+    f.source = 'Statistical Downscaling Model'
+    f.history = 'Generated on %s' % date.today()
+    f.first_day = float(days[0]) if days.size else 0.0
+    f.last_day = float(days[-1]) if days.size else 0.0
+    f.time_units = 'days since 1899-12-31 00:00:00'
+
+    f.createDimension('lat', lat.size)
+    var_lat = f.createVariable('lat', float, ('lat',))
+    var_lat[:] = lat
+    var_lat.units = 'degrees_north'
+    f.createDimension('lon', lon.size)
+    var_lon = f.createVariable('lon', float, ('lon',))
+    var_lon[:] = lon
+    var_lon.units = 'degrees_east'
+
+    f.createDimension('season', len(SEASON_NAMES))
+    var_season = f.createVariable('season', np.int32, ('season',))
+    var_season[:] = np.arange(len(SEASON_NAMES))
+    var_season.flag_meanings = ' '.join(SEASON_NAMES)
+
+    f.createDimension('percentile', len(PERCENTILES))
+    var_pct = f.createVariable('percentile', float, ('percentile',))
+    var_pct[:] = PERCENTILES
+
+    f.createDimension('bin', acc.hist.shape[0])
+    f.createDimension('bin_edge', acc.edges.size)
+    var_edges = f.createVariable('bin_edges', float, ('bin_edge',))
+    var_edges[:] = acc.edges
+    var_edges.comment = 'values beyond the edges are counted in the first or last bin'
+
+    missing_value = 99999.9
+    for name, values, dim, dtype in [('mean', acc.means(), 'season', np.float32),
+                                     ('count', acc.counts, 'season', np.int32),
+                                     ('percentiles', acc.percentiles(), 'percentile', np.float32),
+                                     ('histogram', acc.hist, 'bin', np.int32)]:
+        var = f.createVariable('%s_%s' % (acc.predictand, name), dtype, (dim, 'lat', 'lon'))
+        values = values.reshape((values.shape[0],) + shape)
+        if dtype == np.float32:
+            values = np.where(np.isnan(values), missing_value, values)
+            var.missing_value = var._FillValue = missing_value
+        var[:] = values
+
+    f.close()
+
+
+def read_cell_stats(stats_file, y, x):
+    """ The statistics of one grid cell from a side-car file
+
+    'percentiles' holds the values of the cell at the levels of 'percentile_levels'.
+    """
+    with ncio.open_file(stats_file) as f:
+        predictand = find_predictand_stats(f)
+        ret = {
+            'predictand': predictand,
+            'first_day': f.first_day,
+            'last_day': f.last_day,
+            'bin_edges': ncio.take(f.variables['bin_edges']),
+            'percentile_levels': ncio.take(f.variables['percentile']),
+        }
+        for name in ('mean', 'count', 'percentiles', 'histogram'):
+            ret[name] = ncio.take(f.variables['%s_%s' % (predictand, name)], (slice(None), y, x), fill_nan=True)
+    return ret
+
+
+def find_predictand_stats(ncd_file):
+    for name in ('rain', 'tmax', 'tmin'):
+        if '%s_histogram' % name in ncd_file.variables:
+            return name
+    raise ValueError('Not a statistics file')
@@ -9,7 +9,14 @@ import argparse
 
 from sdm import __version__
 from sdm.cod import CoD
-from sdm.extractor import GriddedExtractor
+from sdm.extractor import GriddedExtractor, AGGREGATION_PERIODS, AGGREGATION_STATISTICS, REGIONAL_STATISTICS
+from sdm.stats import compute_stats, stats_file_path
+from sdm.analog_index import load_or_build, output_resolution, update_output
+from sdm import shard
+from sdm.ncio import FilePool
+from sdm.planner import parse_memory, plan_extraction, format_plan
+from sdm.gridded import AwapDailyData
+from sdm.pyramid import BASE_RESOLUTION, RESOLUTIONS, build_pyramid
 
 
 def read_config(config_file):
@@ -26,6 +33,20 @@ def read_config(config_file):
     return config
 
 
+def get_mask_cache_dir(config):
+    if config.has_option('dxt', 'mask_cache_dir'):
+        return config.get('dxt', 'mask_cache_dir')
+    return None
+
+
+def get_index_file(config, index_file=None):
+    if index_file:
+        return index_file
+    if config.has_option('dxt', 'analog_index_file'):
+        return config.get('dxt', 'analog_index_file')
+    return os.path.join(os.path.expanduser('~'), '.sdm_analog_index.npz')
+
+
 def main(args):
     ap = argparse.ArgumentParser(prog=os.path.basename(__file__),
                                  formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -75,7 +96,57 @@ def main(args):
                                     help='output netCDF file name')
     dxt_gridded_parser.add_argument('-R', '--region',
                                     required=False,
-                                    help='the region where the data are to be extracted')
+                                    help='the region where the data are to be extracted, '
+                                         'or a GeoJSON file or shapefile (.shp) of its polygons')
+    dxt_gridded_parser.add_argument('--start-date',
+                                    required=False,
+                                    help='first date (yyyy, yyyy-mm or yyyy-mm-dd) of the series to extract')
+    dxt_gridded_parser.add_argument('--end-date',
+                                    required=False,
+                                    help='last date (yyyy, yyyy-mm or yyyy-mm-dd) of the series to extract')
+    dxt_gridded_parser.add_argument('--months',
+                                    nargs='+',
+                                    type=int,
+                                    required=False,
+                                    help='months of year (1-12) of the series to extract')
+    dxt_gridded_parser.add_argument('--aggregate',
+                                    required=False,
+                                    choices=AGGREGATION_PERIODS,
+                                    help='save the monthly, seasonal or yearly statistic instead of the daily series')
+    dxt_gridded_parser.add_argument('--statistic',
+                                    required=False,
+                                    choices=AGGREGATION_STATISTICS,
+                                    default='mean',
+                                    help='the statistic of --aggregate (default to mean)')
+    dxt_gridded_parser.add_argument('--regional-stats',
+                                    nargs='+',
+                                    required=False,
+                                    choices=REGIONAL_STATISTICS,
+                                    help='save daily series of these statistics over the region instead of the gridded data; '
+                                         'the mean is weighted by the cosine of latitude')
+    dxt_gridded_parser.add_argument('--percentiles',
+                                    nargs='+',
+                                    type=float,
+                                    required=False,
+                                    help='also save daily series of these percentiles of the grid point values over the region')
+    dxt_gridded_parser.add_argument('--max-memory',
+                                    required=False,
+                                    help='memory budget, e.g. 500M or 8G: the data type, and whether to stream the output '
+                                         'a number of months at a time, are chosen to fit it')
+    dxt_gridded_parser.add_argument('--dry-run',
+                                    action='store_true',
+                                    default=False,
+                                    help='print the plan of the extraction, with its memory and bytes read, and exit')
+    dxt_gridded_parser.add_argument('--resolution',
+                                    required=False,
+                                    choices=RESOLUTIONS,
+                                    default=BASE_RESOLUTION,
+                                    help='grid resolution in degrees (default to %(default)s); coarser ones read the AWAP files '
+                                         'built by awap-pyramid, for quick previews')
+    dxt_gridded_parser.add_argument('--stats',
+                                    action='store_true',
+                                    default=False,
+                                    help='also save per-cell statistics to OUTPUT_FILE.stats.nc')
 
     dxt_gridded2_parser = subparsers.add_parser('dxt-gridded2',
                                                 help='extract gridded data with the given parameters')
@@ -98,7 +169,182 @@ def main(args):
                                      help='predictand name, e.g. rain, tmax, tmin')
     dxt_gridded2_parser.add_argument('-R', '--region',
                                      required=False,
-                                     help='the region where the data are to be extracted (default to region-type)')
+                                     help='the region where the data are to be extracted (default to region-type), '
+                                          'or a GeoJSON file or shapefile (.shp) of its polygons')
+    dxt_gridded2_parser.add_argument('--start-date',
+                                     required=False,
+                                     help='first date (yyyy, yyyy-mm or yyyy-mm-dd) of the series to extract')
+    dxt_gridded2_parser.add_argument('--end-date',
+                                     required=False,
+                                     help='last date (yyyy, yyyy-mm or yyyy-mm-dd) of the series to extract')
+    dxt_gridded2_parser.add_argument('--months',
+                                     nargs='+',
+                                     type=int,
+                                     required=False,
+                                     help='months of year (1-12) of the series to extract')
+    dxt_gridded2_parser.add_argument('--aggregate',
+                                     required=False,
+                                     choices=AGGREGATION_PERIODS,
+                                     help='save the monthly, seasonal or yearly statistic instead of the daily series')
+    dxt_gridded2_parser.add_argument('--statistic',
+                                     required=False,
+                                     choices=AGGREGATION_STATISTICS,
+                                     default='mean',
+                                     help='the statistic of --aggregate (default to mean)')
+    dxt_gridded2_parser.add_argument('--regional-stats',
+                                     nargs='+',
+                                     required=False,
+                                     choices=REGIONAL_STATISTICS,
+                                     help='save daily series of these statistics over the region instead of the gridded data; '
+                                          'the mean is weighted by the cosine of latitude')
+    dxt_gridded2_parser.add_argument('--percentiles',
+                                     nargs='+',
+                                     type=float,
+                                     required=False,
+                                     help='also save daily series of these percentiles of the grid point values over the region')
+    dxt_gridded2_parser.add_argument('--max-memory',
+                                     required=False,
+                                     help='memory budget, e.g. 500M or 8G: the data type, and whether to stream the output '
+                                          'a number of months at a time, are chosen to fit it')
+    dxt_gridded2_parser.add_argument('--dry-run',
+                                     action='store_true',
+                                     default=False,
+                                     help='print the plan of the extraction, with its memory and bytes read, and exit')
+    dxt_gridded2_parser.add_argument('--resolution',
+                                     required=False,
+                                     choices=RESOLUTIONS,
+                                     default=BASE_RESOLUTION,
+                                     help='grid resolution in degrees (default to %(default)s); coarser ones read the AWAP files '
+                                          'built by awap-pyramid, for quick previews')
+    dxt_gridded2_parser.add_argument('--stats',
+                                     action='store_true',
+                                     default=False,
+                                     help='also save per-cell statistics to OUTPUT_FILE.stats.nc')
+
+    dxt_stats_parser = subparsers.add_parser('dxt-stats',
+                                             help='calculate per-cell statistics of an extracted netCDF file')
+    dxt_stats_parser.add_argument('output_file',
+                                  help='netCDF file saved by dxt-gridded or dxt-gridded2')
+    dxt_stats_parser.add_argument('-o', '--stats-file',
+                                  required=False,
+                                  help='statistics file name (default to OUTPUT_FILE.stats.nc)')
+
+    cod_index_parser = subparsers.add_parser('cod-index',
+                                             help='build or refresh the index of the AWAP days used by all CoD files')
+    cod_index_parser.add_argument('-i', '--index-file',
+                                  required=False,
+                                  help='index file name (default to analog_index_file of the configuration, '
+                                       'or "$HOME/.sdm_analog_index.npz")')
+    cod_index_parser.add_argument('-d', '--days',
+                                  nargs='+',
+                                  type=int,
+                                  required=False,
+                                  help='list the CoD files and number of rows that use these days (yyyymmdd)')
+    cod_index_parser.add_argument('-M', '--months',
+                                  nargs='+',
+                                  type=int,
+                                  required=False,
+                                  help='list the CoD files and number of rows that use these months (yyyymm)')
+
+    dxt_update_parser = subparsers.add_parser('dxt-update',
+                                              help='re-extract the time steps of output files that use revised AWAP data')
+    dxt_update_parser.add_argument('output_files',
+                                   nargs='+',
+                                   help='netCDF files saved by dxt-gridded or dxt-gridded2')
+    dxt_update_parser.add_argument('-i', '--index-file',
+                                   required=False,
+                                   help='index file name (as for cod-index)')
+    dxt_update_parser.add_argument('-d', '--days',
+                                   nargs='+',
+                                   type=int,
+                                   required=False,
+                                   help='revised AWAP days (yyyymmdd)')
+    dxt_update_parser.add_argument('-M', '--months',
+                                   nargs='+',
+                                   type=int,
+                                   required=False,
+                                   help='revised or appended AWAP months (yyyymm)')
+
+    shard_plan_parser = subparsers.add_parser('shard-plan',
+                                              help='split extractions into balanced shards for a job array')
+    shard_plan_parser.add_argument('plan_file',
+                                   help='the plan (JSON) file to write')
+    shard_plan_parser.add_argument('-n', '--shards',
+                                   type=int,
+                                   required=True,
+                                   help='number of shards, i.e. job array elements')
+    shard_plan_parser.add_argument('-o', '--output-dir',
+                                   default='.',
+                                   help='directory of the output files of the CoD files (default to ".")')
+    shard_plan_parser.add_argument('-m', '--models',
+                                   nargs='+',
+                                   required=False,
+                                   help='model names (default to all)')
+    shard_plan_parser.add_argument('-c', '--scenarios',
+                                   nargs='+',
+                                   required=False,
+                                   help='scenario names (default to all)')
+    shard_plan_parser.add_argument('-r', '--region-types',
+                                   nargs='+',
+                                   required=False,
+                                   help='region type names (default to all)')
+    shard_plan_parser.add_argument('-s', '--seasons',
+                                   nargs='+',
+                                   required=False,
+                                   help='season numbers (default to all)')
+    shard_plan_parser.add_argument('-p', '--predictands',
+                                   nargs='+',
+                                   required=False,
+                                   help='predictand names (default to all)')
+    shard_plan_parser.add_argument('-R', '--region',
+                                   required=False,
+                                   help='the region where the data are to be extracted (default to region-type)')
+    shard_plan_parser.add_argument('--bands',
+                                   metavar='OUTPUT_FILE',
+                                   required=False,
+                                   help='split the single selected CoD file into latitude bands instead, '
+                                        'to be merged into OUTPUT_FILE by shard-merge')
+
+    shard_run_parser = subparsers.add_parser('shard-run',
+                                             help='run one shard of a plan')
+    shard_run_parser.add_argument('plan_file',
+                                  help='the plan file written by shard-plan')
+    shard_run_parser.add_argument('shard',
+                                  type=int,
+                                  nargs='?',
+                                  help='shard number, from 0 (default to $PBS_ARRAY_INDEX)')
+
+    shard_merge_parser = subparsers.add_parser('shard-merge',
+                                               help='merge the latitude band outputs of a plan')
+    shard_merge_parser.add_argument('plan_file',
+                                    help='the plan file written by shard-plan')
+    shard_merge_parser.add_argument('--remove',
+                                    action='store_true',
+                                    default=False,
+                                    help='remove the band files once merged')
+
+    awap_pyramid_parser = subparsers.add_parser('awap-pyramid',
+                                                help='build coarser copies of the AWAP daily files for previews')
+    awap_pyramid_parser.add_argument('-p', '--predictands',
+                                     nargs='+',
+                                     required=False,
+                                     default=['rain', 'tmax', 'tmin'],
+                                     help='predictands to coarsen (default to rain tmax tmin)')
+    awap_pyramid_parser.add_argument('--resolutions',
+                                     nargs='+',
+                                     required=False,
+                                     choices=RESOLUTIONS[1:],
+                                     default=list(RESOLUTIONS[1:]),
+                                     help='resolutions in degrees to build (default to all)')
+    awap_pyramid_parser.add_argument('-M', '--months',
+                                     nargs='+',
+                                     type=int,
+                                     required=False,
+                                     help='months (yyyymm) to coarsen (default to all)')
+    awap_pyramid_parser.add_argument('--overwrite',
+                                     action='store_true',
+                                     default=False,
+                                     help='coarsen again the months that are up to date')
 
     ns = ap.parse_args(args)
 
@@ -112,7 +358,9 @@ def main(args):
         gridded_extractor = GriddedExtractor(cod_base_dir=config.get('dxt', 'cod_base_dir'),
                                              mask_base_dir=config.get('dxt', 'mask_base_dir'),
                                              gridded_base_dir=config.get('dxt', 'gridded_base_dir'),
-                                             verbose=ns.verbose)
+                                             verbose=ns.verbose,
+                                             mask_cache_dir=get_mask_cache_dir(config),
+                                             resolution=ns.resolution)
 
         if ns.sub_command == 'dxt-gridded':
             model, scenario, region_type, season, predictand = CoD.get_components_from_path(ns.cod_file_path)
@@ -120,10 +368,139 @@ def main(args):
             model, scenario, region_type, season, predictand = \
                 ns.model, ns.scenario, ns.region_type, ns.season, ns.predictand
 
-        data, dates, lat, lon = gridded_extractor.extract(model, scenario, region_type, season, predictand,
-                                                          ns.region)
+        window = dict(start_date=CoD.date_code(ns.start_date) if ns.start_date else None,
+                      end_date=CoD.date_code(ns.end_date, end=True) if ns.end_date else None,
+                      months=ns.months)
+        if ns.regional_stats or ns.percentiles:
+            if ns.aggregate or ns.stats or ns.max_memory or ns.dry_run:
+                ap.error('--regional-stats and --percentiles cannot be used with --aggregate, --stats, '
+                         '--max-memory or --dry-run')
+            series, dates = gridded_extractor.regional_series(
+                model, scenario, region_type, season, predictand, ns.region,
+                statistics=ns.regional_stats or (), percentiles=ns.percentiles or (), **window)
+            GriddedExtractor.save_series_netcdf(ns.output_file, series, dates,
+                                                model, scenario, region_type, season, predictand, ns.region,
+                                                resolution=ns.resolution)
+            return
+
+        if ns.max_memory or ns.dry_run:
+            if ns.aggregate:
+                ap.error('--max-memory and --dry-run cannot be used with --aggregate')
+            plan = plan_extraction(gridded_extractor, model, scenario, region_type, season, predictand,
+                                   ns.region, max_memory=parse_memory(ns.max_memory) if ns.max_memory else None,
+                                   **window)
+            if ns.dry_run:
+                print format_plan(plan)
+                return
+            if ns.verbose:
+                print format_plan(plan)
+            if plan['mode'] == 'streaming':
+                gridded_extractor.extract_to_netcdf(ns.output_file, model, scenario, region_type, season,
+                                                    predictand, ns.region, chunk_months=plan['chunk_months'],
+                                                    **window)
+                if ns.stats:
+                    compute_stats(ns.output_file, verbose=ns.verbose)
+                return
+            window['dtype'] = plan['dtype']
+
+        if ns.aggregate:
+            aggregation = (ns.aggregate, ns.statistic)
+            data, dates, lat, lon = gridded_extractor.aggregate(
+                model, scenario, region_type, season, predictand, ns.region,
+                period=ns.aggregate, statistic=ns.statistic, **window)
+        else:
+            aggregation = None
+            data, dates, lat, lon = gridded_extractor.extract(
+                model, scenario, region_type, season, predictand, ns.region, **window)
         GriddedExtractor.save_netcdf(ns.output_file, data, dates, lat, lon,
-                                     model, scenario, region_type, season, predictand)
+                                     model, scenario, region_type, season, predictand, ns.region,
+                                     aggregation=aggregation, resolution=ns.resolution)
+        if ns.stats:
+            compute_stats(ns.output_file, verbose=ns.verbose)
+
+    elif ns.sub_command == 'dxt-stats':
+        print compute_stats(ns.output_file, ns.stats_file, verbose=ns.verbose)
+
+    elif ns.sub_command == 'cod-index':
+        index = load_or_build(get_index_file(config, ns.index_file), config.get('dxt', 'cod_base_dir'),
+                              verbose=ns.verbose)
+        if ns.days or ns.months:
+            for cod_file_path, rows in sorted(index.lookup(ns.days, ns.months).items()):
+                print '%d %s' % (rows.size, cod_file_path)
+        else:
+            print index
+
+    elif ns.sub_command == 'dxt-update':
+        if not (ns.days or ns.months):
+            ap.error('dxt-update needs the revised --days or --months')
+        index = load_or_build(get_index_file(config, ns.index_file), config.get('dxt', 'cod_base_dir'),
+                              verbose=ns.verbose)
+        # The output files mostly use the same revised months, which are kept open.
+        with FilePool() as pool:
+            # An extractor on the grid of each resolution the outputs were saved at
+            gridded_extractors = {}
+            for output_file in ns.output_files:
+                resolution = output_resolution(output_file)
+                if resolution not in gridded_extractors:
+                    gridded_extractors[resolution] = GriddedExtractor(
+                        cod_base_dir=config.get('dxt', 'cod_base_dir'),
+                        mask_base_dir=config.get('dxt', 'mask_base_dir'),
+                        gridded_base_dir=config.get('dxt', 'gridded_base_dir'),
+                        verbose=ns.verbose,
+                        mask_cache_dir=get_mask_cache_dir(config),
+                        pool=pool,
+                        resolution=resolution)
+                nsteps = update_output(output_file, index, gridded_extractors[resolution], ns.days, ns.months,
+                                       verbose=ns.verbose)
+                print '%d %s' % (nsteps, output_file)
+                # Statistics saved with --stats would no longer match the data.
+                if nsteps and os.path.isfile(stats_file_path(output_file)):
+                    compute_stats(output_file, verbose=ns.verbose)
+
+    elif ns.sub_command in ('shard-plan', 'shard-run', 'shard-merge'):
+        gridded_extractor = GriddedExtractor(cod_base_dir=config.get('dxt', 'cod_base_dir'),
+                                             mask_base_dir=config.get('dxt', 'mask_base_dir'),
+                                             gridded_base_dir=config.get('dxt', 'gridded_base_dir'),
+                                             verbose=ns.verbose,
+                                             mask_cache_dir=get_mask_cache_dir(config))
+
+        if ns.sub_command == 'shard-plan':
+            cod_file_paths = shard.job_matrix(config.get('dxt', 'cod_base_dir'), ns.models, ns.scenarios,
+                                              ns.region_types, ns.seasons, ns.predictands)
+            if not cod_file_paths:
+                ap.error('no CoD files are selected')
+            if ns.bands:
+                if len(cod_file_paths) != 1:
+                    ap.error('--bands needs a single CoD file to be selected, not %d' % len(cod_file_paths))
+                plan = shard.plan_bands(gridded_extractor, cod_file_paths[0], ns.bands, ns.shards, ns.region)
+            else:
+                plan = shard.plan_jobs(gridded_extractor, cod_file_paths, ns.output_dir, ns.shards, ns.region)
+            shard.save_plan(ns.plan_file, plan)
+            for i, tasks in enumerate(plan['shards']):
+                print 'shard %d: %d tasks, %.1f GB to read' % (
+                    i, len(tasks), sum(task['bytes'] for task in tasks) / 1e9)
+
+        elif ns.sub_command == 'shard-run':
+            plan = shard.load_plan(ns.plan_file)
+            shard_index = shard.shard_index_from_env() if ns.shard is None else ns.shard
+            # The tasks of a shard share AWAP months, which are kept open between them.
+            with FilePool() as pool:
+                gridded_extractor.awap_manager.pool = pool
+                for output_file in shard.run_shard(plan, shard_index, gridded_extractor, verbose=ns.verbose):
+                    print output_file
+
+        else:
+            plan = shard.load_plan(ns.plan_file)
+            for merge in plan['merges']:
+                print shard.merge_bands(merge, gridded_extractor, remove=ns.remove, verbose=ns.verbose)
+
+    elif ns.sub_command == 'awap-pyramid':
+        gridded_base_dir = config.get('dxt', 'gridded_base_dir')
+        source = AwapDailyData(base_dir=gridded_base_dir, verbose=ns.verbose)
+        targets = [AwapDailyData(base_dir=gridded_base_dir, resolution=resolution) for resolution in ns.resolutions]
+        written = build_pyramid(source, targets, ns.predictands, ns.months, overwrite=ns.overwrite,
+                                verbose=ns.verbose)
+        print '%d files written' % len(written)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pytest
+from scipy.io import netcdf
+
+from sdm.extractor import GriddedExtractor
+
+# The CoD file of the awap_extractor fixture, with rdates across the turn of
+# a year and analog days used again and again.
+COD_ROWS = [(991230, 600101), (991231, 600102), (1000101, 600101), (1000102, 600203), (1000115, 600101),
+            (1000201, 600102), (1000202, 600102), (1000301, 600204), (1000302, 600203), (1000401, 600101)]
+
+COMPONENTS = ('A', 'historical', 'reg', 1, 'rain')
+
+AWAP_MISSING_VALUE = -999.0
+
+
+def write_awap_month(awap_manager, year, month, data):
+    file_path, var_code = awap_manager.get_file_path('rain', year, month)
+    if not os.path.isdir(os.path.dirname(file_path)):
+        os.makedirs(os.path.dirname(file_path))
+    f = netcdf.netcdf_file(file_path, 'w')
+    f.createDimension('time', data.shape[0])
+    f.createDimension('lat', data.shape[1])
+    f.createDimension('lon', data.shape[2])
+    var = f.createVariable(var_code, np.float32, ('time', 'lat', 'lon'))
+    var[:] = np.where(np.isnan(data), AWAP_MISSING_VALUE, data)
+    var.missing_value = np.float32(AWAP_MISSING_VALUE)
+    f.close()
+
+
+def awap_month_data(awap_manager, seed):
+    """ 4 days of random data on the grid, missing on land cell (11, 21) and at two cells of the second day
+    """
+    data = np.random.RandomState(seed).rand(4, awap_manager.lat.size, awap_manager.lon.size) * 10
+    data[:, 11, 21] = np.NaN
+    data[1, 12, 22:24] = np.NaN
+    return data.astype(np.float32)
+
+
+@pytest.fixture
+def awap_extractor(tmpdir):
+    """ A GriddedExtractor at 0.5 degree of AWAP months 196001 and 196002, mask_reg and the CoD file of COD_ROWS
+
+    The region is the 0.5 degree cells (10:13, 20:24) less (10, 20).
+    """
+    extractor = GriddedExtractor(cod_base_dir=str(tmpdir.join('cod')), mask_base_dir=str(tmpdir),
+                                 gridded_base_dir=str(tmpdir.join('awap')), resolution='0.5')
+
+    for month in (1, 2):
+        write_awap_month(extractor.awap_manager, 1960, month, awap_month_data(extractor.awap_manager, month))
+
+    # Masks are on the 0.05 degree grid.
+    mask = np.zeros((691, 886), dtype=np.int32)
+    mask[100:130, 200:240] = 1
+    mask[100:110, 200:210] = 0
+    f = netcdf.netcdf_file(str(tmpdir.join('mask_reg.nc')), 'w')
+    f.createDimension('lat', mask.shape[0])
+    f.createDimension('lon', mask.shape[1])
+    f.createVariable('mask', np.int32, ('lat', 'lon'))[:] = mask
+    f.close()
+
+    cod_file_path = extractor.cod_manager.get_cod_file_path(*COMPONENTS)
+    os.makedirs(os.path.dirname(cod_file_path))
+    with open(cod_file_path, 'w') as f:
+        f.write('rawfield analog 1\n')
+        for rdate, adate in COD_ROWS:
+            f.write('%d %d 0.1\n' % (rdate, adate))
+
+    return extractor
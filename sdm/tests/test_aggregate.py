@@ -0,0 +1,52 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from sdm.cod import CoD
+
+from conftest import COMPONENTS
+
+
+def expected_aggregate(data, rdates, period, statistic):
+    """ The statistic of the daily data over the rows of each period, with numpy's nan functions
+    """
+    period_starts, idx_periods = np.unique(CoD.period_starts(rdates, period), return_inverse=True)
+    func = {'mean': np.nanmean, 'sum': np.nansum, 'max': np.nanmax, 'min': np.nanmin}[statistic]
+    ret = []
+    for i in range(period_starts.size):
+        rows = data[idx_periods == i]
+        with warnings.catch_warnings():
+            # Cells with no valid data give NaN.
+            warnings.simplefilter('ignore', RuntimeWarning)
+            values = func(rows, axis=0)
+        # nansum gives 0 for cells with no valid data.
+        values[np.all(np.isnan(rows), axis=0)] = np.NaN
+        ret.append(values)
+    return period_starts, np.array(ret)
+
+
+@pytest.mark.parametrize('period', ['month', 'season', 'year'])
+@pytest.mark.parametrize('statistic', ['mean', 'sum', 'max', 'min'])
+def test_aggregate_matches_extract(awap_extractor, period, statistic):
+    data, rdates, lat, lon = awap_extractor.extract(*COMPONENTS)
+
+    ret, period_starts, ret_lat, ret_lon = awap_extractor.aggregate(*COMPONENTS, period=period,
+                                                                    statistic=statistic)
+
+    expected_starts, expected = expected_aggregate(data, rdates, period, statistic)
+    np.testing.assert_equal(period_starts, expected_starts)
+    np.testing.assert_allclose(ret, expected, rtol=1e-6)
+    np.testing.assert_equal(ret_lat, lat)
+    np.testing.assert_equal(ret_lon, lon)
+    # The cell missing on every day, and the cell outside the region
+    assert np.isnan(ret[:, 1, 1]).all() and np.isnan(ret[:, 0, 0]).all()
+
+
+def test_aggregate_periods(awap_extractor):
+    _, period_starts, _, _ = awap_extractor.aggregate(*COMPONENTS, period='season')
+    # December 1999 is in the summer of 2000.
+    np.testing.assert_equal(period_starts, [991201, 1000301])
+
+    with pytest.raises(ValueError):
+        awap_extractor.aggregate(*COMPONENTS, period='week')
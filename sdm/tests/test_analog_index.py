@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+from scipy.io import netcdf
+
+from sdm.analog_index import AnalogIndex, output_resolution, update_output
+from sdm.extractor import GriddedExtractor
+
+from conftest import COMPONENTS, awap_month_data, write_awap_month
+
+
+def write_cod(base_dir, modsce, season, adates):
+    dirout = os.path.join(base_dir, modsce, 'sea', 'rain', 'season_%d' % season)
+    os.makedirs(dirout)
+    with open(os.path.join(dirout, 'rawfield_analog_%d' % season), 'w') as f:
+        f.write('rawfield analog %d\n' % season)
+        for i, adate in enumerate(adates):
+            f.write('%d %d 0.1\n' % (2000101 + i, adate))
+    return os.path.join(dirout, 'rawfield_analog_%d' % season)
+
+
+def test_lookup_days_and_months(tmpdir):
+    base_dir = str(tmpdir)
+    first = write_cod(base_dir, 'A_rcp45', 1, [600115, 600201, 600115, 600301])
+    second = write_cod(base_dir, 'B_rcp45', 2, [600228, 600302])
+
+    index = AnalogIndex.build(base_dir)
+
+    np.testing.assert_equal(index.lookup(days=[19600115])[first], [0, 2])
+    assert second not in index.lookup(days=[19600115])
+    found = index.lookup(months=[196002])
+    np.testing.assert_equal(found[first], [1])
+    np.testing.assert_equal(found[second], [0])
+    np.testing.assert_equal(index.lookup(days=[19600301], months=[196003])[first], [3])
+    assert index.lookup(months=[196004]) == {}
+
+
+def test_save_load_and_refresh(tmpdir):
+    base_dir = str(tmpdir.mkdir('cod'))
+    first = write_cod(base_dir, 'A_rcp45', 1, [600115, 600201])
+    index_file = str(tmpdir.join('index.npz'))
+    AnalogIndex.build(base_dir).save(index_file)
+
+    index = AnalogIndex.load(index_file)
+    assert index.is_current()
+    np.testing.assert_equal(index.file_adates(first), [600115, 600201])
+
+    second = write_cod(base_dir, 'B_rcp45', 2, [600115])
+    assert not index.is_current()
+    index = AnalogIndex.build(base_dir, previous=index)
+    assert sorted(index.lookup(days=[19600115])) == [first, second]
+
+
+def read_output(output_file, predictand):
+    f = netcdf.netcdf_file(output_file, mmap=False)
+    ret = f.variables['time'].data.copy(), f.variables[predictand].data.copy(), f.history
+    f.close()
+    return ret
+
+
+def test_update_output(tmpdir, awap_extractor):
+    output_file = str(tmpdir.join('out.nc'))
+    data, dates, lat, lon = awap_extractor.extract(*COMPONENTS)
+    GriddedExtractor.save_netcdf(output_file, data, dates, lat, lon, *COMPONENTS, resolution='0.5')
+    assert output_resolution(output_file) == '0.5'
+    times, before, history = read_output(output_file, 'rain')
+    index = AnalogIndex.build(awap_extractor.cod_manager.base_dir)
+
+    # February is recalibrated.
+    write_awap_month(awap_extractor.awap_manager, 1960, 2, awap_month_data(awap_extractor.awap_manager, 3))
+    size = os.path.getsize(output_file)
+    assert update_output(output_file, index, awap_extractor, months=[196002]) == 3
+    assert update_output(output_file, index, awap_extractor, days=[19600315]) == 0
+
+    expected, _, _, _ = awap_extractor.extract(*COMPONENTS)
+    expected[np.isnan(expected)] = 99999.9
+    updated_times, after, updated_history = read_output(output_file, 'rain')
+    assert os.path.getsize(output_file) == size
+    assert updated_history == history
+    np.testing.assert_equal(updated_times, times)
+    np.testing.assert_allclose(after, expected, rtol=1e-6)
+    # Only the rows using February have changed.
+    changed = np.any(after != before, axis=(1, 2))
+    np.testing.assert_equal(np.where(changed)[0], [3, 7, 8])
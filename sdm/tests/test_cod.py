@@ -0,0 +1,35 @@
+import numpy as np
+
+from sdm.cod import CoD
+
+
+def test_date_code():
+    assert CoD.date_code('2080') == 1800101
+    assert CoD.date_code('2099', end=True) == 1991231
+    assert CoD.date_code('2000-02', end=True) == 1000229
+    assert CoD.date_code('1986-03-15') == 860315
+
+
+def test_select_window_and_months():
+    cod_dates = {
+        'rdates': np.array([1791231, 1800101, 1800615, 1991231, 2000101]),
+        'adates': np.arange(5),
+        'edists': np.zeros(5),
+    }
+
+    selected = CoD.select(cod_dates, CoD.date_code('2080'), CoD.date_code('2099', end=True))
+    np.testing.assert_equal(selected['adates'], [1, 2, 3])
+
+    selected = CoD.select(cod_dates, months=[12, 1])
+    np.testing.assert_equal(selected['adates'], [0, 1, 3, 4])
+
+
+def test_period_starts():
+    cod_dates = np.array([1001130, 1001201, 1010115, 1010301, 1011130])
+
+    np.testing.assert_equal(CoD.period_starts(cod_dates, 'month'),
+                            [1001101, 1001201, 1010101, 1010301, 1011101])
+    np.testing.assert_equal(CoD.period_starts(cod_dates, 'season'),
+                            [1000901, 1001201, 1001201, 1010301, 1010901])
+    np.testing.assert_equal(CoD.period_starts(cod_dates, 'year'),
+                            [1000101, 1000101, 1010101, 1010101, 1010101])
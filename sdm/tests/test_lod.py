@@ -0,0 +1,36 @@
+import numpy as np
+
+from sdm import lod
+
+
+def test_minmax_keeps_extremes():
+    values = np.sin(np.arange(36500) / 50.0)
+    values[12345] = 10.0
+    values[20000] = -10.0
+    values[30000:30100] = np.NaN
+
+    keep = lod.minmax_indices(values, 1000)
+
+    assert keep.size <= 1002
+    assert np.all(np.diff(keep) > 0)
+    assert 12345 in keep and 20000 in keep
+    assert keep[0] == 0 and keep[-1] == values.size - 1
+    np.testing.assert_equal(np.nanmax(values[keep]), 10.0)
+    np.testing.assert_equal(np.nanmin(values[keep]), -10.0)
+
+
+def test_short_series_unchanged():
+    np.testing.assert_equal(lod.minmax_indices(np.arange(10.0), 100), np.arange(10))
+
+
+def test_pyramid_levels_match_direct_envelopes():
+    values = np.random.RandomState(0).rand(10000)
+    values[::7] = np.NaN
+
+    levels = lod.pyramid(values, factor=4, min_points=50)
+
+    assert [width for width, level in levels] == [4, 16, 64, 256]
+    for width, level in levels:
+        direct = lod.envelope(values, width)
+        for key in ('start', 'min', 'max', 'sum', 'count'):
+            np.testing.assert_allclose(level[key], direct[key])
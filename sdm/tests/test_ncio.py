@@ -0,0 +1,45 @@
+import numpy as np
+from scipy.io import netcdf
+
+from sdm import ncio
+
+
+def write_file(file_path, data, missing_value=99999.9):
+    f = netcdf.netcdf_file(file_path, 'w')
+    f.createDimension('time', None)
+    f.createDimension('lat', data.shape[1])
+    f.createDimension('lon', data.shape[2])
+    var = f.createVariable('rain', np.float32, ('time', 'lat', 'lon'))
+    var[:] = data
+    var.missing_value = missing_value
+    f.close()
+
+
+def test_read_point_and_hyperslab(tmpdir):
+    file_path = str(tmpdir.join('a.nc'))
+    data = np.arange(60, dtype=np.float32).reshape(5, 3, 4)
+    data[2, 1, 1] = 99999.9
+    write_file(file_path, data)
+
+    np.testing.assert_equal(ncio.read_point(file_path, 'rain', 1, 2), data[:, 1, 2])
+    point = ncio.read_point(file_path, 'rain', 1, 1, fill_nan=True)
+    assert np.isnan(point[2]) and point[3] == data[3, 1, 1]
+
+    hyperslab = ncio.read_variable(file_path, 'rain', (np.array([0, 3]), slice(1, 3), slice(0, 2)))
+    np.testing.assert_equal(hyperslab, data[[0, 3], 1:3, 0:2])
+
+
+def test_pool_closes_least_recently_used(tmpdir):
+    file_paths = [str(tmpdir.join('%d.nc' % i)) for i in range(3)]
+    for i, file_path in enumerate(file_paths):
+        write_file(file_path, np.ones((2, 2, 2)) * i)
+
+    with ncio.FilePool(max_open=2) as pool:
+        first = pool.get(file_paths[0])
+        pool.get(file_paths[1])
+        pool.get(file_paths[0])
+        pool.get(file_paths[2])
+        assert sorted(pool.files) == [file_paths[0], file_paths[2]]
+        assert pool.get(file_paths[0]) is first
+        assert ncio.read_point(file_paths[2], 'rain', 0, 0, pool=pool)[0] == 2
+    assert len(pool) == 0
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from sdm.planner import parse_memory, format_bytes, largest_chunk_peaks, streaming_peak, plan_extraction
+
+
+def test_parse_memory():
+    assert parse_memory('500M') == 500 * 1024 ** 2
+    assert parse_memory('8GB') == 8 * 1024 ** 3
+    assert parse_memory('1.5k') == 1536
+    assert parse_memory('4096') == 4096
+    with pytest.raises(ValueError):
+        parse_memory('lots')
+
+
+def test_format_bytes():
+    assert format_bytes(512) == '512 B'
+    assert format_bytes(3 * 1024 ** 3) == '3.0 GB'
+
+
+def test_largest_chunk_peaks():
+    month_rows = np.array([19, 27, 14])
+    month_days = np.array([13, 16, 10])
+    # The largest month read, with the cube of its days
+    month_peak = 16 * (20 * 5 + 19 * 4) + 16 * 20 * 4
+
+    assert largest_chunk_peaks(month_rows, month_days, 1, 19, 20) == streaming_peak(27, month_peak, 20)
+    assert largest_chunk_peaks(month_rows, month_days, 2, 19, 20) == streaming_peak(46, month_peak, 20)
+
+
+class StubExtractor(object):
+    """ CoD dates of two days of January 1960 and one of February and March each, and a mask of 10 points in a 3 x 4 box
+    """
+
+    def read_inputs(self, *args):
+        cod_dates = {
+            'rdates': np.arange(800101, 800113),
+            'adates': np.repeat([600101, 600101, 600102, 600203, 600305], [2, 1, 1, 4, 4]),
+            'edists': np.zeros(12),
+        }
+        mask = np.zeros((10, 10), dtype=np.int32)
+        mask[2:5, 3:7] = 1
+        mask[2, 3] = mask[4, 6] = 0
+        return cod_dates, mask
+
+
+def test_plan_extraction():
+    args = (StubExtractor(), 'A', 'historical', 'reg', 1, 'rain')
+
+    plan = plan_extraction(*args)
+    assert (plan['nrows'], plan['npoints'], plan['shape'], plan['files']) == (12, 10, (3, 4), 5)
+    # Only the 4 distinct days of the box are read, as float32
+    assert plan['bytes_read'] == 4 * 12 * 4
+    assert (plan['mode'], plan['dtype'], plan['peak_bytes']) == ('in-memory', np.float64, 12 * 12 * 20)
+
+    plan = plan_extraction(*args, max_memory=2000)
+    assert (plan['mode'], plan['dtype'], plan['peak_bytes']) == ('in-memory', np.float32, 12 * 12 * 12)
+
+    plan = plan_extraction(*args, max_memory=1500)
+    assert (plan['mode'], plan['chunk_months']) == ('streaming', 2)
+    assert plan['peak_bytes'] == streaming_peak(8, 2 * (12 * 5 + 10 * 4) + 2 * 12 * 4, 12)
+
+    with pytest.raises(ValueError):
+        plan_extraction(*args, max_memory=800)
@@ -0,0 +1,52 @@
+import json
+import struct
+
+import numpy as np
+
+from sdm import polygon
+from sdm.mask import Mask
+
+LAT = np.arange(0.5, 10.0, 1.0)
+LON = np.arange(0.5, 10.0, 1.0)
+
+OUTER = np.array([[2.0, 2.0], [8.0, 2.0], [8.0, 8.0], [2.0, 8.0]])
+HOLE = np.array([[4.0, 4.0], [6.0, 4.0], [6.0, 6.0], [4.0, 6.0]])
+
+
+def expected_mask():
+    mask = np.zeros((LAT.size, LON.size), dtype=np.int32)
+    mask[2:8, 2:8] = 1
+    mask[4:6, 4:6] = 0
+    return mask
+
+
+def test_rasterise_square_with_hole():
+    np.testing.assert_equal(polygon.rasterise([[OUTER, HOLE]], LAT, LON), expected_mask())
+    # Descending latitudes give the flipped mask.
+    np.testing.assert_equal(polygon.rasterise([[OUTER, HOLE]], LAT[::-1], LON), expected_mask()[::-1])
+
+
+def test_read_shapefile(tmpdir):
+    points = np.vstack([OUTER, OUTER[:1], HOLE, HOLE[:1]])
+    content = (struct.pack('<i4d2i', 5, 2.0, 2.0, 8.0, 8.0, 2, points.shape[0]) +
+               np.array([0, 5], dtype='<i4').tostring() + points.astype('<f8').tostring())
+    record = struct.pack('>2i', 1, len(content) // 2) + content
+    header = struct.pack('>7i', 9994, 0, 0, 0, 0, 0, (100 + len(record)) // 2) + \
+        struct.pack('<2i8d', 1000, 5, *([0.0] * 8))
+    file_path = str(tmpdir.join('region.shp'))
+    with open(file_path, 'wb') as f:
+        f.write(header + record)
+
+    np.testing.assert_equal(polygon.rasterise(polygon.read_polygons(file_path), LAT, LON), expected_mask())
+
+
+def test_polygon_mask_is_cached(tmpdir):
+    file_path = str(tmpdir.join('region.geojson'))
+    with open(file_path, 'w') as f:
+        json.dump({'type': 'Feature', 'properties': {},
+                   'geometry': {'type': 'Polygon', 'coordinates': [OUTER.tolist(), HOLE.tolist()]}}, f)
+
+    mask_manager = Mask(cache_dir=str(tmpdir.join('cache')), lat=LAT, lon=LON)
+    np.testing.assert_equal(mask_manager.read_mask(file_path), expected_mask())
+    assert len(tmpdir.join('cache').listdir()) == 1
+    np.testing.assert_equal(mask_manager.read_mask(file_path), expected_mask())
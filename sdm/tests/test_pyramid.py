@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from scipy.io import netcdf
+
+from sdm import pyramid
+from sdm.gridded import AwapDailyData
+
+
+def test_grid():
+    lat, lon = pyramid.grid('0.05')
+    np.testing.assert_equal(lat, np.arange(-4450, -995, 5) / 100.0)
+    np.testing.assert_equal(lon, np.arange(11200, 15630, 5) / 100.0)
+
+    lat, lon = pyramid.grid('0.5')
+    assert (lat.size, lon.size) == (70, 89)
+    np.testing.assert_allclose(lat[:2], [-44.275, -43.775])
+
+    with pytest.raises(ValueError):
+        pyramid.grid('0.3')
+
+
+def test_coarsen_leaves_out_missing_cells():
+    data = np.arange(15, dtype=float).reshape(3, 5)
+    data[0, 1] = np.NaN
+    data[2, 4] = np.NaN
+
+    np.testing.assert_allclose(pyramid.coarsen(data, 2),
+                               [[(0 + 5 + 6) / 3.0, (2 + 3 + 7 + 8) / 4.0, (4 + 9) / 2.0],
+                                [(10 + 11) / 2.0, (12 + 13) / 2.0, np.NaN]])
+
+
+def test_coarsen_mask():
+    mask = np.zeros((5, 5), dtype=np.int32)
+    mask[4, 0] = 1
+    np.testing.assert_equal(pyramid.coarsen_mask(mask, 2), [[0, 0, 0], [0, 0, 0], [1, 0, 0]])
+
+
+def test_build_month(tmpdir):
+    source = AwapDailyData(base_dir=str(tmpdir))
+    target = AwapDailyData(base_dir=str(tmpdir), resolution='0.5')
+    source_path, _ = source.get_file_path('rain', 1960, 1)
+    tmpdir.mkdir('daily_0.05').mkdir('rr_calib')
+
+    data = np.random.RandomState(0).rand(2, source.lat.size, source.lon.size).astype(np.float32)
+    data[:, :10, :10] = -999.0
+    f = netcdf.netcdf_file(source_path, 'w')
+    f.createDimension('time', 2)
+    f.createDimension('lat', source.lat.size)
+    f.createDimension('lon', source.lon.size)
+    var = f.createVariable('rr', np.float32, ('time', 'lat', 'lon'))
+    var[:] = data
+    var.missing_value = np.float32(-999.0)
+    f.close()
+
+    assert pyramid.source_months(source, 'rain') == [196001]
+    assert pyramid.build_month(source, target, 'rain', 1960, 1) == target.get_file_path('rain', 1960, 1)[0]
+    assert pyramid.build_month(source, target, 'rain', 1960, 1) is None
+
+    coarse = target.read_one_file('rain', 1960, 1)
+    assert coarse.shape == (2, target.lat.size, target.lon.size)
+    assert np.isnan(coarse[:, 0, 0]).all()
+    np.testing.assert_allclose(coarse[:, 1, 1], data[:, 10:20, 10:20].mean(axis=(1, 2)), rtol=1e-5)
@@ -0,0 +1,23 @@
+import numpy as np
+
+from conftest import COMPONENTS
+
+
+def test_regional_series_matches_extract(awap_extractor):
+    data, rdates, lat, lon = awap_extractor.extract(*COMPONENTS)
+
+    series, dates = awap_extractor.regional_series(*COMPONENTS, statistics=('mean', 'min', 'max'),
+                                                   percentiles=(10, 50, 95))
+
+    np.testing.assert_equal(dates, rdates)
+    assert sorted(series) == ['max', 'mean', 'min', 'p10', 'p50', 'p95']
+    valid = ~np.isnan(data)
+    weights = np.cos(np.radians(lat))[:, np.newaxis] * np.ones(lon.size)
+    # Weighted by the cosine of latitude, leaving out missing values
+    mean = (np.where(valid, data, 0.0) * weights).sum(axis=(1, 2)) / (valid * weights).sum(axis=(1, 2))
+    np.testing.assert_allclose(series['mean'], mean, rtol=1e-6)
+    points = data.reshape(data.shape[0], -1)
+    np.testing.assert_allclose(series['min'], np.nanmin(points, axis=1), rtol=1e-6)
+    np.testing.assert_allclose(series['max'], np.nanmax(points, axis=1), rtol=1e-6)
+    for p in (10, 50, 95):
+        np.testing.assert_allclose(series['p%d' % p], np.nanpercentile(points, p, axis=1), rtol=1e-6)
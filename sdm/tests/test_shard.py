@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+
+from sdm import shard
+from sdm.extractor import GriddedExtractor
+
+from conftest import COMPONENTS
+
+
+def test_balance_is_longest_first():
+    costs = [7, 5, 4, 3, 3, 2]
+
+    shards = shard.balance(costs, 3)
+
+    assert shards == [[0, 5], [1, 4], [2, 3]]
+    assert sorted(sum(costs[i] for i in tasks) for tasks in shards) == [7, 8, 9]
+    assert shard.balance(costs, 3) == shards
+
+
+def test_latitude_bands_have_equal_points():
+    mask = np.zeros((20, 10), dtype=np.int32)
+    mask[2:18, :] = 1
+    mask[5, :] = 0
+
+    bands = shard.latitude_bands(mask, 3)
+
+    assert bands[0][0] == 2 and bands[-1][1] == 18
+    assert all(a[1] == b[0] for a, b in zip(bands[:-1], bands[1:]))
+    assert [int(mask[start:stop].sum()) for start, stop in bands] == [50, 50, 50]
+    assert len(shard.latitude_bands(mask, 100)) == 15
+
+
+def test_plan_paths_are_absolute(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    cod_dir = tmpdir.join('cod', 'A_historical', 'reg', 'rain', 'season_1')
+    cod_dir.ensure(dir=True)
+    cod_dir.join('rawfield_analog_1').write('x y 1\n2000101 600101 0.5\n2000102 600215 0.5\n')
+    extractor = GriddedExtractor(cod_base_dir='cod', gridded_base_dir='awap')
+
+    plan = shard.plan_jobs(extractor, shard.job_matrix('cod'), 'out', 2)
+    task = plan['shards'][0][0]
+    assert task['cod_file'] == str(cod_dir.join('rawfield_analog_1'))
+    assert task['output_file'] == str(tmpdir.join('out', 'A_historical_reg_rain_season_1.nc'))
+
+
+def test_merge_bands(tmpdir, awap_extractor):
+    cod_file_path = awap_extractor.cod_manager.get_cod_file_path(*COMPONENTS)
+    output_file = str(tmpdir.join('merged.nc'))
+    plan = shard.plan_bands(awap_extractor, cod_file_path, output_file, 2)
+    assert len(plan['shards']) == 2
+    for i in range(len(plan['shards'])):
+        shard.run_shard(plan, i, awap_extractor)
+
+    # Chunks of 3 time steps of the 3 x 4 grid
+    shard.merge_bands(plan['merges'][0], awap_extractor, remove=True, chunk_bytes=3 * 12 * 4)
+
+    expected_file = str(tmpdir.join('expected.nc'))
+    data, dates, lat, lon = awap_extractor.extract(*COMPONENTS)
+    GriddedExtractor.save_netcdf(expected_file, data, dates, lat, lon, *COMPONENTS, resolution='0.5')
+    assert open(output_file, 'rb').read() == open(expected_file, 'rb').read()
+    assert not any(os.path.exists(band_file) for band_file in plan['merges'][0]['band_files'])
@@ -0,0 +1,28 @@
+import numpy as np
+
+from sdm.stats import StatsAccumulator, save_stats, read_cell_stats, PERCENTILES
+
+
+def test_read_cell_stats(tmpdir):
+    stats_file = str(tmpdir.join('out.nc.stats.nc'))
+    days = np.arange(1, 101)
+    data = np.zeros((100, 6))
+    data[:, 4] = np.arange(100) + 0.5
+    data[:10, 5] = np.NaN
+
+    acc = StatsAccumulator('rain', 6)
+    acc.update(np.ones(100, dtype=int), data)
+    save_stats(stats_file, acc, np.array([-30.0, -29.95]), np.array([140.0, 140.05, 140.1]), days)
+
+    cell = read_cell_stats(stats_file, 1, 1)
+    assert cell['predictand'] == 'rain'
+    assert (cell['first_day'], cell['last_day']) == (1, 100)
+    np.testing.assert_equal(cell['percentile_levels'], PERCENTILES)
+    np.testing.assert_allclose(cell['percentiles'], PERCENTILES, atol=1e-4)
+    np.testing.assert_allclose(cell['mean'][:2], [50, 50])
+    assert np.isnan(cell['mean'][2])
+    np.testing.assert_equal(cell['count'], [100, 100, 0, 0, 0])
+    assert cell['histogram'].sum() == 100
+
+    cell = read_cell_stats(stats_file, 1, 2)
+    np.testing.assert_equal(cell['count'][:2], [90, 90])
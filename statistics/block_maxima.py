@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+Copyright 2015 CSIRO
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Calculate annual and seasonal block maxima and minima of daily data.
+
+All the seasons (ann, DJF, MAM, JJA, SON, MJJASO, NDJFMA) are computed
+for every grid cell in a single streaming pass over one or many input
+files. December (and November for NDJFMA) count towards the following
+year's season, and seasons that are incomplete at either end of the
+record are dropped.
+
+"""
+
+import sys
+import argparse
+
+import numpy as np
+import netCDF4 as nc4
+
+
+SEASONS = {'ann': (1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12),
+           'DJF': (12, 1, 2),
+           'MAM': (3, 4, 5),
+           'JJA': (6, 7, 8),
+           'SON': (9, 10, 11),
+           'MJJASO': (5, 6, 7, 8, 9, 10),
+           'NDJFMA': (11, 12, 1, 2, 3, 4)}
+
+# Seasons spanning the new year, labelled by the year of their January.
+CROSS_YEAR_SEASONS = ('DJF', 'NDJFMA')
+
+
+def month_bits(months):
+    return np.left_shift(1, np.asarray(months) - 1)
+
+
+class BlockExtremes(object):
+    """Running seasonal block maxima and minima, updated chunk by chunk."""
+
+    def __init__(self, seasons=None):
+        self.seasons = list(seasons or sorted(SEASONS))
+        self.blocks = dict((season, {}) for season in self.seasons)
+
+    def update(self, years, months, data):
+        """Add a chunk of time-ordered data of shape (ntime, ...)."""
+
+        for season in self.seasons:
+            in_season = np.in1d(months, SEASONS[season])
+            if not np.any(in_season):
+                continue
+            season_years = years[in_season]
+            if season in CROSS_YEAR_SEASONS:
+                season_years = np.where(months[in_season] >= 11, season_years + 1, season_years)
+
+            # The chunk is ordered in time, so each season year is one run.
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(season_years)) + 1))
+            values = data[in_season]
+            maxima = np.fmax.reduceat(values, starts, axis=0)
+            minima = np.fmin.reduceat(values, starts, axis=0)
+            bits = np.bitwise_or.reduceat(month_bits(months[in_season]), starts)
+
+            blocks = self.blocks[season]
+            for i, year in enumerate(season_years[starts]):
+                if year in blocks:
+                    block = blocks[year]
+                    np.fmax(block['max'], maxima[i], out=block['max'])
+                    np.fmin(block['min'], minima[i], out=block['min'])
+                    block['months'] |= bits[i]
+                else:
+                    blocks[year] = {'max': maxima[i], 'min': minima[i], 'months': bits[i]}
+
+    def result(self, season):
+        """Years, maxima and minima of the complete blocks of season."""
+
+        complete = np.bitwise_or.reduce(month_bits(SEASONS[season]))
+        blocks = self.blocks[season]
+        years = sorted(y for y in blocks if blocks[y]['months'] == complete)
+        return {'years': np.array(years, dtype=int),
+                'max': np.array([blocks[y]['max'] for y in years]),
+                'min': np.array([blocks[y]['min'] for y in years])}
+
+
+def time_ordered(infiles):
+    """Sort the input files by their first time step."""
+
+    def first_time(infile):
+        with nc4.Dataset(infile) as ds:
+            time_var = ds.variables['time']
+            return nc4.num2date(time_var[0], time_var.units, getattr(time_var, 'calendar', 'standard'))
+
+    return sorted(infiles, key=first_time)
+
+
+def missing_values(var):
+    """The fill and missing values of a netCDF4 variable, as float64."""
+
+    values = [getattr(var, '_FillValue', nc4.default_fillvals.get(var.dtype.str[1:]))]
+    if hasattr(var, 'missing_value'):
+        values.extend(np.atleast_1d(var.missing_value))
+    # Compare in the type of the variable, in which the values were written.
+    return [np.array(value, dtype=var.dtype).astype(np.float64) for value in values if value is not None]
+
+
+def block_extremes(infiles, variable, seasons=None, chunk_size=366, check_missing=False):
+    """Seasonal block maxima and minima of variable over the input files.
+
+    Returns a dictionary with the lats, lons, time units and variable
+    units of the input, and for each season its years, maxima and minima.
+    Raises a ValueError if the time axis of a file is not increasing or,
+    with check_missing, if the data contain missing values.
+
+    """
+
+    acc = BlockExtremes(seasons)
+    result = {}
+
+    for infile in time_ordered(list(infiles)):
+        with nc4.Dataset(infile) as ds:
+            time_var = ds.variables['time']
+            calendar = getattr(time_var, 'calendar', 'standard')
+            if np.any(np.diff(time_var[:]) <= 0):
+                raise ValueError('Execution halted: Bad time axis in %s' % infile)
+            var = ds.variables[variable]
+            var.set_auto_mask(False)
+            fill_values = missing_values(var)
+
+            if not result:
+                result = {'lats': ds.variables['lat'][:],
+                          'lons': ds.variables['lon'][:],
+                          'origin': time_var.units,
+                          'units': getattr(var, 'units', '')}
+
+            for start in range(0, len(time_var), chunk_size):
+                index = slice(start, start + chunk_size)
+                dates = nc4.num2date(time_var[index], time_var.units, calendar)
+                years = np.array([d.year for d in dates])
+                months = np.array([d.month for d in dates])
+
+                data = var[index].astype(np.float64)
+                # Missing values as NaN, which fmax and fmin skip.
+                for fill_value in fill_values:
+                    data[data == fill_value] = np.nan
+                if check_missing and (np.any(np.isnan(data)) or np.any(np.abs(data) > 1e20)):
+                    raise ValueError('Execution halted: Missing variable data in %s' % infile)
+                acc.update(years, months, data)
+
+    for season in acc.seasons:
+        result[season] = acc.result(season)
+
+    return result
+
+
+def write_nc(outfile, variable, extremes, seasons):
+    """Write the block extremes, one year axis per season."""
+
+    missing_value = 1e20
+
+    with nc4.Dataset(outfile, 'w') as ncout:
+        ncout.createDimension('lat', len(extremes['lats']))
+        ncout.createDimension('lon', len(extremes['lons']))
+        var_lat = ncout.createVariable('lat', 'f8', ('lat',))
+        var_lat[:] = extremes['lats']
+        var_lat.units = 'degrees_north'
+        var_lon = ncout.createVariable('lon', 'f8', ('lon',))
+        var_lon[:] = extremes['lons']
+        var_lon.units = 'degrees_east'
+
+        for season in seasons:
+            year_dim = 'year_%s' % season
+            ncout.createDimension(year_dim, len(extremes[season]['years']))
+            var_year = ncout.createVariable(year_dim, 'i4', (year_dim,))
+            var_year[:] = extremes[season]['years']
+            var_year.long_name = '%s season year' % season
+
+            for stat in ('max', 'min'):
+                name = '%s_%s_%s' % (variable, season, stat)
+                var = ncout.createVariable(name, 'f4', (year_dim, 'lat', 'lon'),
+                                           fill_value=missing_value)
+                var.units = extremes['units']
+                var.long_name = '%s %s block %simum' % (variable, season, stat)
+                var[:] = np.ma.masked_invalid(extremes[season][stat])
+
+        ncout.origin = extremes['origin']
+
+
+def main(infiles, outfile, variable, seasons=None):
+    """Run the program."""
+
+    seasons = seasons or sorted(SEASONS)
+    extremes = block_extremes(infiles, variable, seasons)
+    write_nc(outfile, variable, extremes, seasons)
+
+
+if __name__ == '__main__':
+
+    description = 'Calculate annual and seasonal block maxima and minima of daily data in one pass'
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument("variable", type=str, help="Variable to extract the extremes of")
+    parser.add_argument("files", type=str, nargs='+', metavar='infile ... outfile',
+                        help="Daily input netCDF files followed by the output file name")
+    parser.add_argument("--seasons", type=str, nargs='*', choices=sorted(SEASONS), default=None,
+                        help="Seasons to calculate [default = all]")
+
+    args = parser.parse_args()
+
+    if len(args.files) < 2:
+        parser.print_usage()
+        sys.exit(1)
+
+    main(args.files[:-1], args.files[-1], args.variable, args.seasons)
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+"""
+Copyright 2015 CSIRO
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Calculate GEV parameters and return levels for every grid cell.
+
+Python counterpart of calculate_gev.R taking the same arguments:
+
+  python calculate_gev.py season fit_method infile outfile
+
+L-moment fits (lmom) are computed for all cells at once with array
+operations. Maximum likelihood (mle) and penalised (pfit) fits are
+optimised cell by cell, spread over a process pool. Parameters follow
+the Hosking convention used by the lmom package: location (xi), scale
+(alpha) and shape (k). The return levels for 2 to 100 years are written
+together with the parameters in a single pass.
+
+"""
+
+import os
+import sys
+import time
+import argparse
+import datetime
+import multiprocessing
+
+import numpy as np
+import netCDF4 as nc4
+from scipy import optimize
+from scipy.special import gamma, gammaln
+
+import block_maxima
+
+
+VARIABLES = ('txxETCCDI', 'rx1dayETCCDI', 'tnnETCCDI', 'sfcWindmax', 'pr', 'tasmax',
+             'tasmin', 'rx1day', 'txx', 'tnn', 'sfcWind', 'rnd24')
+# Block minima of these variables are negated so that a GEV for maxima
+# can be fitted; the return levels are negated back on output.
+MINIMUM_VARIABLES = ('tnnETCCDI', 'tasmin', 'tnn')
+
+FIT_METHODS = ('lmom', 'pfit', 'mle')
+RETURN_PERIODS = (2, 5, 10, 20, 50, 100)
+MIN_YEARS = 20
+EULER = 0.57722
+
+
+def read_block_maxima(infile, variable, season):
+    """Seasonal block maxima of variable in the units used for the fit.
+
+    The maxima are computed in a single pass over the daily data. Block
+    minima of MINIMUM_VARIABLES are returned negated.
+
+    """
+
+    if variable not in VARIABLES:
+        raise ValueError('Variable %s not one of %s' % (variable, ', '.join(VARIABLES)))
+
+    extremes = block_maxima.block_extremes([infile], variable, [season], check_missing=True)
+    minimum = variable in MINIMUM_VARIABLES
+    blocks = extremes[season]
+    maxima = blocks['min'] if minimum else blocks['max']
+
+    if variable == 'pr' and extremes['units'] == 'kg m-2 s-1':
+        maxima = maxima * 86400
+    if variable in ('tasmin', 'tasmax') and extremes['units'] == 'K':
+        maxima = maxima - 273.15
+
+    if minimum:
+        maxima = -maxima
+
+    return extremes, blocks['years'], maxima
+
+
+def sample_lmoments(data):
+    """First three sample L-moments along the first axis."""
+
+    x = np.sort(data, axis=0)
+    n = x.shape[0]
+    i = np.arange(n, dtype=np.float64).reshape((n,) + (1,) * (x.ndim - 1))
+
+    b0 = x.mean(axis=0)
+    b1 = (i / (n - 1) * x).mean(axis=0)
+    b2 = (i * (i - 1) / ((n - 1) * (n - 2)) * x).mean(axis=0)
+
+    l1 = b0
+    l2 = 2 * b1 - b0
+    l3 = 6 * b2 - 6 * b1 + b0
+
+    return l1, l2, l3 / l2
+
+
+def pelgev(l1, l2, t3, iterations=10):
+    """GEV parameters (xi, alpha, k) from L-moments, for arrays of cells.
+
+    Starts from Hosking's approximation for the shape parameter and
+    refines it with Newton-Raphson on the exact tau3 equation.
+
+    """
+
+    log2, log3 = np.log(2.0), np.log(3.0)
+    z = 2.0 / (3.0 + t3) - log2 / log3
+    k = 7.8590 * z + 2.9554 * z ** 2
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for _ in range(iterations):
+            a, b = 1 - 3.0 ** -k, 1 - 2.0 ** -k
+            da, db = log3 * 3.0 ** -k, log2 * 2.0 ** -k
+            f = 2 * a / b - 3 - t3
+            df = 2 * (da * b - a * db) / b ** 2
+            step = np.where(np.abs(k) > 1e-6, f / df, 0.0)
+            k = k - np.where(np.isfinite(step), step, 0.0)
+
+        gumbel = np.abs(k) <= 1e-6
+        g = gamma(1 + k)
+        alpha = np.where(gumbel, l2 / log2, l2 * k / ((1 - 2.0 ** -k) * g))
+        xi = np.where(gumbel, l1 - EULER * alpha, l1 - alpha * (1 - g) / k)
+
+    return xi, alpha, np.where(gumbel, 0.0, k)
+
+
+def quagev(f, xi, alpha, k):
+    """GEV quantile for non-exceedance probability f."""
+
+    y = -np.log(f)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(k == 0, xi - alpha * np.log(y), xi + alpha * (1 - y ** k) / k)
+
+
+def sted_log_prior(xi):
+    """Beta prior on the shape parameter used by the penalised fit."""
+
+    if xi <= -0.5 or xi >= 0.5:
+        return -np.inf
+    return (gammaln(15) - gammaln(9) - gammaln(6)
+            + 8 * np.log(0.5 + xi) + 5 * np.log(0.5 - xi))
+
+
+def gev_nllh(params, x, penalised):
+    """Negative log-likelihood in the ismev convention (xi > 0 heavy tailed)."""
+
+    mu, sc, xi = params
+    if sc <= 0:
+        return 1e6
+    y = 1 + xi * (x - mu) / sc
+    if np.any(y <= 0):
+        return 1e6
+    nllh = x.size * np.log(sc) + np.sum(y ** (-1 / xi)) + np.sum(np.log(y) * (1 / xi + 1))
+    if penalised:
+        prior = sted_log_prior(xi)
+        if not np.isfinite(prior):
+            return 1e6
+        nllh -= prior
+    return nllh
+
+
+def fit_cell(x, fit_method):
+    """MLE or penalised GEV fit of one cell, as in ismev gev.fit / gevp.fit."""
+
+    in2 = np.sqrt(6 * np.var(x, ddof=1)) / np.pi
+    in1 = np.mean(x) - EULER * in2
+    res = optimize.minimize(gev_nllh, [in1, in2, 0.1], args=(x, fit_method == 'pfit'),
+                            method='Nelder-Mead', options={'maxiter': 10000, 'maxfev': 10000})
+    mu, sc, xi = res.x
+    return (mu, sc, -xi), res.success
+
+
+def fit_cells(task):
+    """Fit every cell (column) of a (nyears, ncells) block of maxima."""
+
+    block, fit_method = task
+    ncells = block.shape[1]
+    params = np.empty((3, ncells))
+    params[:] = np.nan
+    fit_time = np.zeros(ncells)
+    converged = np.zeros(ncells, dtype=np.int8)
+
+    for i in range(ncells):
+        x = block[:, i]
+        if not np.all(np.isfinite(x)):
+            continue
+        t0 = time.time()
+        try:
+            params[:, i], converged[i] = fit_cell(x, fit_method)
+        except (ValueError, FloatingPointError):
+            pass
+        fit_time[i] = time.time() - t0
+
+    return params, fit_time, converged
+
+
+def calc_gev(fit_method, maxima, processes=None, chunk_size=64):
+    """GEV parameters for each cell of maxima (nyears, nlat, nlon).
+
+    Returns the parameters (3, nlat, nlon), the per-cell fit time and the
+    per-cell convergence flag.
+
+    """
+
+    nyears = maxima.shape[0]
+    cells = maxima.reshape(nyears, -1)
+    ncells = cells.shape[1]
+
+    if fit_method == 'lmom':
+        t0 = time.time()
+        valid = np.all(np.isfinite(cells), axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            params = np.array(pelgev(*sample_lmoments(cells)))
+        params[:, ~valid] = np.nan
+        fit_time = np.empty(ncells)
+        fit_time[:] = (time.time() - t0) / ncells
+        converged = np.all(np.isfinite(params), axis=0).astype(np.int8)
+    else:
+        tasks = [(cells[:, i:i + chunk_size], fit_method) for i in range(0, ncells, chunk_size)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(fit_cells, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        params = np.concatenate([r[0] for r in results], axis=1)
+        fit_time = np.concatenate([r[1] for r in results])
+        converged = np.concatenate([r[2] for r in results])
+
+    shape = maxima.shape[1:]
+    return params.reshape((3,) + shape), fit_time.reshape(shape), converged.reshape(shape)
+
+
+def report(fit_method, fit_time, converged, valid):
+    """Print fit time and convergence statistics."""
+
+    nvalid = int(np.sum(valid))
+    print('GEV fit (%s): %d cells fitted, total %.2f s, mean %.2e s per cell, max %.2e s'
+          % (fit_method, nvalid, fit_time[valid].sum(), fit_time[valid].mean() if nvalid else 0,
+             fit_time[valid].max() if nvalid else 0))
+    print('             %d of %d cells did not converge'
+          % (nvalid - int(np.sum(converged[valid])), nvalid))
+
+
+def write_nc(outfile, nc, params, fit_time, converged, minimum, attributes):
+    """Write parameters, return levels and fit diagnostics in one pass."""
+
+    missing_value = 1e20
+    xi, alpha, k = params
+
+    with nc4.Dataset(outfile, 'w') as ncout:
+        ncout.createDimension('lat', len(nc['lats']))
+        ncout.createDimension('lon', len(nc['lons']))
+        var_lat = ncout.createVariable('lat', 'f8', ('lat',))
+        var_lat[:] = nc['lats']
+        var_lat.units = 'degrees_north'
+        var_lon = ncout.createVariable('lon', 'f8', ('lon',))
+        var_lon[:] = nc['lons']
+        var_lon.units = 'degrees_east'
+
+        def write_var(name, values, units, long_name, dtype='f8'):
+            var = ncout.createVariable(name, dtype, ('lat', 'lon'), fill_value=missing_value)
+            var.units = units
+            var.long_name = long_name
+            var[:] = np.ma.masked_invalid(values)
+
+        write_var('xi', xi, 'none', 'GEV location parameter')
+        write_var('alpha', alpha, 'none', 'GEV scale parameter')
+        write_var('k', k, 'none', 'GEV shape parameter')
+
+        for return_period in RETURN_PERIODS:
+            ret_level = quagev(1 - 1.0 / return_period, xi, alpha, k)
+            if minimum:
+                ret_level = -ret_level
+            write_var('RetLevel%d' % return_period, ret_level, 'day-1',
+                      'Return Level: %dyrs' % return_period)
+
+        write_var('fit_time', fit_time, 's', 'GEV fit time per cell')
+        var = ncout.createVariable('converged', 'i1', ('lat', 'lon'))
+        var.long_name = 'GEV fit converged (1) or not (0)'
+        var[:] = converged
+
+        attributes['origin'] = nc['origin']
+        attributes['creation_date'] = datetime.datetime.now().ctime()
+        ncout.setncatts(attributes)
+
+    print('Name of output file: %s' % outfile)
+
+
+def period_outfile(outfilename, start, end, nperiods):
+    """Substitute the analysis period into the output file name."""
+
+    if '1986-2005' in outfilename:
+        return outfilename.replace('1986-2005', '%s-%s' % (start, end))
+    if nperiods == 1:
+        return outfilename
+    root, extn = os.path.splitext(outfilename)
+    return '%s_%s-%s%s' % (root, start, end, extn)
+
+
+def main(season, fit_method, infile, outfilename, processes=None):
+    """Run the program."""
+
+    if season not in block_maxima.SEASONS:
+        raise ValueError('Season %s not one of %s' % (season, ', '.join(sorted(block_maxima.SEASONS))))
+    if fit_method not in FIT_METHODS:
+        raise ValueError('Fit method %s not one of %s' % (fit_method, ', '.join(FIT_METHODS)))
+
+    out_name = os.path.basename(infile)
+    fields = out_name.split('_')
+    var, model = fields[0], fields[2]
+    scenario, run = fields[-3], fields[-2]
+
+    if scenario == 'historical':
+        periods = [(1986, 2005)]
+    else:
+        periods = [(2020, 2039), (2040, 2059), (2060, 2079), (2080, 2099)]
+
+    print('Commencing GEV analysis for %s for scenario=%s' % (infile, scenario))
+
+    minimum = var in MINIMUM_VARIABLES
+    nc, years, maxima = read_block_maxima(infile, var, season)
+
+    for start, end in periods:
+        index = (years >= start) & (years <= end)
+        if np.sum(index) < MIN_YEARS:
+            raise ValueError('Execution halted: Less than %d years available for GEV analysis period'
+                             % MIN_YEARS)
+
+        params, fit_time, converged = calc_gev(fit_method, maxima[index], processes=processes)
+        report(fit_method, fit_time, converged, np.all(np.isfinite(maxima[index]), axis=0))
+
+        outfile = period_outfile(outfilename, start, end, len(periods))
+        print('Writing to file: %s' % outfile)
+        attributes = {
+            'institution': 'CSIRO (Commonwealth Scientific and Industrial Research Organisation, Australia)',
+            'institute_id': 'CSIRO',
+            'experiment_id': scenario,
+            'source': out_name,
+            'project_id': 'CMIP5',
+            'model_id': model,
+            'parent_experiment_rip': run,
+            'season': season,
+            'analysis_period': '%s-%s' % (start, end),
+            'GEV_fitting_method': fit_method,
+            'product': 'output',
+            'title': '%s return levels for %s' % (model, var),
+            'references': 'Please see http://www.cccma.ec.gc.ca/data/climdex/climdex.shtml '
+                          'for information regarding the ETCCDI database',
+        }
+        write_nc(outfile, nc, params, fit_time, converged, minimum, attributes)
+
+
+if __name__ == '__main__':
+
+    description = 'Calculate GEV parameters and return levels for every grid cell'
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument("season", type=str, choices=sorted(block_maxima.SEASONS), help="Season to calculate maxima for")
+    parser.add_argument("fit_method", type=str, choices=FIT_METHODS, help="GEV fitting method")
+    parser.add_argument("infile", type=str, help="Input netCDF file")
+    parser.add_argument("outfile", type=str,
+                        help="Output netCDF file. Any '1986-2005' in the name is replaced by the analysis period")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Number of worker processes for mle and pfit [default = number of cpus]")
+
+    args = parser.parse_args()
+
+    try:
+        main(args.season, args.fit_method, args.infile, args.outfile, processes=args.processes)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
@@ -52,15 +52,19 @@ if [ ! -f $infile ] ; then
     usage
 fi
 
+# Keep the intermediate histogram on local scratch rather than
+# next to the input file
+
+temp_dir=$(mktemp -d -p ${PBS_JOBFS:-${TMPDIR:-/tmp}})
+function cleanup {
+    rm -rf $temp_dir
+}
+trap cleanup EXIT
+
 # Execute the cdo function
 infilename="${infile##*/}"
-infileext="${infilename##*.}"
 basefilename="${infilename%.*}"
-basedir="${infile%$infilename}"
-echo
-tmpfile="${basedir}${basefilename}_histcount.nc"
-echo $tmpfile
+tmpfile="${temp_dir}/${basefilename}_histcount.$$.nc"
 cdo -O histcount,$options $infile $tmpfile
-cdo div $tmpfile -vertsum $tmpfile $outfile
-rm ${tmpfile}
+cdo -O div $tmpfile -vertsum $tmpfile $outfile
 
@@ -0,0 +1,34 @@
+import numpy as np
+import netCDF4 as nc4
+import pytest
+
+import block_maxima
+
+
+def write_daily(infile, data):
+    with nc4.Dataset(infile, 'w') as ds:
+        ds.createDimension('time', data.shape[0])
+        ds.createDimension('lat', data.shape[1])
+        ds.createDimension('lon', data.shape[2])
+        var_time = ds.createVariable('time', 'f8', ('time',))
+        var_time[:] = np.arange(data.shape[0])
+        var_time.units = 'days since 2001-01-01'
+        var_time.calendar = 'standard'
+        ds.createVariable('lat', 'f8', ('lat',))[:] = np.arange(data.shape[1])
+        ds.createVariable('lon', 'f8', ('lon',))[:] = np.arange(data.shape[2])
+        var = ds.createVariable('tasmax', 'f4', ('time', 'lat', 'lon'), fill_value=1e20)
+        var[:] = data
+
+
+def test_partially_missing_cell(tmpdir):
+    infile = str(tmpdir.join('in.nc'))
+    data = np.ma.masked_array(np.arange(365 * 2, dtype=np.float32).reshape(365, 1, 2))
+    data[-10:, 0, 1] = np.ma.masked
+    write_daily(infile, data)
+
+    extremes = block_maxima.block_extremes([infile], 'tasmax', ['ann'])
+    np.testing.assert_equal(extremes['ann']['max'], [[[728, 709]]])
+    np.testing.assert_equal(extremes['ann']['min'], [[[0, 1]]])
+
+    with pytest.raises(ValueError):
+        block_maxima.block_extremes([infile], 'tasmax', ['ann'], check_missing=True)
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+Copyright 2015 CSIRO
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Run a declarative sequence of the cdo wrapper steps (remap, temporal
+anomaly, aggregation, histogram ...) as piped cdo operator chains.
+
+The pipeline is described by a JSON file containing a list of branches.
+Each branch has an input (or a list of inputs for ensemble statistics),
+an optional output and a list of steps, e.g.
+
+  {"branches": [
+     {"name": "access",
+      "input": "tas_ACCESS1-0.xml",
+      "steps": [{"step": "remap", "method": "remapcon2", "grid": "r360x180"},
+                {"step": "temporal_anomaly", "timescale": "ymon"}]},
+     {"name": "canesm",
+      "input": "tas_CanESM2.nc",
+      "steps": [{"step": "remap", "method": "remapcon2", "grid": "r360x180"},
+                {"step": "temporal_anomaly", "timescale": "ymon"}]},
+     {"name": "ensemble",
+      "inputs": ["@access", "@canesm"],
+      "output": "tas_ensmean_hist.nc",
+      "steps": [{"step": "ensemble_agg", "statistic": "ensmean"},
+                {"step": "time_agg", "method": "timmean"},
+                {"step": "calc_pdf", "bin_list": "-inf,-2,-1,0,1,2,inf"}]}
+  ]}
+
+Inputs starting with "@" refer to the output of another branch. Steps
+within a branch are fused into a single cdo call wherever possible;
+branches that do not depend on each other are run in parallel. Branches
+without an output, xml catalogue conversions and the few intermediate
+files that cannot be avoided are written to a scratch directory that
+is removed when the pipeline finishes.
+
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import itertools
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+
+XML_TO_NC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xml_to_nc.py')
+
+REMAP_METHODS = ('remapbil', 'remapbic', 'remapdis', 'remapnn',
+                 'remapcon', 'remapcon2', 'remaplaf')
+ANOMALY_TIMESCALES = ('yday', 'ymon', 'yseas')
+AGG_PREFIXES = {'time_agg': 'tim',
+                'field_agg': 'fld',
+                'zonal_agg': 'zon',
+                'meridional_agg': 'mer',
+                'vertical_agg': 'vert'}
+HISTOGRAM_METHODS = ('histcount', 'histsum', 'histmean', 'histfreq')
+ARITHMETIC_OPERATIONS = ('add', 'sub', 'mul', 'div', 'min', 'max', 'atan2')
+
+
+class PipelineError(Exception):
+    pass
+
+
+def default_scratch_dir():
+    """Local scratch: the PBS job file system on NCI, otherwise $TMPDIR."""
+
+    for env in ('PBS_JOBFS', 'TMPDIR'):
+        if os.environ.get(env) and os.path.isdir(os.environ[env]):
+            return os.environ[env]
+    return tempfile.gettempdir()
+
+
+def is_plain(expr):
+    """True if the expression is just a file name (no operators)."""
+
+    return len(expr) == 1
+
+
+def apply_op(operator, *inputs):
+    """Build the cdo expression applying operator to the input expressions."""
+
+    expr = ['-' + operator]
+    for input_expr in inputs:
+        expr.extend(input_expr)
+    return expr
+
+
+def remap(expr, step):
+    method = step.get('method', 'remapcon2')
+    if method not in REMAP_METHODS:
+        raise PipelineError('Unknown remap method: %s' % method)
+    return apply_op('%s,%s' % (method, step['grid']), expr)
+
+
+def temporal_anomaly(expr, step):
+    timescale = step.get('timescale')
+    if timescale is None:
+        subtractor, averager = 'sub', 'timmean'
+    elif timescale in ANOMALY_TIMESCALES:
+        subtractor, averager = timescale + 'sub', timescale + 'avg'
+    else:
+        raise PipelineError('Unknown anomaly timescale: %s' % timescale)
+
+    clim_expr = expr
+    if step.get('clim_bounds'):
+        clim_expr = apply_op('seldate,%s' % step['clim_bounds'], expr)
+
+    return apply_op(subtractor, expr, apply_op(averager, clim_expr))
+
+
+def make_agg(prefix):
+    def agg(expr, step):
+        method = step['method']
+        if not method.startswith(prefix):
+            raise PipelineError('Aggregation method %s does not start with %s'
+                                % (method, prefix))
+        return apply_op(method, expr)
+    return agg
+
+
+def histogram(expr, step):
+    method = step.get('method', 'histcount')
+    if method not in HISTOGRAM_METHODS:
+        raise PipelineError('Unknown histogram method: %s' % method)
+    return apply_op('%s,%s' % (method, step['bin_list']), expr)
+
+
+def calc_pdf(expr, step):
+    counts = apply_op('histcount,%s' % step['bin_list'], expr)
+    return apply_op('div', counts, apply_op('vertsum', counts))
+
+
+def dataset_arithmetic(expr, step, other):
+    operation = step['operation']
+    if operation not in ARITHMETIC_OPERATIONS:
+        raise PipelineError('Unknown arithmetic operation: %s' % operation)
+    return apply_op(operation, expr, other)
+
+
+def fldcor(expr, step, other):
+    return apply_op('fldcor', expr, other)
+
+
+def timcor(expr, step, other):
+    return apply_op('timcor', expr, other)
+
+
+# Steps taking a single input stream. Steps listed in REUSES_INPUT read
+# their input more than once, so an expensive input is written to scratch
+# first instead of being computed twice.
+UNARY_STEPS = {'remap': remap,
+               'temporal_anomaly': temporal_anomaly,
+               'histogram': histogram,
+               'calc_pdf': calc_pdf}
+UNARY_STEPS.update(dict((name, make_agg(prefix)) for name, prefix in AGG_PREFIXES.items()))
+REUSES_INPUT = ('temporal_anomaly', 'calc_pdf')
+
+# Steps combining the stream with a second dataset given as 'other'.
+BINARY_STEPS = {'dataset_arithmetic': dataset_arithmetic,
+                'fldcor': fldcor,
+                'timcor': timcor}
+
+
+class Branch(object):
+    def __init__(self, spec):
+        self.name = spec['name']
+        if 'inputs' in spec:
+            self.inputs = list(spec['inputs'])
+        else:
+            self.inputs = [spec['input']]
+        self.output = spec.get('output')
+        self.steps = spec.get('steps', [])
+
+        for i, step in enumerate(self.steps):
+            name = step.get('step')
+            if name == 'ensemble_agg':
+                if i != 0:
+                    raise PipelineError('%s: ensemble_agg must be the first step' % self.name)
+            elif name not in UNARY_STEPS and name not in BINARY_STEPS:
+                raise PipelineError('%s: unknown step %s' % (self.name, name))
+        if len(self.inputs) > 1 and (not self.steps or self.steps[0]['step'] != 'ensemble_agg'):
+            raise PipelineError('%s: multiple inputs require an ensemble_agg first step' % self.name)
+
+    @property
+    def dependencies(self):
+        refs = [f for f in self.inputs if f.startswith('@')]
+        refs += [s['other'] for s in self.steps if str(s.get('other', '')).startswith('@')]
+        return set(ref[1:] for ref in refs)
+
+
+class Pipeline(object):
+    def __init__(self, branches, scratch_dir=None, jobs=None, dry_run=False, verbose=False):
+        self.branches = [Branch(spec) for spec in branches]
+        self.by_name = dict((b.name, b) for b in self.branches)
+        if len(self.by_name) != len(self.branches):
+            raise PipelineError('Branch names must be unique')
+        for branch in self.branches:
+            missing = branch.dependencies - set(self.by_name)
+            if missing:
+                raise PipelineError('%s: unknown branch reference(s) %s'
+                                    % (branch.name, ', '.join(sorted(missing))))
+
+        self.scratch_dir = scratch_dir or default_scratch_dir()
+        self.jobs = jobs
+        self.dry_run = dry_run
+        self.verbose = verbose
+        self.temp_dir = None
+        self.temp_count = itertools.count(1)
+
+    def temp_file(self, label):
+        return os.path.join(self.temp_dir, '%s.%d.nc' % (label, next(self.temp_count)))
+
+    def branch_output(self, branch):
+        return branch.output or os.path.join(self.temp_dir, 'branch_%s.nc' % branch.name)
+
+    def resolve(self, filename):
+        """Map a branch reference or xml catalogue to a file cdo can read."""
+
+        if filename.startswith('@'):
+            return self.branch_output(self.by_name[filename[1:]])
+
+        if not self.dry_run and not os.path.isfile(filename):
+            raise PipelineError("Input file doesn't exist: %s" % filename)
+
+        if filename.endswith('.xml'):
+            tmp_in = self.temp_file('xml_concat')
+            self.run(['python', XML_TO_NC, 'None', filename, tmp_in])
+            return tmp_in
+
+        return filename
+
+    def run(self, cmd):
+        if self.verbose or self.dry_run:
+            print(' '.join(cmd))
+        if not self.dry_run and subprocess.call(cmd) != 0:
+            raise PipelineError('Command failed: %s' % ' '.join(cmd))
+
+    def cdo(self, expr, outfile):
+        if is_plain(expr):
+            cmd = ['cdo', '-O', 'copy', expr[0], outfile]
+        else:
+            cmd = ['cdo', '-O', expr[0][1:]] + expr[1:] + [outfile]
+        self.run(cmd)
+
+    def materialise(self, expr, label):
+        if is_plain(expr):
+            return expr
+        tmp_file = self.temp_file(label)
+        self.cdo(expr, tmp_file)
+        return [tmp_file]
+
+    def build(self, branch):
+        """Fuse the steps of a branch into as few cdo calls as possible."""
+
+        inputs = [[self.resolve(f)] for f in branch.inputs]
+        steps = branch.steps
+
+        if steps and steps[0]['step'] == 'ensemble_agg':
+            # Operators with a variable number of inputs can only be the
+            # first operator of a chain, so the ensemble is written out
+            # when further steps follow.
+            expr = apply_op(steps[0]['statistic'], *inputs)
+            steps = steps[1:]
+            if steps:
+                expr = self.materialise(expr, 'ensemble_%s' % branch.name)
+        else:
+            expr = inputs[0]
+
+        for step in steps:
+            name = step['step']
+            if name in BINARY_STEPS:
+                other = [self.resolve(step['other'])]
+                expr = BINARY_STEPS[name](expr, step, other)
+            else:
+                if name in REUSES_INPUT:
+                    expr = self.materialise(expr, '%s_%s' % (name, branch.name))
+                expr = UNARY_STEPS[name](expr, step)
+
+        return expr
+
+    def run_branch(self, branch):
+        expr = self.build(branch)
+        self.cdo(expr, self.branch_output(branch))
+        return branch.name
+
+    def execute(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='cdo_pipeline.', dir=self.scratch_dir)
+        pool = ThreadPool(self.jobs)
+        try:
+            done = set()
+            pending = list(self.branches)
+            while pending:
+                ready = [b for b in pending if b.dependencies <= done]
+                if not ready:
+                    raise PipelineError('Circular branch references: %s'
+                                        % ', '.join(b.name for b in pending))
+                done.update(pool.map(self.run_branch, ready))
+                pending = [b for b in pending if b.name not in done]
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+
+def main(args):
+    """Run the program."""
+
+    with open(args.pipeline) as spec_file:
+        spec = json.load(spec_file)
+
+    try:
+        pipeline = Pipeline(spec['branches'],
+                            scratch_dir=args.scratch_dir or spec.get('scratch_dir'),
+                            jobs=args.jobs,
+                            dry_run=args.dry_run,
+                            verbose=args.verbose)
+        pipeline.execute()
+    except PipelineError as e:
+        print('ERROR: %s' % e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    description = 'Run a sequence of cdo wrapper steps as fused cdo operator chains'
+    parser = argparse.ArgumentParser(description=description,
+                                     epilog=__doc__.split('limitations under the License.')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("pipeline", help="JSON file describing the pipeline branches")
+    parser.add_argument("--scratch_dir", default=None,
+                        help="Directory for temporary files [default = $PBS_JOBFS or $TMPDIR]")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Number of branches to run at once [default = number of cpus]")
+    parser.add_argument("--dry_run", action="store_true", default=False,
+                        help="Print the cdo commands without running them")
+    parser.add_argument("--verbose", action="store_true", default=False,
+                        help="Print the cdo commands as they are run")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -4,64 +4,112 @@
 Returns a JSON object with a list of ranges and a
 corresponding density.
 
+With --use-stats the counts come from the side-car statistics
+file written by the sdm package (sdmrun.py dxt-stats), when it
+exists, instead of from the whole time series. Its fixed bins
+are merged into about the requested number of bins. Otherwise
+the file is read through a memory map (netcdf_point.py), so
+only the series of the requested point is read.
+
 """
 
 import argparse
 import json
+import os
 import sys
 import re
 import datetime as dt
 
 import numpy as np
-import scipy.io.netcdf as nc
+
+import netcdf_point
+
+
+def regroup_bins(edges, counts, bins):
+    """ Merge the fixed bins of a statistics file into about 'bins' bins,
+    dropping empty bins at either end. """
+
+    filled = np.flatnonzero(counts)
+    if filled.size:
+        counts = counts[filled[0]:filled[-1] + 1]
+        edges = edges[filled[0]:filled[-1] + 2]
+
+    width = int(np.ceil(len(counts) / float(bins)))
+    starts = np.arange(0, len(counts), width)
+    return np.append(edges[starts], edges[-1]), np.add.reduceat(counts, starts)
+
+
+def histogram_from_stats(stats_file, x_val, y_val, bins):
+    """ Look the histogram of one cell up in a statistics file. """
+
+    from sdm.stats import read_cell_stats
+
+    cell = read_cell_stats(stats_file, y_val, x_val)
+    edges, counts = regroup_bins(cell["bin_edges"], cell["histogram"], bins)
+
+    # Statistics files use the time units of the sdm output.
+    base = dt.date(1899, 12, 31)
+    time_bounds = [(base + dt.timedelta(days=int(cell["first_day"]))).isoformat(),
+                   (base + dt.timedelta(days=int(cell["last_day"]))).isoformat()]
+
+    outbins = []
+    for i in xrange(len(edges)-1):
+        outbins.append("(" + str(edges[i]) + "," + str(edges[i+1]) + ")")
+
+    return {"bins": outbins,
+            "counts": counts.tolist(),
+            "num_entries": int(cell["count"][0]),
+            "time_bounds": time_bounds}
 
 
 def main(args):
     """ First extract the time series, then calculate the frequencies. """
 
+    stats_file = args.infile + ".stats.nc"
+    if args.use_stats and os.path.isfile(stats_file):
+        output = histogram_from_stats(stats_file, args.x_val, args.y_val, args.bins)
+        with open(args.outfile, 'w') as output_file:
+            output_file.write(json.dumps(output))
+        return
+
     # Open the netCDF file
-    input_file = nc.netcdf_file(args.infile, 'r',
-                                mmap=False)
+    with netcdf_point.open_file(args.infile) as input_file:
 
-    # Grab the variable
-    input_var = input_file.variables[args.varname]
+        # Test that the required x and y fits.
+        val_shape = input_file.variables[args.varname].shape
+        if (args.x_val > val_shape[2] or
+            args.y_val > val_shape[1]):
+            print("ERROR: Given x or y vals are no good!")
+            sys.exit(1)
 
-    # Extract the start and end times
-    time_var = input_file.variables["time"]
+        # Extract the data, reading only the series of the point
+        output_data = netcdf_point.take(input_file.variables[args.varname],
+                                        (slice(None), args.y_val, args.x_val))
+
+        # Extract the start and end times
+        time_units = input_file.variables["time"].units
+        time_calendar = input_file.variables["time"].calendar
+        time_values = netcdf_point.take(input_file.variables["time"], [0, -1])
 
     # This is a little brittle - this extraction makes an
     # assumption about the use of a standard calendar.
     units_re = r"^(?P<unit>\S+) since (?P<year>\d+)-(?P<month>\d+)-(?P<day>\d+).+$"
 
-    match_dict = re.match(units_re, time_var.units).groupdict()
+    match_dict = re.match(units_re, time_units).groupdict()
     start_date = dt.date(int(match_dict["year"]), int(match_dict["month"]),
                          int(match_dict["day"]))
 
     if match_dict["unit"] != "days":
         raise Exception("Time unit: {} not understood"
                         .format(match_dict["unit"]))
-    if time_var.calendar != "standard":
+    if time_calendar != "standard":
         print("WARNING: calendar {} is not standard. JSON date output may be incorrect"
-              .format(time_var.calendar))
+              .format(time_calendar))
 
-    start_time = start_date + dt.timedelta(days=int(time_var[0]))
-    end_time = start_date + dt.timedelta(days=int(time_var[-1]))
+    start_time = start_date + dt.timedelta(days=int(time_values[0]))
+    end_time = start_date + dt.timedelta(days=int(time_values[-1]))
     time_bounds = [start_time.isoformat(), end_time.isoformat()]
 
-    # Test that the required x and y fits.
-    val_shape = input_var.shape
-    if (args.x_val > input_var.shape[2] or
-        args.y_val > input_var.shape[1]):
-        input_file.close()
-        print("ERROR: Given x or y vals are no good!")
-        sys.exit(1)
-
-    # Extract the data
-    output_data = input_var[:, args.y_val, args.x_val]
-
-    # Close the input file.
-    input_file.close()
-
     # Use the numpy histogram calculator.
     counts, bins = np.histogram(output_data, bins=args.bins)
 
@@ -93,6 +141,8 @@ if __name__ == "__main__":
                         type=int)
     parser.add_argument("bins", help="The number of bins for the frequencies",
                         type=int)
+    parser.add_argument("--use-stats", help="Use the statistics file (infile.stats.nc) if there is one",
+                        action="store_true", default=False)
 
     args = parser.parse_args()
 
@@ -4,6 +4,14 @@
 Returns a JSON object with an array of numerical
 data and a corresponding array of ISO strings.
 
+Optionally the series is decimated to about a given number
+of points (keeping the extremes), and/or min/max/mean pyramid
+levels are written alongside for charts that zoom. Both
+use the sdm package (sdm/sdm/lod.py).
+
+The file is read through a memory map (netcdf_point.py), so
+only the series of the requested point is read.
+
 """
 
 import argparse
@@ -12,50 +20,48 @@ import json
 import sys
 import datetime as dt
 
-import scipy.io.netcdf as nc
+import netcdf_point
 
 
 def main(args):
     """ Extract a JSON timeseries from a netCDF file."""
 
     # Open the netCDF file
-    input_file = nc.netcdf_file(args.infile, 'r',
-                                mmap=False)
-
-    # Grab the variable
-    input_var = input_file.variables[args.varname]
+    with netcdf_point.open_file(args.infile) as input_file:
 
-    # Test that the required x and y fits.
-    val_shape = input_var.shape
-    if (args.x_val > input_var.shape[2] or
-        args.y_val > input_var.shape[1]):
-        input_file.close()
-        print("ERROR: Given x or y vals are no good!")
-        sys.exit(1)
+        # Test that the required x and y fits.
+        val_shape = input_file.variables[args.varname].shape
+        if (args.x_val > val_shape[2] or
+            args.y_val > val_shape[1]):
+            print("ERROR: Given x or y vals are no good!")
+            sys.exit(1)
 
-    # Extract the data
-    output_data = input_var[:, args.y_val, args.x_val]
+        # Extract the data, reading only the series of the point
+        output_data = netcdf_point.take(input_file.variables[args.varname],
+                                        (slice(None), args.y_val, args.x_val))
 
-    # Extract the associated times
-    time_var = input_file.variables["time"]
+        # Extract the associated times
+        time_units = input_file.variables["time"].units
+        time_calendar = input_file.variables["time"].calendar
+        time_values = netcdf_point.take(input_file.variables["time"])
 
     # This is a little brittle - this extraction makes an
     # assumption about the use of a standard calendar.
     units_re = r"^(?P<unit>\S+) since (?P<year>\d+)-(?P<month>\d+)-(?P<day>\d+).+$"
 
-    match_dict = re.match(units_re, time_var.units).groupdict()
+    match_dict = re.match(units_re, time_units).groupdict()
     start_date = dt.date(int(match_dict["year"]), int(match_dict["month"]),
                          int(match_dict["day"]))
     
     if match_dict["unit"] != "days":
         raise Exception("Time unit: {} not understood"
                         .format(match_dict["unit"]))
-    if time_var.calendar != "standard":
+    if time_calendar != "standard":
         print("WARNING: calendar {} is not standard. JSON date output may be incorrect"
-              .format(time_var.calendar))
+              .format(time_calendar))
     
     output_times = map(lambda date: start_date + dt.timedelta(days=int(date)),
-                       time_var)
+                       time_values)
 
     output_strings = [datething.isoformat()
                       for datething in output_times]
@@ -64,12 +70,20 @@ def main(args):
     output = {"times": output_strings,
               args.varname: output_data.tolist()}
 
+    if args.lod or args.pyramid:
+        from sdm import lod
+
+        if args.pyramid:
+            output["lod_levels"] = lod.save_pyramid(args.outfile, output_strings,
+                                                    output_data, args.varname)
+        if args.lod:
+            times, values = lod.decimate(output_strings, output_data, args.lod)
+            output["times"] = times
+            output[args.varname] = values.tolist()
+
     with open(args.outfile, 'w') as output_file:
         output_file.write(json.dumps(output))
 
-    # Close the netCDF file
-    input_file.close()
-
 
 if __name__ == "__main__":
 
@@ -81,6 +95,10 @@ if __name__ == "__main__":
                         type=int)
     parser.add_argument("y_val", help="The y value to extract",
                         type=int)
+    parser.add_argument("--lod", help="Decimate the series to about this many points",
+                        type=int, default=None)
+    parser.add_argument("--pyramid", help="Also write min/max/mean pyramid levels",
+                        action="store_true", default=False)
 
     args = parser.parse_args()
 
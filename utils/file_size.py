@@ -1,46 +1,195 @@
 #!/usr/bin/env python
 
-import cdms2
-import os, sys
+import os, re, sys
+import sqlite3
+import xml.etree.ElementTree as ET
 from optparse import OptionParser
 
 __version__ = "$rev$"
 
-def get_filesize(ifile):
+DEFAULT_INDEX = os.path.join(os.path.expanduser('~'), '.cwsl_file_size.db')
 
-    try:
-        fh = cdms2.open(ifile)
-    except Exception, e:
-        print("Cannot determine filesize: %s" % e)
-        sys.exit(1)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS catalogues (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    total INTEGER
+);
+CREATE TABLE IF NOT EXISTS members (
+    catalogue TEXT,
+    path TEXT,
+    mtime REAL,
+    size INTEGER,
+    PRIMARY KEY (catalogue, path)
+);
+"""
+
+# The innermost lists of a cdms_filemap, e.g. [0,365,-,-,-,tas_1990.nc].
+FILEMAP_LIST = re.compile(r'\[([^\[\]]*)\]')
+FILEMAP_INDEX = re.compile(r'^(-|\d+)$')
+
+
+def open_index(index_file):
+    """Open (creating if needed) the SQLite file size index."""
+
+    db = sqlite3.connect(index_file, timeout=60)
+    db.executescript(SCHEMA)
+    return db
+
+
+def catalogue_members(ifile):
+    """Paths of the data files of an xml catalogue, or None if ifile isn't one.
+
+    Only the attributes of the opening <dataset> element are read, so this
+    doesn't need cdms2 and doesn't parse the (possibly huge) axis values.
+    """
 
-    total = 0
-    #
     try:
-        for data_file in fh.getPaths():
-            total += os.stat(os.path.join(fh.datapath,data_file)).st_size
-    except:
+        for event, elem in ET.iterparse(ifile, events=('start',)):
+            attrs = elem.attrib
+            break
+    except ET.ParseError:
+        return None
+    if 'cdms_filemap' not in attrs:
+        return None
+
+    directory = attrs.get('directory', '')
+    if not os.path.isabs(directory):
+        directory = os.path.join(os.path.dirname(os.path.abspath(ifile)), directory)
+
+    members = []
+    for entry in FILEMAP_LIST.findall(attrs['cdms_filemap']):
+        fields = [field.strip() for field in entry.split(',')]
+        if len(fields) >= 5 and FILEMAP_INDEX.match(fields[0]):
+            path = os.path.join(directory, fields[-1])
+            if path not in members:
+                members.append(path)
+    return members
+
+
+def stat_members(paths):
+    """(path, mtime, size) of each member file."""
+
+    stats = []
+    for path in paths:
+        st = os.stat(path)
+        stats.append((path, st.st_mtime, st.st_size))
+    return stats
+
+
+def index_catalogue(db, ifile, st):
+    """(Re)build the index entries of ifile, returning its total size."""
+
+    members = catalogue_members(ifile)
+    if members is None:
         #Not a xml catalog?
-        total += os.stat(ifile).st_size
+        stats = [(ifile, st.st_mtime, st.st_size)]
+    else:
+        stats = stat_members(members)
 
+    total = sum(size for path, mtime, size in stats)
+    db.execute("DELETE FROM members WHERE catalogue = ?", (ifile,))
+    db.executemany("INSERT INTO members VALUES (?, ?, ?, ?)",
+                   [(ifile, path, mtime, size) for path, mtime, size in stats])
+    db.execute("INSERT OR REPLACE INTO catalogues VALUES (?, ?, ?, ?)",
+               (ifile, st.st_mtime, st.st_size, total))
     return total
 
 
+def refresh_members(db, ifile):
+    """Re-stat the indexed member files of ifile, updating those that changed."""
+
+    total = 0
+    changed = False
+    rows = db.execute("SELECT path, mtime, size FROM members WHERE catalogue = ?",
+                      (ifile,)).fetchall()
+    for path, mtime, size in rows:
+        st = os.stat(path)
+        if (st.st_mtime, st.st_size) != (mtime, size):
+            db.execute("UPDATE members SET mtime = ?, size = ? WHERE catalogue = ? AND path = ?",
+                       (st.st_mtime, st.st_size, ifile, path))
+            changed = True
+        total += st.st_size
+    if changed:
+        db.execute("UPDATE catalogues SET total = ? WHERE path = ?", (total, ifile))
+    return total
+
+
+def get_filesize(ifile, db=None):
+    """Total size of ifile, or of the data files of an xml catalogue.
+
+    With an index (an open sqlite3 connection) the member files of a
+    catalogue are only listed again when the catalogue itself has changed.
+    Otherwise the indexed members are stat-ed, so a member rewritten under
+    an unchanged catalogue is still counted at its current size.
+    """
+
+    try:
+        ifile = os.path.abspath(ifile)
+        st = os.stat(ifile)
+
+        if db is None:
+            members = catalogue_members(ifile)
+            if members is None:
+                return st.st_size
+            return sum(size for path, mtime, size in stat_members(members))
+
+        row = db.execute("SELECT mtime, size, total FROM catalogues WHERE path = ?",
+                         (ifile,)).fetchone()
+        if row is None or (row[0], row[1]) != (st.st_mtime, st.st_size):
+            return index_catalogue(db, ifile, st)
+        return refresh_members(db, ifile)
+
+    except (IOError, OSError), e:
+        print("Cannot determine filesize: %s" % e)
+        sys.exit(1)
+
+
+def read_list(list_file):
+    """File names from list_file, one per line ('-' for stdin)."""
+
+    fh = sys.stdin if list_file == '-' else open(list_file)
+    try:
+        return [line.strip() for line in fh if line.strip()]
+    finally:
+        if fh is not sys.stdin:
+            fh.close()
+
+
 if __name__ == "__main__":
-    usage = "usage: %prog [options] ifile\n" + \
-            "  ifile:\t\twill check size of ifile\n"
+    usage = "usage: %prog [options] ifile [ifile ...]\n" + \
+            "  ifile:\t\twill check size of ifile\n" + \
+            "  With more than one ifile (or -f) prints 'size path' for each"
     parser = OptionParser(usage=usage, version=__version__)
     parser.add_option('-m', '--mbytes', dest='mbytes',
                       action="store_true",default=False, help='Return output in MB')
+    parser.add_option('-f', '--file-list', dest='file_list', default=None,
+                      help='Read the files to size from this file, one per line (- for stdin)')
+    parser.add_option('-i', '--index', dest='index', default=DEFAULT_INDEX,
+                      help='SQLite index of catalogue sizes [default: %default]')
+    parser.add_option('-n', '--no-index', dest='use_index',
+                      action="store_false", default=True, help='Stat every file, ignoring the index')
 
     (options, args) = parser.parse_args()
-    if len(args) > 1:
+    if options.file_list:
+        args = args + read_list(options.file_list)
+    if not args:
         print("ERROR: incorrect number of arguments")
         print(usage)
         sys.exit(1)
 
-    filesize = get_filesize(args[0])
-    if options.mbytes:
-        print(filesize/(1024*1024))
-    else:
-        print(filesize)
+    db = open_index(options.index) if options.use_index else None
+    try:
+        for ifile in args:
+            filesize = get_filesize(ifile, db)
+            if options.mbytes:
+                filesize = filesize/(1024*1024)
+            if len(args) == 1 and not options.file_list:
+                print(filesize)
+            else:
+                print("%d %s" % (filesize, ifile))
+    finally:
+        if db is not None:
+            db.commit()
+            db.close()
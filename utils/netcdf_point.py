@@ -0,0 +1,20 @@
+""" Read points of netCDF files through a memory map.
+
+This is the memory-mapped reader of the sdm package (sdm/sdm/ncio.py),
+shared rather than copied. It only needs numpy and scipy, so when the
+sdm package is not installed it is loaded from its file in this
+repository.
+
+"""
+
+import imp
+import os
+
+try:
+    from sdm import ncio
+except ImportError:
+    ncio = imp.load_source('ncio', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                os.pardir, 'sdm', 'sdm', 'ncio.py'))
+
+open_file = ncio.open_file
+take = ncio.take
@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 
-''' Script to plot directly from CDO seas output files in cwsl. '''
+''' Script to plot directly from CDO seas output files in cwsl.
+
+By default every season is written to a temporary file and plotted with
+mpl_toolbox. With --in_memory the file is read once and each panel is
+drawn straight from its slice of the data, in a pool of processes,
+without any temporary files.
+'''
 
 from argparse import ArgumentParser
+import multiprocessing
 import numpy as np
-import os,commands,cdms2
+import os,sys,cdms2
 
 from mpl_toolbox import utils
 from mpl_toolbox import colour_utils
@@ -18,6 +25,188 @@ cdms2.setNetcdfDeflateFlag(0) ## where value is either 0 or 1
 cdms2.setNetcdfDeflateLevelFlag(0) ## where value is a integer between 0 and 9 included
 
 
+# Extents of the regions the in-memory renderer knows about,
+# as (lon_min, lon_max, lat_min, lat_max).
+REGIONS = {'WORLD360': (0, 360, -90, 90),
+           'WORLD': (-180, 180, -90, 90),
+           'AUS': (110, 160, -45, -10)}
+
+# Panel size in inches and resolution of the in-memory renderer.
+PANEL_SIZE = (4.0, 3.0)
+DPI = 100
+
+
+def first_variable(fh):
+    """ The first variable on a lat/lon grid (what cdo showname gives first). """
+
+    for name in fh.listvariables():
+        var = fh[name]
+        if var.getLatitude() is not None and var.getLongitude() is not None:
+            return name
+    raise ValueError('No gridded variable in %s' % fh.id)
+
+
+def panel_labels(noseas):
+    """ Month or season names for the panels of cdo ymon*/yseas* output. """
+
+    if noseas == len(m_list):
+        return [month.capitalize() for month in m_list]
+    if noseas == 4:
+        return [seas.upper() for seas in s_list[:4]]
+    return [str(seas) for seas in range(1, noseas + 1)]
+
+
+def rows_cols(npanels):
+    """ A near square grid with room for every panel. """
+
+    ncols = int(np.ceil(np.sqrt(npanels)))
+    return int(np.ceil(npanels / float(ncols))), ncols
+
+
+def parse_ticks(tick_string):
+    """ Levels and extend setting from '(0.1,1.3,2.5)' or '[0.0,1.1,2.0]'. """
+
+    levels = [float(tick) for tick in tick_string.strip('()[] ').split(',')]
+    extend = 'both' if tick_string.strip().startswith('(') else 'neither'
+    return levels, extend
+
+
+def convert_units(data, units):
+    """ Kelvin to Celsius and kg m-2 s-1 to mm/day. """
+
+    if units == 'K':
+        return data - 273.15, 'C'
+    if units in ('kg m-2 s-1', 'kg/m2/s'):
+        return data * 86400., 'mm/day'
+    return data, units
+
+
+def read_panels(infile, variable, conv_units=False, units=None):
+    """ Read every time step (season) of variable in one go. """
+
+    fh = cdms2.open(infile, 'r')
+    try:
+        variable = variable or first_variable(fh)
+        data = fh(variable)
+        lats = np.array(data.getLatitude()[:])
+        lons = np.array(data.getLongitude()[:])
+        var_units = getattr(data, 'units', '')
+        data = np.ma.masked_invalid(np.ma.array(data))
+    finally:
+        fh.close()
+
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    if conv_units:
+        data, var_units = convert_units(data, var_units)
+    return data, lats, lons, units or var_units
+
+
+def render_panel(task):
+    """ Draw one panel and return it as an RGBA image array.
+
+    Only matplotlib's object oriented API is used, so panels can be
+    drawn in separate processes.
+    """
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.colors import BoundaryNorm, Normalize
+
+    data, lats, lons, extent, cmap, levels, vmin, vmax, plot_type, label = task
+
+    fig = Figure(figsize=PANEL_SIZE, dpi=DPI)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_axes([0.1, 0.1, 0.85, 0.8])
+
+    if levels is None:
+        norm = Normalize(vmin=vmin, vmax=vmax)
+    else:
+        norm = BoundaryNorm(levels, ncolors=256)
+
+    if plot_type == 'pcolor':
+        ax.pcolormesh(lons, lats, data, cmap=cmap, norm=norm)
+    elif plot_type == 'contourf':
+        ax.contourf(lons, lats, data, levels=levels, cmap=cmap, norm=norm)
+    else:
+        ax.contour(lons, lats, data, levels=levels, cmap=cmap, norm=norm)
+
+    ax.set_xlim(extent[0], extent[1])
+    ax.set_ylim(extent[2], extent[3])
+    ax.set_title(label, fontsize='small')
+    ax.tick_params(labelsize='x-small')
+
+    canvas.draw()
+    width, height = canvas.get_width_height()
+    return np.frombuffer(canvas.tostring_argb(), dtype=np.uint8).reshape(height, width, 4)
+
+
+def plot_in_memory(infile, outfile, variable=None, region='WORLD360', title=None,
+                   colourmap='hot', ticks=None, plot_type='pcolor', units=None,
+                   conv_units=False, processes=None):
+    """ Plot every season of infile on a panel with a shared colour bar.
+
+    The data are read once and the common colour scale comes from a
+    single reduction over all the seasons, so no dummy plot is needed.
+    """
+
+    # mpl_toolbox has imported pyplot already, so the backend can no longer
+    # be chosen. The figure is drawn on an explicit Agg canvas instead.
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.cm import ScalarMappable
+    from matplotlib.colors import BoundaryNorm, Normalize
+
+    if region not in REGIONS:
+        raise ValueError('Region %s is not one of %s' % (region, ', '.join(sorted(REGIONS))))
+    extent = REGIONS[region]
+
+    data, lats, lons, units = read_panels(infile, variable, conv_units, units)
+    if region == 'WORLD':
+        lons = np.where(lons > 180, lons - 360, lons)
+        order = np.argsort(lons)
+        lons, data = lons[order], data[..., order]
+
+    levels, extend = parse_ticks(ticks) if ticks else (None, 'neither')
+    vmin, vmax = np.ma.min(data), np.ma.max(data)
+    labels = panel_labels(len(data))
+
+    tasks = [(data[i], lats, lons, extent, colourmap, levels, vmin, vmax, plot_type, labels[i])
+             for i in range(len(data))]
+    if processes == 1 or len(tasks) == 1:
+        images = [render_panel(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            images = pool.map(render_panel, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    nrows, ncols = rows_cols(len(tasks))
+    fig = Figure(figsize=(ncols * PANEL_SIZE[0], nrows * PANEL_SIZE[1] + 1.0))
+    FigureCanvasAgg(fig)
+    axes = np.array([fig.add_subplot(nrows, ncols, i + 1) for i in range(nrows * ncols)])
+    for ax in axes.flat:
+        ax.set_axis_off()
+    for ax, image in zip(axes.flat, images):
+        # Agg gives ARGB, imshow wants RGBA.
+        ax.imshow(np.roll(image, -1, axis=2), interpolation='nearest')
+
+    if levels is None:
+        norm = Normalize(vmin=vmin, vmax=vmax)
+    else:
+        norm = BoundaryNorm(levels, ncolors=256)
+    mappable = ScalarMappable(norm=norm, cmap=colourmap)
+    mappable.set_array(np.ma.compressed(data))
+    colourbar = fig.colorbar(mappable, ax=axes.tolist(), orientation='horizontal',
+                             fraction=0.04, pad=0.03, extend=extend)
+    colourbar.set_label(units)
+
+    fig.suptitle(title or os.path.basename(infile))
+    fig.savefig(outfile, dpi=DPI)
+
+
 
 # Main
 ##############################################################################
@@ -60,6 +249,15 @@ if __name__ == '__main__':
     parser.add_argument('--conv_units',
                         help='''Convert the units of the variable plotted in the panel''',
                         default='False')
+    parser.add_argument('--in_memory',
+                        help='''Read the file once and draw the panels from memory, without temporary
+                        files or mpl_toolbox (no shapefile overlays; regions: %s)''' % ', '.join(sorted(REGIONS)),
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--processes',
+                        help='''Number of processes drawing panels with --in_memory [default = number of cpus]''',
+                        type=int,
+                        default=None)
     args = parser.parse_args()
     
     infile = args.infile
@@ -75,7 +273,15 @@ if __name__ == '__main__':
     ### if variable not specified get first one listed in file ###
     if (variable == None or variable == ''):
         
-        variable = commands.getstatusoutput('cdo showname %s' %infile )[1].split('\n')[1].split()[0]
+        fh = cdms2.open(infile,'r')
+        variable = first_variable(fh)
+        fh.close()
+
+    if args.in_memory:
+        plot_in_memory(infile, args.outfile, variable, region=args.region, title=args.title,
+                       colourmap=args.colourmap, ticks=args.ticks, plot_type=args.plot_type,
+                       units=args.units, conv_units=conv_units, processes=args.processes)
+        sys.exit(0)
     
     ### generate a list of tmp filenames ###
     fpath,fname = os.path.split(infile)
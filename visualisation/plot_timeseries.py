@@ -1,11 +1,14 @@
 #!/bin/env python
 
+import os
+import sys
+import time
 import argparse
 import datetime
+import multiprocessing
 
-#CDAT
-import cdms2
 import numpy as np
+import netCDF4 as nc4
 
 #Matplotlib libraries
 import matplotlib
@@ -13,22 +16,94 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import matplotlib.font_manager as font_manager
-from pylab import legend
+
+# Calendars that datetime (and so matplotlib) can represent exactly.
+REAL_CALENDARS = ('standard', 'gregorian', 'proleptic_gregorian')
+
+SECONDS = {'second': 1., 'minute': 60., 'hour': 3600., 'day': 86400.}
+
+# The figure and axes reused by every plot drawn in this process.
+_template = {}
+
+
+def time_to_datenum(values, units, calendar='standard'):
+    """
+    Convert time values to matplotlib date numbers, truncated to the day
+    """
+
+    calendar = (calendar or 'standard').lower()
+    values = np.asarray(values, dtype=np.float64)
+
+    step = units.partition(' since ')[0].strip().lower().rstrip('s')
+    origin = nc4.num2date(0, units, calendar)
+    real_origin = calendar == 'proleptic_gregorian' or \
+        (calendar in REAL_CALENDARS and (origin.year, origin.month, origin.day) >= (1582, 10, 15))
+
+    if real_origin and step in SECONDS:
+        # Plain arithmetic from the origin.
+        start = mdates.date2num(datetime.datetime(origin.year, origin.month, origin.day,
+                                                  origin.hour, origin.minute, origin.second))
+        return np.floor(start + values * SECONDS[step] / 86400.)
+
+    # Non-standard calendars: place each date on the real calendar by
+    # year, month and day, so that e.g. 360_day months line up.
+    dates = nc4.num2date(values, units, calendar)
+    years = np.array([d.year for d in dates])
+    months = np.array([d.month for d in dates])
+    days = np.array([d.day for d in dates])
+    month_starts = ((years - 1970) * 12 + months - 1).astype('datetime64[M]')
+    days_1970 = (month_starts.astype('datetime64[D]') - np.datetime64('1970-01-01', 'D')).astype(np.float64)
+    return mdates.date2num(datetime.datetime(1970, 1, 1)) + days_1970 + days - 1
+
+
+def read_series(ifile, variable):
+    """
+    Read the time axis (as matplotlib date numbers), data and units of variable
+    """
+
+    if ifile.endswith('.xml'):
+        # Catalogues need cdms2, only imported when required.
+        import cdms2
+        fin = cdms2.open(ifile, 'r')
+        data = fin(variable, squeeze=1)
+        time_axis = data.getTime()
+        values, units = time_axis[:], time_axis.units
+        calendar = getattr(time_axis, 'calendar', 'standard')
+        data_units = data.units
+        data = np.ma.array(data)
+        fin.close()
+    else:
+        with nc4.Dataset(ifile) as fin:
+            var = fin.variables[variable]
+            time_var = fin.variables[var.dimensions[0]]
+            values, units = time_var[:], time_var.units
+            calendar = getattr(time_var, 'calendar', 'standard')
+            data_units = var.units
+            data = np.ma.squeeze(var[:])
+
+    return time_to_datenum(values, units, calendar), data, data_units
+
+
+def figure_template():
+    """
+    The figure and axes of this process, created on first use
+    """
+
+    if not _template:
+        _template['fig'], _template['ax'] = plt.subplots()
+    return _template['fig'], _template['ax']
+
 
 def plot(title,variable,ifile,ofile):
     """
     Based on example from http://matplotlib.org/examples/api/date_demo.html
     """
 
-    fin = cdms2.open(ifile,'r')
-    data = fin(variable,squeeze=1)
+    time_axis, data, units = read_series(ifile, variable)
 
-    #Convert time axis to datetime
-    time_axis = [datetime.datetime(d.year,d.month,d.day) for d in data.getAxis(0).asComponentTime()]
-    units = data.units
-
-    fig, ax = plt.subplots()
-    ax.plot(time_axis,np.array(data),color='blue',lw=3.0,label=variable)
+    fig, ax = figure_template()
+    ax.cla()
+    ax.plot_date(time_axis,data,fmt='-',color='blue',lw=3.0,label=variable)
 
     years    = mdates.YearLocator(5)   # every 5 years
     yearly   = mdates.YearLocator()  # every year
@@ -40,7 +115,7 @@ def plot(title,variable,ifile,ofile):
     ax.xaxis.set_minor_locator(yearly)
 
     datemin = time_axis[0]
-    datemax = datetime.date(time_axis[-1].year+1, 1, 1)
+    datemax = mdates.date2num(datetime.date(mdates.num2date(time_axis[-1]).year+1, 1, 1))
     ax.set_xlim(datemin, datemax)
 
     # format the coords message box
@@ -55,18 +130,88 @@ def plot(title,variable,ifile,ofile):
     ax.set_title(title)
 
     font = font_manager.FontProperties(size='medium')
-    legend(loc=2,prop=font,numpoints=1,labelspacing=0.3,ncol=2)
+    ax.legend(loc=2,prop=font,numpoints=1,labelspacing=0.3,ncol=2)
 
     fig.savefig(ofile)
 
+
+def plot_entry(entry):
+    """
+    Plot one manifest entry, returning an error message on failure
+    """
+
+    variable, ifile, ofile, title = entry
+    try:
+        plot(title, variable, ifile, ofile)
+    except Exception as e:
+        return '%s: %s' % (ifile, e)
+    return None
+
+
+def read_manifest(manifest):
+    """
+    Read (variable, input, output, title) entries, one per line
+
+    The fields are separated by whitespace and the title, which is
+    optional, is the rest of the line. Blank lines and lines starting
+    with # are ignored.
+    """
+
+    entries = []
+    with open(manifest) as fh:
+        for line in fh:
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            fields = line.split(None, 3)
+            if len(fields) < 3:
+                raise ValueError('Bad manifest line: %s' % line.strip())
+            title = fields[3].strip() if len(fields) == 4 else "Timeseries Plot"
+            entries.append((fields[0], fields[1], fields[2], title))
+    return entries
+
+
+def plot_batch(entries, processes=None):
+    """
+    Plot every entry in a pool of processes and report the throughput
+    """
+
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        errors = [error for error in pool.imap_unordered(plot_entry, entries, chunksize=8) if error]
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    for error in errors:
+        print('ERROR: %s' % error)
+    print('%d plots in %.1f s (%.1f plots/sec)'
+          % (len(entries) - len(errors), elapsed, (len(entries) - len(errors)) / max(elapsed, 1e-6)))
+    return len(errors)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Plot timeseries from NetCDF file')
-    parser.add_argument('variable', help='variable name')
-    parser.add_argument('input', help='input file (nc)')
-    parser.add_argument('output', help='output file (png)')
+    parser.add_argument('variable', help='variable name', nargs='?')
+    parser.add_argument('input', help='input file (nc)', nargs='?')
+    parser.add_argument('output', help='output file (png)', nargs='?')
     parser.add_argument('--title', help='Plot Title',
                         default="Timeseries Plot")
+    parser.add_argument('--manifest', help='file of "variable input output [title]" lines to plot '
+                        'in one batch, instead of a single plot', default=None)
+    parser.add_argument('--processes', help='number of processes for --manifest '
+                        '[default = number of cpus]', type=int, default=None)
 
     args = parser.parse_args()
 
+    if args.manifest:
+        if os.path.isfile(args.manifest):
+            sys.exit(1 if plot_batch(read_manifest(args.manifest), args.processes) else 0)
+        print('ERROR: no manifest %s' % args.manifest)
+        sys.exit(1)
+    if not args.output:
+        parser.print_usage()
+        sys.exit(1)
+
     plot(args.title, args.variable, args.input, args.output)